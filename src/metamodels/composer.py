@@ -14,9 +14,16 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import hashlib
+import inspect
+import json
+import multiprocessing
 import sqlite3
+import time
+import weakref
 
 import numpy as np
+import pandas as pd
 
 import bayeslite.core as core
 from bayeslite.exception import BayesLiteException as BLE
@@ -28,6 +35,18 @@ from crosscat.utils import sample_utils as su
 
 import bayeslite.metamodel
 
+from bdbcontrib.bql_utils import cursor_to_df
+from bdbcontrib.bql_utils import table_to_df
+from bdbcontrib.predictors.predictor import IBayesDBForeignPredictorFactory
+from bdbcontrib.predictors.predictor import logpdf_many
+from bdbcontrib.predictors.predictor import predictive_distribution_many
+from bdbcontrib.predictors.predictor import simulate_many
+from bdbcontrib.py_utils import LRUCache
+
+# Milliseconds for a connection to wait for the locks of another, as the
+# parent and the workers of the process pool share the database file.
+_BUSY_TIMEOUT = 3600 * 1000
+
 composer_schema_1 = [
 '''
 INSERT INTO bayesdb_metamodel
@@ -118,29 +137,272 @@ BEGIN
 END;
 ''']
 
+composer_schema_1to2 = [
+'''
+UPDATE bayesdb_metamodel SET version = 2 WHERE name = 'composer';
+''','''
+-- JSON object of keyword options for the foreign predictor, or NULL.
+ALTER TABLE bayesdb_composer_column_foreign_predictor
+    ADD COLUMN predictor_options TEXT;
+''']
+
+composer_schema_2to3 = [
+'''
+UPDATE bayesdb_metamodel SET version = 3 WHERE name = 'composer';
+''','''
+-- SHA-1 hex digest of predictor_binary, keying cached predictors.
+ALTER TABLE bayesdb_composer_column_foreign_predictor
+    ADD COLUMN predictor_digest TEXT;
+''']
+
 class Composer(bayeslite.metamodel.IBayesDBMetamodel):
     """A metamodel which composes foreign predictors with CrossCat.
     """
 
-    def __init__(self, n_samples=None):
+    def __init__(self, n_samples=None, resampling=None, target_ess=None,
+            min_samples=None, max_samples=None, target_stderr=None,
+            processes=None, logger=None, predictor_cache_bytes=None,
+            instrument=False):
+        """Create a composer metamodel.
+
+        Parameters
+        ----------
+        n_samples : int, optional
+            Number of importance samples drawn per weighted pool.
+            Defaults to 100.
+
+        resampling : str, optional
+            How `simulate` draws predictions from weighted pools.
+            'systematic' (default) or 'stratified' draw one or a few
+            pools, sized by their effective sample size, and resample
+            all predictions from them.  'independent' draws a fresh pool
+            for every prediction, yielding independent predictions at
+            the cost of one pool each.
+
+        target_ess : float, optional
+            If given, importance sampling is adaptive: batches of
+            `n_samples` samples are drawn until the effective sample size
+            of the importance weights reaches `target_ess`, within
+            `min_samples` and `max_samples`, for each row of a pool.
+
+        min_samples, max_samples : int, optional
+            Caps on the number of samples of an adaptive pool.  Default
+            to `n_samples` and `10*n_samples`.
+
+        target_stderr : float, optional
+            If given, Monte Carlo estimates of mutual information keep
+            drawing batches of samples until their standard error falls
+            to `target_stderr`, within `max_samples` samples.
+
+        processes : int, optional
+            If given, multi-model estimates (`column_dependence_probability`,
+            `column_mutual_information` and `logpdf_joint` with no
+            `modelno`) fan out the per-model work over a pool of this
+            many worker processes, each with its own handle on the
+            database file and its own caches.  Every model is evaluated
+            under a seed drawn from `bdb.np_prng`, so results do not
+            depend on the number of processes.  Workers only see
+            committed models; in-memory databases are always evaluated
+            serially.  Call `shutdown` to terminate the pool.
+            INITIALIZE also trains independent foreign predictors in
+            this many processes.
+
+        logger : object, optional
+            A bayeslite.loggers.BqlLogger to which the progress of
+            training foreign predictors is reported.  Quiet by default.
+
+        predictor_cache_bytes : int, optional
+            Budget, in bytes of serialized predictors, of the cache of
+            deserialized foreign predictors of each database.  Least
+            recently used predictors beyond the budget are discarded and
+            deserialized again on demand.  Unbounded by default.  See
+            `warm`, `evict` and `predictor_cache_info`.
+
+        instrument : bool, optional
+            If True, record the number of calls, wall time and number of
+            samples of each stage of inference (crosscat simulation and
+            density, foreign predictor simulation and density, predictor
+            deserialization, catalog and row reads), per generator and
+            column.  See `stats`, `stats_df` and `reset_stats`.  Work
+            done in worker processes is not recorded.
+        """
         # In-memory map of registered foreign predictor builders.
         self.predictor_builder = {}
-        self.predictor_cache = {}
+        # Deserialized foreign predictors of each database, across
+        # transactions.
+        assert predictor_cache_bytes is None or 0 <= predictor_cache_bytes
+        self.predictor_cache_bytes = predictor_cache_bytes
+        self.predictor_cache = weakref.WeakKeyDictionary()
         # Default number of samples.
         if n_samples is None:
             self.n_samples = 100
         else:
             assert 0 < n_samples
             self.n_samples = n_samples
+        # Resampling scheme of simulate.
+        if resampling is None:
+            self.resampling = 'systematic'
+        else:
+            assert resampling in ['systematic', 'stratified', 'independent']
+            self.resampling = resampling
+        # Adaptive importance sampling.
+        assert target_ess is None or 0 < target_ess
+        self.target_ess = target_ess
+        if min_samples is None:
+            self.min_samples = self.n_samples
+        else:
+            assert 0 < min_samples
+            self.min_samples = min_samples
+        if max_samples is None:
+            self.max_samples = 10 * self.n_samples
+        else:
+            assert self.min_samples <= max_samples
+            self.max_samples = max_samples
+        # Effective sample size of the most recent weighted pool.
+        # Early stopping of mutual information.
+        assert target_stderr is None or 0 < target_stderr
+        self.target_stderr = target_stderr
+        # Worker processes for multi-model estimates, started lazily.
+        assert processes is None or 0 < processes
+        self.processes = processes
+        self._pool = None
+        self._pool_pathname = None
+        self.logger = logger
+        # Instrumentation {(stage, genid, colno): [calls, seconds, samples]}.
+        self.instrument = instrument
+        self._stats = {}
 
     def _predictor_cache(self, bdb):
+        if bdb not in self.predictor_cache:
+            self.predictor_cache[bdb] = LRUCache(maxsize=self.predictor_cache_bytes)
+        return self.predictor_cache[bdb]
+
+    def _evidence_cache(self, bdb):
+        assert bdb.cache is not None
+        if 'composer_evidence' in bdb.cache:
+            return bdb.cache['composer_evidence']
+        else:
+            evidence_cache = {}
+            bdb.cache['composer_evidence'] = evidence_cache
+            return evidence_cache
+
+    def _dependence_cache(self, bdb):
+        assert bdb.cache is not None
+        if 'composer_dependence' in bdb.cache:
+            return bdb.cache['composer_dependence']
+        else:
+            dependence_cache = {}
+            bdb.cache['composer_dependence'] = dependence_cache
+            return dependence_cache
+
+    def _invalidate_models(self, bdb, genid):
+        # Models changed: estimates of evidence densities and crosscat
+        # dependence probabilities are stale.
+        if bdb.cache is not None:
+            for cache in [self._evidence_cache(bdb),
+                    self._dependence_cache(bdb)]:
+                for key in [k for k in cache if k[0] == genid]:
+                    del cache[key]
+
+    def _schema_cache(self, bdb):
         assert bdb.cache is not None
-        if 'composer' in bdb.cache:
-            return bdb.cache['composer']
+        if 'composer_schema' in bdb.cache:
+            return bdb.cache['composer_schema']
         else:
-            comp_cache = {}
-            bdb.cache['composer'] = comp_cache
-            return comp_cache
+            schema_cache = {}
+            bdb.cache['composer_schema'] = schema_cache
+            return schema_cache
+
+    def _schema(self, bdb, genid):
+        # Structural metadata of the generator (column ownership, parents,
+        # topological order, internal crosscat generator) is immutable for
+        # the lifetime of the generator, so load it once per transaction
+        # and serve every lookup from memory.  Only the digests of the
+        # foreign predictors change, and storing them invalidates it.
+        if bdb.cache is None:
+            return self._load_schema(bdb, genid)
+        schema_cache = self._schema_cache(bdb)
+        if genid not in schema_cache:
+            with self._timed('schema', genid):
+                schema_cache[genid] = self._load_schema(bdb, genid)
+        return schema_cache[genid]
+
+    def _invalidate_schema(self, bdb, genid):
+        if bdb.cache is not None:
+            self._schema_cache(bdb).pop(genid, None)
+
+    def _load_schema(self, bdb, genid):
+        cursor = bdb.sql_execute('''
+            SELECT crosscat_generator_id FROM bayesdb_composer_cc_id
+                WHERE generator_id = ?
+        ''', (genid,))
+        cc_id = cursor.fetchall()[0][0]
+        cursor = bdb.sql_execute('''
+            SELECT colno, local FROM bayesdb_composer_column_owner
+                WHERE generator_id = ?
+                ORDER BY colno ASC
+        ''', (genid,))
+        owners = cursor.fetchall()
+        lcols = frozenset(colno for colno, local in owners if local)
+        fcols = frozenset(colno for colno, local in owners if not local)
+        pcols = {fcol: set() for fcol in fcols}
+        cursor = bdb.sql_execute('''
+            SELECT fcolno, pcolno FROM bayesdb_composer_column_parents
+                WHERE generator_id = ?
+                ORDER BY fcolno ASC, pcolno ASC
+        ''', (genid,))
+        for fcolno, pcolno in cursor:
+            pcols[fcolno].add(pcolno)
+        # Local ancestors of every column: a local column is its own, and
+        # a foreign column inherits those of its parents.
+        lancestors = {colno: frozenset([colno]) for colno in lcols}
+        def local_ancestors(colno):
+            if colno not in lancestors:
+                lancestors[colno] = frozenset().union(
+                    *[local_ancestors(pcol) for pcol in pcols[colno]])
+            return lancestors[colno]
+        for fcol in fcols:
+            local_ancestors(fcol)
+        cursor = bdb.sql_execute('''
+            SELECT colno FROM bayesdb_composer_column_toposort
+                WHERE generator_id = ?
+                ORDER BY position ASC
+        ''', (genid,))
+        topo = tuple(row[0] for row in cursor)
+        cursor = bdb.sql_execute('''
+            SELECT colno, predictor_name, predictor_options, predictor_digest
+                FROM bayesdb_composer_column_foreign_predictor
+                WHERE generator_id = ?
+        ''', (genid,))
+        predictor_names = {}
+        predictor_options = {}
+        predictor_digests = {}
+        for colno, name, options, digest in cursor:
+            predictor_names[colno] = name
+            predictor_options[colno] = json.loads(options) if options else {}
+            predictor_digests[colno] = digest
+        colnames = {colno: core.bayesdb_generator_column_name(bdb, genid, colno)
+            for colno, _ in owners}
+        stattypes = {colno:
+            core.bayesdb_generator_column_stattype(bdb, genid, colno)
+            for colno, _ in owners}
+        cc_colnos = {colno: core.bayesdb_generator_column_number(bdb, cc_id,
+            colnames[colno]) for colno in lcols}
+        return {
+            'cc_id': cc_id,
+            'cc': core.bayesdb_generator_metamodel(bdb, cc_id),
+            'cc_colnos': cc_colnos,
+            'lcols': lcols,
+            'fcols': fcols,
+            'pcols': {f: frozenset(p) for f, p in pcols.iteritems()},
+            'lancestors': lancestors,
+            'topo': topo,
+            'predictor_names': predictor_names,
+            'predictor_options': predictor_options,
+            'predictor_digests': predictor_digests,
+            'colnames': colnames,
+            'stattypes': stattypes,
+        }
 
     def register_foreign_predictor(self, builder):
         """Register an object which builds a foreign predictor.
@@ -182,31 +444,115 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
                     builder.name(), self.predictor_builder)))
         self.predictor_builder[casefold(builder.name())] = builder
 
+    def shutdown(self):
+        """Terminate the worker processes of multi-model estimates, if any.
+
+        The pool is started again on the next parallel estimate.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            self._pool_pathname = None
+
+    def _process_pool(self, bdb):
+        # One pool per database file; workers hold their own handle.
+        if self._pool is not None and self._pool_pathname != bdb.pathname:
+            self.shutdown()
+        if self._pool is None:
+            config = {
+                'n_samples': self.n_samples,
+                'resampling': self.resampling,
+                'target_ess': self.target_ess,
+                'min_samples': self.min_samples,
+                'max_samples': self.max_samples,
+                'target_stderr': self.target_stderr,
+                'predictor_cache_bytes': self.predictor_cache_bytes,
+            }
+            builders = self.predictor_builder.values()
+            processes = self.processes or multiprocessing.cpu_count()
+            ready = multiprocessing.Value('i', 0)
+            failed = multiprocessing.Value('i', 0)
+            bdb.sql_execute('PRAGMA busy_timeout = %d' % (_BUSY_TIMEOUT,))
+            self._pool = multiprocessing.Pool(processes, _model_worker_init,
+                (bdb.pathname, config, builders, ready, failed))
+            self._pool_pathname = bdb.pathname
+            # Wait for every worker to open the database, lest their reads
+            # race the next write of the parent.
+            while ready.value < processes and not failed.value:
+                time.sleep(0.01)
+            if failed.value:
+                self.shutdown()
+                raise BLE(ValueError('Worker processes of composer failed '
+                    'to open %s.' % (bdb.pathname,)))
+        return self._pool
+
+    def _map_models(self, bdb, genid, modelnos, method, *args):
+        """Evaluate `method` on every model in `modelnos`.
+
+        Returns the list of per-model results, in the order of
+        `modelnos`, computed in the worker processes if enabled.
+        """
+        if self.processes is None or len(modelnos) < 2 or \
+                bdb.pathname == ':memory:':
+            return [getattr(self, method)(bdb, genid, modelno, *args)
+                for modelno in modelnos]
+        # Per-model seeds, so results do not depend on scheduling.
+        seeds = bdb.np_prng.randint(2**31 - 1, size=len(modelnos))
+        tasks = [(method, genid, modelno, int(seed), args)
+            for modelno, seed in zip(modelnos, seeds)]
+        return self._process_pool(bdb).map(_model_worker_call, tasks)
+
     def name(self):
         return 'composer'
 
     def register(self, bdb):
-        cursor = bdb.sql_execute('''
-            SELECT version FROM bayesdb_metamodel WHERE name = ?;
-        ''', (self.name(),))
-        version = None
-        try:
-            row = cursor.next()
-        except StopIteration:
-            version = 0
-        else:
-            version = row[0]
-        assert version is not None
-        if version == 0:
-            with bdb.savepoint():
+        with bdb.savepoint():
+            cursor = bdb.sql_execute('''
+                SELECT version FROM bayesdb_metamodel WHERE name = ?;
+            ''', (self.name(),))
+            version = None
+            try:
+                row = cursor.next()
+            except StopIteration:
+                version = 0
+            else:
+                version = row[0]
+            assert version is not None
+            if version == 0:
                 for stmt in composer_schema_1:
                     bdb.sql_execute(stmt)
-        return
+                version = 1
+            if version == 1:
+                for stmt in composer_schema_1to2:
+                    bdb.sql_execute(stmt)
+                version = 2
+            if version == 2:
+                for stmt in composer_schema_2to3:
+                    bdb.sql_execute(stmt)
+                cursor = bdb.sql_execute('''
+                    SELECT generator_id, colno, predictor_binary
+                        FROM bayesdb_composer_column_foreign_predictor
+                        WHERE predictor_binary IS NOT NULL
+                ''')
+                for genid, colno, binary in cursor.fetchall():
+                    bdb.sql_execute('''
+                        UPDATE bayesdb_composer_column_foreign_predictor
+                            SET predictor_digest = ?
+                            WHERE generator_id = ? AND colno = ?
+                    ''', (_digest(binary), genid, colno))
+                version = 3
+            if version != 3:
+                raise BLE(ValueError('Composer already installed with '
+                    'unknown schema version: {}.'.format(version)))
 
     def create_generator(self, bdb, table, schema, instantiate):
         # Parse the schema.
         (columns, lcols, _fcols, fcol_to_pcols, fcol_to_fpred,
-            dependencies) = self.parse(schema)
+            dependencies, fcol_to_options) = self.parse(schema)
+        for fcol in sorted(fcol_to_options):
+            self._check_predictor_options(bdb, fcol, fcol_to_fpred[fcol],
+                fcol_to_options[fcol])
         # Instantiate **this** generator.
         genid, bdbcolumns = instantiate(columns.items())
         # Create internal crosscat generator. The name will be the same as
@@ -262,23 +608,31 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
                     INSERT INTO bayesdb_composer_column_toposort
                         (generator_id, colno, position) VALUES (?,?,?)
                     ''', (genid, colno, position,))
-            # Save predictor names of foreign columns.
+            # Save predictor names and options of foreign columns.
             for fcolno in fcolno_to_pcolnos:
-                fp_name = fcol_to_fpred[casefold(
-                    core.bayesdb_generator_column_name(bdb,genid, fcolno))]
+                fcol = casefold(
+                    core.bayesdb_generator_column_name(bdb,genid, fcolno))
+                fp_name = fcol_to_fpred[fcol]
+                options = fcol_to_options[fcol]
                 bdb.sql_execute('''
                     INSERT INTO bayesdb_composer_column_foreign_predictor
-                        (generator_id, colno, predictor_name) VALUES (?,?,?)
-                ''', (genid, fcolno, casefold(fp_name)))
+                        (generator_id, colno, predictor_name,
+                            predictor_options)
+                        VALUES (?,?,?,?)
+                ''', (genid, fcolno, casefold(fp_name),
+                    json.dumps(options) if options else None))
+        # Discard any stale structure of a generator which had this id.
+        self._invalidate_schema(bdb, genid)
+        self.evict(bdb, genid)
 
     def drop_generator(self, bdb, genid):
         with bdb.savepoint():
-            # Clear caches.
-            keys = [k for k in self._predictor_cache(bdb) if k[0] == genid]
-            for k in keys:
-                del self._predictor_cache(bdb)[k]
             # Obtain before losing references.
             cc_name = core.bayesdb_generator_name(bdb, self.cc_id(bdb, genid))
+            # Clear caches.
+            self.evict(bdb, genid)
+            self._invalidate_schema(bdb, genid)
+            self._invalidate_models(bdb, genid)
             # Delete tables reverse order of insertion.
             bdb.sql_execute('''
                 DELETE FROM bayesdb_composer_column_foreign_predictor
@@ -314,34 +668,178 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         qg = quote(core.bayesdb_generator_name(bdb, self.cc_id(bdb, genid)))
         bql = 'INITIALIZE {} MODELS FOR {};'.format(max(modelnos)+1, qg)
         bdb.execute(bql)
+        self._invalidate_models(bdb, genid)
         # Initialize the foriegn predictors.
-        for fcol in self.fcols(bdb, genid):
+        fcols = sorted(self.fcols(bdb, genid))
+        if fcols:
+            self._store_predictors(bdb, genid,
+                self._train_predictors(bdb, genid, fcols))
+
+    def refresh_predictors(self, bdb, genid, rowids=None, fcols=None):
+        """Retrain the foreign predictors of a generator on new rows.
+
+        The crosscat models are left untouched.  Foreign predictors
+        whose factory implements `update` are updated with the new
+        rows only; the others are retrained on the whole table.
+
+        Parameters
+        ----------
+        bdb : bayeslite.BayesDB
+        genid : int
+            Generator id.
+        rowids : list<int>, optional
+            Rows of the base table added since the predictors were
+            trained.  If None, all predictors are retrained on the whole
+            table.
+        fcols : list<int>, optional
+            Foreign columns whose predictors to refresh.  Defaults to
+            all foreign columns.
+        """
+        with bdb.savepoint():
+            if fcols is None:
+                fcols = sorted(self.fcols(bdb, genid))
+            for fcol in fcols:
+                if fcol not in self.fcols(bdb, genid):
+                    raise BLE(ValueError('Column {} is not modeled by a '
+                        'foreign predictor.'.format(fcol)))
+            if rowids is not None and len(rowids) == 0:
+                return
+            binaries = {}
+            retrain = []
+            for fcol in fcols:
+                builder = self.predictor_builder[
+                    self.predictor_name(bdb, genid, fcol)]
+                if rowids is None or not hasattr(builder, 'update'):
+                    retrain.append(fcol)
+                    continue
+                targets, conditions = self._predictor_columns(bdb, genid, fcol)
+                df = self._table_rows_df(bdb, genid,
+                    [name for name, _stattype in targets + conditions], rowids)
+                try:
+                    predictor = builder.update(bdb,
+                        self.predictor(bdb, genid, fcol), df)
+                except NotImplementedError:
+                    retrain.append(fcol)
+                    continue
+                binaries[fcol] = builder.serialize(bdb, predictor)
+                if self.logger is not None:
+                    self.logger.info('Updated foreign predictor %s for %s '
+                        'with %d rows.', self.predictor_name(bdb, genid, fcol),
+                        self.colname(bdb, genid, fcol), len(df))
+            if retrain:
+                binaries.update(self._train_predictors(bdb, genid, retrain))
+            self._store_predictors(bdb, genid, binaries)
+            # Estimates given the old predictors are stale.
+            self._invalidate_models(bdb, genid)
+
+    def _predictor_columns(self, bdb, genid, fcol):
+        # Targets and conditions of the foreign predictor of fcol, as lists
+        # of (name, stattype) pairs.
+        targets = [(self.colname(bdb, genid, fcol),
+            self.stattype(bdb, genid, fcol))]
+        conditions = [(self.colname(bdb, genid, pcol),
+            self.stattype(bdb, genid, pcol))
+            for pcol in sorted(self.pcols(bdb, genid, fcol))]
+        return targets, conditions
+
+    def _train_predictors(self, bdb, genid, fcols):
+        # Trains the foreign predictors of fcols on the whole table, and
+        # returns a dict {fcol: predictor_binary}.
+        table_name = core.bayesdb_generator_table(bdb, genid)
+        specs = {}
+        for fcol in fcols:
             # Convert column numbers to names.
-            targets = \
-                [(core.bayesdb_generator_column_name(bdb, genid, fcol),
-                  core.bayesdb_generator_column_stattype(bdb, genid, fcol))]
-            conditions = \
-                [(core.bayesdb_generator_column_name(bdb, genid, pcol),
-                  core.bayesdb_generator_column_stattype(bdb, genid, pcol))
-                 for pcol in self.pcols(bdb, genid, fcol)]
-            # Initialize the foreign predictor.
-            table_name = core.bayesdb_generator_table(bdb, genid)
+            targets, conditions = self._predictor_columns(bdb, genid, fcol)
             predictor_name = self.predictor_name(bdb, genid, fcol)
             builder = self.predictor_builder[predictor_name]
-            predictor = builder.create(bdb, table_name, targets, conditions)
-            # Store in the database.
-            with bdb.savepoint():
-                sql = '''
-                    UPDATE bayesdb_composer_column_foreign_predictor SET
-                        predictor_binary = :predictor_binary
-                        WHERE generator_id = :genid AND colno = :colno
-                '''
-                predictor_binary = builder.serialize(bdb, predictor)
+            specs[fcol] = (builder, targets, conditions,
+                self.predictor_options(bdb, genid, fcol))
+        # Read the table once for all predictors which train from a frame.
+        frame_fcols = [fcol for fcol in fcols
+            if _trains_from_df(specs[fcol][0])]
+        columns = sorted(set(name for fcol in frame_fcols
+            for name, _stattype in specs[fcol][1] + specs[fcol][2]))
+        df = table_to_df(bdb, table_name, columns) if frame_fcols else None
+        binaries = {}
+        def trained(fcol, predictor_binary):
+            binaries[fcol] = predictor_binary
+            if self.logger is not None:
+                self.logger.info('Trained foreign predictor %s for %s (%d/%d).',
+                    self.predictor_name(bdb, genid, fcol),
+                    self.colname(bdb, genid, fcol), len(binaries), len(fcols))
+        # Train the others concurrently, each under its own seed.
+        tasks = [(fcol, specs[fcol][0],
+            df[[name for name, _stattype in specs[fcol][1] + specs[fcol][2]]],
+            specs[fcol][1], specs[fcol][2], specs[fcol][3], int(seed))
+            for fcol, seed in zip(frame_fcols,
+                bdb.np_prng.randint(2**31 - 1, size=len(frame_fcols)))]
+        declined = []
+        if self.processes is None or len(tasks) < 2:
+            for fcol, builder, df_fcol, targets, conditions, options, _seed \
+                    in tasks:
+                try:
+                    predictor = builder.create_from_df(df_fcol, targets,
+                        conditions, **options)
+                except NotImplementedError:
+                    declined.append(fcol)
+                    continue
+                trained(fcol, builder.serialize(bdb, predictor))
+        else:
+            pool = multiprocessing.Pool(min(self.processes, len(tasks)))
+            try:
+                for fcol, predictor_binary in \
+                        pool.imap_unordered(_train_worker_call, tasks):
+                    if predictor_binary is None:
+                        declined.append(fcol)
+                    else:
+                        trained(fcol, predictor_binary)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        # Train the foreign predictors which need the database in place.
+        for fcol in fcols:
+            if fcol not in frame_fcols or fcol in declined:
+                builder, targets, conditions, options = specs[fcol]
+                predictor = builder.create(bdb, table_name, targets,
+                    conditions, **options)
+                trained(fcol, builder.serialize(bdb, predictor))
+        return binaries
+
+    def _store_predictors(self, bdb, genid, binaries):
+        # Store in the database.
+        with bdb.savepoint():
+            sql = '''
+                UPDATE bayesdb_composer_column_foreign_predictor SET
+                    predictor_binary = :predictor_binary,
+                    predictor_digest = :predictor_digest
+                    WHERE generator_id = :genid AND colno = :colno
+            '''
+            for fcol in sorted(binaries):
                 bdb.sql_execute(sql, {
                     'genid': genid,
-                    'predictor_binary': sqlite3.Binary(predictor_binary),
+                    'predictor_binary': sqlite3.Binary(binaries[fcol]),
+                    'predictor_digest': _digest(binaries[fcol]),
                     'colno': fcol
                 })
+        # Stale predictors may have been deserialized before.
+        self._invalidate_schema(bdb, genid)
+        self.evict(bdb, genid)
+
+    def _table_rows_df(self, bdb, genid, column_names, rowids):
+        # The columns column_names of rows of the base table as a DataFrame,
+        # like table_to_df, read in chunks within the limit of SQL parameters.
+        qt = quote(core.bayesdb_generator_table(bdb, genid))
+        qcns = ','.join(map(quote, column_names))
+        rowids = sorted(set(rowids))
+        chunks = []
+        for i in xrange(0, len(rowids), 500):
+            chunk = rowids[i:i+500]
+            cursor = bdb.sql_execute('''
+                SELECT %s FROM %s WHERE _rowid_ IN (%s)
+            ''' % (qcns, qt, ','.join('?' * len(chunk))), chunk)
+            chunks.append(cursor_to_df(cursor))
+        return pd.concat(chunks, ignore_index=True)
 
     def drop_models(self, bdb, genid, modelnos=None):
         qg = quote(core.bayesdb_generator_name(bdb, self.cc_id(bdb, genid)))
@@ -351,6 +849,7 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         else:
             bql = 'DROP MODELS FROM {};'.format(qg)
         bdb.execute(bql)
+        self._invalidate_models(bdb, genid)
 
     def analyze_models(self, bdb, genid, modelnos=None, iterations=1,
                 max_seconds=None, ckpt_iterations=None, ckpt_seconds=None):
@@ -359,6 +858,7 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         self.cc(bdb, genid).analyze_models(bdb, self.cc_id(bdb, genid),
             modelnos=modelnos, iterations=iterations, max_seconds=max_seconds,
             ckpt_iterations=ckpt_iterations, ckpt_seconds=ckpt_seconds)
+        self._invalidate_models(bdb, genid)
         # Accounting.
         sql = '''
             UPDATE bayesdb_generator_model
@@ -382,9 +882,9 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         else:
             modelnos = [modelno]
         with bdb.savepoint():
-            p = sum(self._column_dependence_probability(
-                     bdb, genid, m, colno0, colno1)
-                    for m in modelnos) / float(len(modelnos))
+            p = sum(self._map_models(bdb, genid, modelnos,
+                    '_column_dependence_probability', colno0, colno1)) \
+                / float(len(modelnos))
         return p
 
     def _column_dependence_probability(self, bdb, genid, modelno, colno0,
@@ -397,16 +897,14 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         # Trivial case.
         if colno0 == colno1:
             return 1
-        fcols = set(self.fcols(bdb, genid))
+        fcols = self.fcols(bdb, genid)
         c0_foreign = colno0 in fcols
         c1_foreign = colno1 in fcols
         # Neither col is foreign, delegate to CrossCat.
         # XXX Fails for future implementation of conditional dependence.
         if not (c0_foreign or c1_foreign):
-            return self.cc(bdb, genid).column_dependence_probability(bdb,
-                self.cc_id(bdb, genid), modelno,
-                self.cc_colno(bdb, genid, colno0),
-                self.cc_colno(bdb, genid, colno1))
+            return self._cc_dependence_probability(bdb, genid, modelno,
+                colno0, colno1)
         # (colno0, colno1) form a (target, conditions) pair.
         # WE explicitly modeled them as dependent by assumption.
         # TODO: Strong assumption? What if FP determines it is not
@@ -414,25 +912,105 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         if colno0 in self.pcols(bdb, genid, colno1) or \
                 colno1 in self.pcols(bdb, genid, colno0):
             return 1
-        # (colno0, colno1) form a (local, foreign) pair.
         # IF [col0 FP target], [col1 CC], and [all conditions of col0 IND col1]
         #   then [col0 IND col1].
         # XXX Reverse is not true generally (counterxample), but we shall
         # assume an IFF condition. This assumption is not unlike the transitive
         # closure property of independence in crosscat.
-        if (c0_foreign and not c1_foreign) or \
-                (c1_foreign and not c0_foreign):
-            fcol = colno0 if c0_foreign else colno1
-            lcol = colno1 if c0_foreign else colno0
-            return any(self._column_dependence_probability(bdb, genid, modelno,
-                pcol, lcol) for pcol in self.pcols(bdb, genid, fcol))
-        # XXX TODO: Determine independence semantics for this case.
-        # Both columns are foreign. (Recursively) return 1 if any of their
-        # conditions (possibly FPs) have dependencies.
-        assert c0_foreign and c1_foreign
-        return any(self._column_dependence_probability(bdb, genid, modelno,
-                pcol0, pcol1) for pcol0 in self.pcols(bdb, genid, colno0)
-                for pcol1 in self.pcols(bdb, genid, colno1))
+        # XXX TODO: Determine independence semantics for two foreign columns.
+        # Applying the rule through the predictor DAG, a foreign column
+        # depends on whatever any of its local ancestors depends on, so
+        # the columns are dependent iff some pair of their local ancestors
+        # is dependent in crosscat.
+        return any(self._cc_dependence_probability(bdb, genid, modelno,
+                lcol0, lcol1)
+            for lcol0 in self.lancestors(bdb, genid, colno0)
+            for lcol1 in self.lancestors(bdb, genid, colno1))
+
+    def _cc_dependence_probability(self, bdb, genid, modelno, lcol0, lcol1):
+        # Crosscat dependence of two local columns, memoized per model.
+        if lcol0 == lcol1:
+            return 1
+        def dependence():
+            with self._timed('cc_dependence', genid):
+                return self.cc(bdb, genid).column_dependence_probability(bdb,
+                    self.cc_id(bdb, genid), modelno,
+                    self.cc_colno(bdb, genid, lcol0),
+                    self.cc_colno(bdb, genid, lcol1))
+        if bdb.cache is None:
+            return dependence()
+        key = (genid, modelno, min(lcol0, lcol1), max(lcol0, lcol1))
+        dependence_cache = self._dependence_cache(bdb)
+        if key not in dependence_cache:
+            dependence_cache[key] = dependence()
+        return dependence_cache[key]
+
+    def column_dependence_probability_matrix(self, bdb, genid, modelno,
+            colnos=None):
+        """Compute the pairwise dependence probabilities of columns.
+
+        Equivalent to calling `column_dependence_probability` on every
+        pair of `colnos`, but each crosscat dependence probability of
+        the local columns is computed once per model and the dependence
+        of foreign columns is read off their local ancestors.
+
+        Parameters
+        ----------
+        bdb : bayeslite.BayesDB
+        genid : int
+            Generator id.
+        modelno : int or None
+            Model number, or None to average over all models.
+        colnos : list<int>, optional
+            Columns of the matrix.  Defaults to all columns of the
+            generator, in order of column number.
+
+        Returns
+        -------
+        dependence : np.ndarray
+            Symmetric matrix whose (i, j) entry is the dependence
+            probability of `colnos[i]` and `colnos[j]`.
+        """
+        if colnos is None:
+            colnos = core.bayesdb_generator_column_numbers(bdb, genid)
+        if modelno is None:
+            modelnos = core.bayesdb_generator_modelnos(bdb, genid)
+        else:
+            modelnos = [modelno]
+        with bdb.savepoint():
+            return sum(self._map_models(bdb, genid, modelnos,
+                    '_column_dependence_matrix', list(colnos))) \
+                / float(len(modelnos))
+
+    def _column_dependence_matrix(self, bdb, genid, modelno, colnos):
+        # Crosscat dependence of the local ancestors of the columns.
+        ancestors = [self.lancestors(bdb, genid, c) for c in colnos]
+        lcols = sorted(frozenset().union(*ancestors))
+        index = {lcol: i for i, lcol in enumerate(lcols)}
+        cc_dependence = np.zeros((len(lcols), len(lcols)))
+        for i, lcol0 in enumerate(lcols):
+            for j in xrange(i, len(lcols)):
+                cc_dependence[i,j] = cc_dependence[j,i] = \
+                    self._cc_dependence_probability(bdb, genid, modelno,
+                        lcol0, lcols[j])
+        # Local columns keep their crosscat probability; a pair with a
+        # foreign column is dependent iff some pair of ancestors is.
+        incidence = np.zeros((len(colnos), len(lcols)))
+        for i, lcols_i in enumerate(ancestors):
+            incidence[i, [index[lcol] for lcol in lcols_i]] = 1
+        dependence = incidence.dot(cc_dependence > 0).dot(incidence.T) > 0
+        dependence = dependence.astype(float)
+        fcols = self.fcols(bdb, genid)
+        for i, colno0 in enumerate(colnos):
+            for j, colno1 in enumerate(colnos):
+                if colno0 not in fcols and colno1 not in fcols:
+                    dependence[i,j] = \
+                        cc_dependence[index[colno0], index[colno1]]
+                elif colno0 in self.pcols(bdb, genid, colno1) or \
+                        colno1 in self.pcols(bdb, genid, colno0):
+                    dependence[i,j] = 1
+        np.fill_diagonal(dependence, 1)
+        return dependence
 
     def column_mutual_information(self, bdb, genid, modelno, colno0, colno1,
             numsamples=None):
@@ -448,9 +1026,10 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         else:
             modelnos = [modelno]
         with bdb.savepoint():
-            mi = sum(self.conditional_mutual_information(
-                      bdb, genid, modelno, X, W, Z, Y)
-                     for modelno in modelnos) / float(len(modelnos))
+            mi = sum(self._map_models(bdb, genid, modelnos,
+                     'conditional_mutual_information', X, W, Z, Y,
+                     numsamples)) \
+                / float(len(modelnos))
         return mi
 
     def conditional_mutual_information(self, bdb, genid, modelno, X, W, Z, Y,
@@ -459,8 +1038,53 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             return self._conditional_mutual_information(
                 bdb, genid, modelno, X, W, Z, Y, numsamples=numsamples)
 
+    def conditional_mutual_information_stderr(self, bdb, genid, modelno,
+            X, W, Z, Y, numsamples=None, target_stderr=None):
+        """Estimate conditional mutual information with its standard error.
+
+        Estimates I(X:W|Z,Y=y) for a single model by Monte Carlo over
+        samples of (X,W,Z) given Y=y.  The density terms of each sample
+        are estimated under common random numbers.
+
+        Parameters
+        ----------
+        bdb : bayeslite.BayesDB
+        genid : int
+            Generator id.
+        modelno : int
+            Model number.
+        X, W, Z : list<tuple>
+            Disjoint lists of cells [(rowid, colno), ...].
+        Y : list<tuple>
+            Evidence [(rowid, colno, value), ...].
+        numsamples : int, optional
+            Number of Monte Carlo samples, drawn in one batch.  Defaults
+            to `n_samples`.
+        target_stderr : float, optional
+            If given, batches of `numsamples` samples are drawn until
+            the standard error of the estimate falls to `target_stderr`,
+            or the number of samples reaches `max_samples`.  Defaults to
+            the `target_stderr` of the composer.
+
+        Returns
+        -------
+        (estimate, stderr) : tuple<float, float>
+            The estimate of the mutual information, and the standard
+            error of the Monte Carlo mean.
+        """
+        with bdb.savepoint():
+            return self._conditional_mutual_information_stderr(bdb, genid,
+                modelno, X, W, Z, Y, numsamples=numsamples,
+                target_stderr=target_stderr)
+
     def _conditional_mutual_information(self, bdb, genid, modelno, X, W, Z, Y,
             numsamples=None):
+        mi, _stderr = self._conditional_mutual_information_stderr(bdb, genid,
+            modelno, X, W, Z, Y, numsamples=numsamples)
+        return mi
+
+    def _conditional_mutual_information_stderr(self, bdb, genid, modelno,
+            X, W, Z, Y, numsamples=None, target_stderr=None):
         # WARNING: SUPER EXPERIMENTAL.
         # Computes the conditional mutual information I(X:W|Z,Y=y), defined
         # defined as the expectation E_z~Z{X:W|Z=z,Y=y}.
@@ -468,34 +1092,63 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         # Y is an evidence list [(rowid,colno,val), ..].
         if numsamples is None:
             numsamples = self.n_samples
+        if target_stderr is None:
+            target_stderr = self.target_stderr
         # All sets must be disjoint.
         all_cols = X + W + Z + [(r,c) for r,c,_ in Y]
         if len(all_cols) != len(set(all_cols)):
             raise BLE(ValueError('Duplicate cells received in '
                 'conditional_mutual_information.\n'
                 'X: {}\nW: {}\nZ: {}\nY: {}'.format(X, W, Z, Y)))
-        # Simulate from joint.
-        XWZ_samples = self.simulate(bdb, genid, modelno, X+W+Z,
-            Y, numpredictions=numsamples)
-        # Simple Monte Carlo
-        mi = logpz = logpxwz = logpxz = logpwz = 0
-        for s in XWZ_samples:
-            Qx = [(r,c,v) for ((r,c),v) in zip(X, s[:len(X)])]
-            Qw = [(r,c,v) for ((r,c),v) in zip(W, s[len(X):len(X)+len(W)])]
-            Qz = [(r,c,v) for ((r,c),v) in zip(Z, s[len(X)+len(W):])]
-            if Z:
-                logpz = self._joint_logpdf(bdb, genid, modelno, Qz, Y)
-            else:
-                logpz = 0
-            logpxwz = self._joint_logpdf(bdb, genid, modelno, Qx+Qw+Qz, Y)
-            logpxz = self._joint_logpdf(bdb, genid, modelno, Qx+Qz, Y)
-            logpwz = self._joint_logpdf(bdb, genid, modelno, Qw+Qz, Y)
-            mi += logpz + logpxwz - logpxz - logpwz
+        if target_stderr is None:
+            max_samples = numsamples
+        else:
+            max_samples = max(numsamples, self.max_samples)
+        # Estimate the marginal densities of the evidence once, before the
+        # random streams of the terms are shared.
+        for r in set(r for r,_ in X+W+Z):
+            self._evidence_logpdf(bdb, genid, modelno, r,
+                [(rr,c,v) for rr,c,v in Y if rr == r])
+        terms = []
+        while True:
+            # Simulate from joint; resampling from shared pools stratifies
+            # the draws of a batch.
+            XWZ_samples = self.simulate(bdb, genid, modelno, X+W+Z,
+                Y, numpredictions=min(numsamples, max_samples - len(terms)))
+            for s in XWZ_samples:
+                Qx = [(r,c,v) for ((r,c),v) in zip(X, s[:len(X)])]
+                Qw = [(r,c,v) for ((r,c),v) in
+                    zip(W, s[len(X):len(X)+len(W)])]
+                Qz = [(r,c,v) for ((r,c),v) in zip(Z, s[len(X)+len(W):])]
+                terms.append(self._mutual_information_term(bdb, genid,
+                    modelno, Qx, Qw, Qz, Y))
+            stderr = _standard_error(terms)
+            if target_stderr is None or stderr <= target_stderr or \
+                    max_samples <= len(terms):
+                break
         # TODO: linfoot?
-        # TODO: If negative, report to user that reliable answer cannot be
-        # returned with current `numsamples`.
         # Averaging is in direct space is correct.
-        return mi/numsamples
+        return np.mean(terms), stderr
+
+    def _mutual_information_term(self, bdb, genid, modelno, Qx, Qw, Qz, Y):
+        # log p(z) + log p(x,w,z) - log p(x,z) - log p(w,z) given Y for one
+        # sample (x,w,z). Common random numbers: every density is estimated
+        # from the same state of the random streams, so that their errors
+        # are correlated and largely cancel in the difference.
+        np_state = bdb.np_prng.get_state()
+        py_state = bdb.py_prng.getstate()
+        def logpdf(Q):
+            bdb.np_prng.set_state(np_state)
+            bdb.py_prng.setstate(py_state)
+            return self._joint_logpdf(bdb, genid, modelno, Q, Y)
+        if Qz:
+            logpz = logpdf(Qz)
+        else:
+            logpz = 0
+        logpxwz = logpdf(Qx+Qw+Qz)
+        logpxz = logpdf(Qx+Qz)
+        logpwz = logpdf(Qw+Qz)
+        return logpz + logpxwz - logpxz - logpwz
 
     def logpdf_joint(self, bdb, generator_id, targets, constraints, modelno):
         if modelno is None:
@@ -503,16 +1156,13 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         else:
             modelnos = [modelno]
         with bdb.savepoint():
-            return logmeanexp([self._joint_logpdf(bdb, generator_id, modelno,
-                targets, constraints) for modelno in modelnos])
+            return logmeanexp(self._map_models(bdb, generator_id, modelnos,
+                '_joint_logpdf', targets, constraints))
 
     def _joint_logpdf(self, bdb, genid, modelno, Q, Y, n_samples=None):
         # XXX Computes the joint probability of query Q given evidence Y
         # for a single model. The function is a likelihood weighted
         # integrator.
-        # XXX Determine.
-        if n_samples is None:
-            n_samples = self.n_samples
         # Validate inputs.
         if modelno is None:
             raise BLE(ValueError('Invalid modelno None, integer requried.'))
@@ -522,20 +1172,42 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         Q = self._queries_consistent_with_constraints(Q, Y)
         if Q is None:
             return float('-inf')
-        for r, _, _ in Q+Y:
-            assert r == Q[0][0], "Cannot assess more than one row, "\
-                "%s and %s requested" % (Q[0][0], r)
+        # Rows are independent given the model: the density of many rows
+        # is the product of the densities of each row given its own evidence.
+        if any(r != Q[0][0] for r, _, _ in Q):
+            rows = sorted(set(r for r, _, _ in Q))
+            return sum(self._joint_logpdf(bdb, genid, modelno,
+                    [(rr, c, v) for rr, c, v in Q if rr == r],
+                    [(rr, c, v) for rr, c, v in Y if rr == r],
+                    n_samples=n_samples)
+                for r in rows)
+        Y = [(r, c, v) for r, c, v in Y if r == Q[0][0]]
         # (Q,Y) marginal joint density.
         _, QY_weights = self._weighted_sample(bdb, genid, modelno,
             Q[0][0], Q+Y, n_samples=n_samples)
         # Y marginal density.
-        _, Y_weights = self._weighted_sample(bdb, genid, modelno,
-            Q[0][0], Y, n_samples=n_samples)
+        logpY = self._evidence_logpdf(bdb, genid, modelno, Q[0][0], Y,
+            n_samples=n_samples)
         # XXX TODO Keep sampling until logpQY <= logpY
         logpQY = logmeanexp(QY_weights)
-        logpY = logmeanexp(Y_weights)
         return logpQY - logpY
 
+    def _evidence_logpdf(self, bdb, genid, modelno, row_id, Y, n_samples=None):
+        # Estimates the marginal log density of the evidence Y. Queries
+        # sharing the same evidence (notably the terms of conditional mutual
+        # information) reuse one estimate per transaction.
+        if not Y:
+            return 0
+        key = (genid, modelno, row_id, frozenset(Y), n_samples)
+        if bdb.cache is not None and key in self._evidence_cache(bdb):
+            return self._evidence_cache(bdb)[key]
+        _, Y_weights = self._weighted_sample(bdb, genid, modelno, row_id, Y,
+            n_samples=n_samples)
+        logpY = logmeanexp(Y_weights)
+        if bdb.cache is not None:
+            self._evidence_cache(bdb)[key] = logpY
+        return logpY
+
     def _queries_consistent_with_constraints(self, Q, Y):
         queries = dict()
         for (row, col, val) in Q:
@@ -569,7 +1241,6 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         if numsamples is None:
             numsamples = self.n_samples
         colnos = core.bayesdb_generator_column_numbers(bdb, genid)
-        colnames = core.bayesdb_generator_column_names(bdb, genid)
         row = core.bayesdb_generator_row_values(bdb, genid, rowid)
         # Account for multiple imputations if imputing parents.
         parent_conf = 1
@@ -582,9 +1253,10 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             if len(children) == 0 or \
                     all(row[i] is None for i in xrange(len(row)) if i+1
                         in children):
-                return self.cc(bdb, genid).predict_confidence(bdb,
-                        self.cc_id(bdb, genid), modelno,
-                        self.cc_colno(bdb, genid, colno), rowid)
+                with self._timed('cc_predict', genid):
+                    return self.cc(bdb, genid).predict_confidence(bdb,
+                            self.cc_id(bdb, genid), modelno,
+                            self.cc_colno(bdb, genid, colno), rowid)
             else:
                 # Obtain likelihood weighted samples from posterior.
                 Q = [(rowid, colno)]
@@ -595,14 +1267,13 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
                 samples = [s[0] for s in samples]
         # Predicting fcol.
         else:
-            conditions = {c:v for c,v in zip(colnames, row) if
-                core.bayesdb_generator_column_number(bdb, genid, c) in
-                self.pcols(bdb, genid, colno)}
-            for colname, val in conditions.iteritems():
+            pcols = self.pcols(bdb, genid, colno)
+            conditions = {self.colname(bdb, genid, c):v
+                for c,v in zip(colnos, row) if c in pcols}
+            for imp_col in pcols:
+                colname = self.colname(bdb, genid, imp_col)
                 # Impute all missing parents.
-                if val is None:
-                    imp_col = core.bayesdb_generator_column_number(bdb, genid,
-                        colname)
+                if conditions[colname] is None:
                     imp_val, imp_conf = self.predict_confidence(bdb, genid,
                         modelno, imp_col, rowid, numsamples=numsamples)
                     # XXX If imputing several parents, take the overall
@@ -617,15 +1288,20 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             samples = predictor.simulate(numsamples, conditions)
         # Since foreign predictor does not know how to impute, imputation
         # shall occur here in the composer by simulate/logpdf calls.
-        stattype = core.bayesdb_generator_column_stattype(bdb, genid, colno)
+        imp_val, imp_conf = self._impute_samples(bdb, genid, colno, samples)
+        if colno in self.fcols(bdb, genid) and \
+                self.stattype(bdb, genid, colno) == 'categorical':
+            imp_conf = np.exp(predictor.logpdf(imp_val, conditions))
+        return imp_val, imp_conf * parent_conf
+
+    def _impute_samples(self, bdb, genid, colno, samples):
+        # Imputed value and confidence of the cell of column colno from
+        # samples of its value.
+        stattype = self.stattype(bdb, genid, colno)
         if stattype == 'categorical':
             # imp_conf is most frequent.
-            imp_val =  max(((val, samples.count(val)) for val in set(samples)),
-                key=lambda v: v[1])[0]
-            if colno in self.fcols(bdb, genid):
-                imp_conf = np.exp(predictor.logpdf(imp_val, conditions))
-            else:
-                imp_conf = sum(np.array(samples)==imp_val) / len(samples)
+            modes, frequencies = _modes(_column(samples).reshape(1, -1))
+            imp_val, imp_conf = _value(modes[0]), frequencies[0]
         elif stattype == 'numerical':
             # XXX The definition of confidence is P[k=1] where
             # k=1 is the number of mixture componets (we need a distribution
@@ -639,7 +1315,161 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             raise BLE(ValueError(
                 'Unknown stattype "{}" for a foreign predictor '
                 'column encountered in predict_confidence.'.format(stattype)))
-        return imp_val, imp_conf * parent_conf
+        return imp_val, imp_conf
+
+    def impute_column(self, bdb, genid, modelno, colno, rowids,
+            numsamples=None):
+        """Impute the cells of a column in many rows at once.
+
+        Equivalent to `predict_confidence` on every row of `rowids`,
+        but the rows are read in bulk, and rows whose imputation needs
+        importance sampling are sampled together, one vectorized sampler
+        per set of observed columns.
+
+        Parameters
+        ----------
+        bdb : bayeslite.BayesDB
+        genid : int
+            Generator id.
+        modelno : int or None
+            Model number, or None as for `predict_confidence`.
+        colno : int
+            Column to impute.
+        rowids : list<int>
+            Rows of the base table to impute.
+        numsamples : int, optional
+            Number of samples per row.  Defaults to `n_samples`.
+
+        Returns
+        -------
+        imputations : list<tuple>
+            A (value, confidence) pair for each row of `rowids`.
+        """
+        if numsamples is None:
+            numsamples = self.n_samples
+        with bdb.savepoint():
+            colnos = core.bayesdb_generator_column_numbers(bdb, genid)
+            rows = self._row_values(bdb, genid, rowids)
+            imputations = {}
+            if colno in self.lcols(bdb, genid):
+                # Delegate to CC the rows in which no child is observed.
+                children = [f for f in self.fcols(bdb, genid)
+                    if colno in self.pcols(bdb, genid, f)]
+                queries = {}
+                evidence = {}
+                for rowid in set(rowids):
+                    row = dict(zip(colnos, rows[rowid]))
+                    if all(row[f] is None for f in children):
+                        with self._timed('cc_predict', genid):
+                            imputations[rowid] = self.cc(bdb, genid)\
+                                .predict_confidence(bdb,
+                                    self.cc_id(bdb, genid), modelno,
+                                    self.cc_colno(bdb, genid, colno), rowid)
+                    else:
+                        queries[rowid] = [colno]
+                        evidence[rowid] = [(rowid, c, v)
+                            for c, v in sorted(row.iteritems())
+                            if c != colno and v is not None]
+                # Obtain likelihood weighted samples from posterior.
+                simulated = self._simulate_rows(bdb, genid, modelno, queries,
+                    evidence, numsamples)
+                for rowid, samples in simulated.iteritems():
+                    imputations[rowid] = self._impute_samples(bdb, genid,
+                        colno, [s[0] for s in samples])
+            else:
+                # Rows in which all parents are observed need no sampling
+                # of the parents: evaluate the predictor on all at once.
+                pcols = sorted(self.pcols(bdb, genid, colno))
+                index = {c: i for i, c in enumerate(colnos)}
+                observed = [rowid for rowid in sorted(set(rowids))
+                    if all(rows[rowid][index[c]] is not None for c in pcols)]
+                if observed:
+                    conditions = pd.DataFrame({
+                        self.colname(bdb, genid, c):
+                            _column([rows[rowid][index[c]]
+                                for rowid in observed])
+                        for c in pcols}, index=np.arange(len(observed)))
+                    imputations.update(zip(observed, self._impute_foreign(
+                        bdb, genid, colno, conditions, numsamples)))
+                # Impute the missing parents of the others row by row.
+                for rowid in set(rowids) - set(observed):
+                    imputations[rowid] = self._predict_confidence(bdb, genid,
+                        modelno, colno, rowid, numsamples=numsamples)
+            return [imputations[rowid] for rowid in rowids]
+
+    def _impute_foreign(self, bdb, genid, fcol, conditions, numsamples):
+        # Imputed values and confidences of the foreign column fcol in rows
+        # whose parents are given by the frame conditions.  The predictive
+        # distribution of each row is evaluated once if the predictor
+        # exposes it; otherwise numsamples samples of each row are
+        # simulated in one batched call.
+        predictor = self.predictor(bdb, genid, fcol)
+        n_rows = len(conditions)
+        stattype = self.stattype(bdb, genid, fcol)
+        if stattype not in ['categorical', 'numerical']:
+            raise BLE(ValueError(
+                'Unknown stattype "{}" for a foreign predictor '
+                'column encountered in predict_confidence.'.format(stattype)))
+        with self._timed('fp_logpdf', genid, fcol, n_rows):
+            distribution = predictive_distribution_many(predictor,
+                conditions)
+        if distribution is not None:
+            if stattype == 'categorical':
+                # The mode and its predictive probability.
+                probabilities, classes = distribution
+                modes = np.argmax(probabilities, axis=1)
+                imp_vals = classes[modes]
+                imp_confs = probabilities[np.arange(n_rows), modes]
+            else:
+                # The mean of the Gaussian, with the confidence estimated
+                # from samples of it as for a predictor which only
+                # simulates.
+                imp_vals, scales = distribution
+                samples = np.asarray(imp_vals, dtype=float)[:,np.newaxis] \
+                    + np.asarray(scales, dtype=float)[:,np.newaxis] \
+                    * bdb.np_prng.normal(size=(n_rows, numsamples))
+                imp_confs = [su.continuous_imputation_confidence(list(s),
+                    None, None, n_steps=1000) for s in samples]
+            return [(_value(v), c) for v, c in zip(imp_vals, imp_confs)]
+        repeated = conditions.iloc[np.repeat(np.arange(n_rows), numsamples)]
+        repeated.index = np.arange(n_rows * numsamples)
+        with self._timed('fp_simulate', genid, fcol, len(repeated)):
+            samples = _column(simulate_many(predictor, repeated))\
+                .reshape(n_rows, numsamples)
+        if stattype == 'categorical':
+            imp_vals, _frequencies = _modes(samples)
+            with self._timed('fp_logpdf', genid, fcol, n_rows):
+                imp_confs = np.exp(logpdf_many(predictor, imp_vals,
+                    conditions))
+        else:
+            imp_vals = np.mean(samples.astype(float), axis=1)
+            imp_confs = [su.continuous_imputation_confidence(list(s), None,
+                None, n_steps=1000) for s in samples]
+        return [(_value(v), c) for v, c in zip(imp_vals, imp_confs)]
+
+    def _row_values(self, bdb, genid, rowids):
+        # Values of the generator columns in rows of the base table, as a
+        # dict {rowid: row} like bayesdb_generator_row_values, read in
+        # chunks within the limit of SQL parameters.
+        table_name = core.bayesdb_generator_table(bdb, genid)
+        column_names = core.bayesdb_generator_column_names(bdb, genid)
+        qt = quote(table_name)
+        qcns = ','.join(map(quote, column_names))
+        rowids = sorted(set(rowids))
+        rows = {}
+        with self._timed('rows', genid, samples=len(rowids)):
+            for i in xrange(0, len(rowids), 500):
+                chunk = rowids[i:i+500]
+                cursor = bdb.sql_execute('''
+                    SELECT _rowid_, %s FROM %s WHERE _rowid_ IN (%s)
+                ''' % (qcns, qt, ','.join('?' * len(chunk))), chunk)
+                for row in cursor:
+                    rows[row[0]] = row[1:]
+        missing = [rowid for rowid in rowids if rowid not in rows]
+        if missing:
+            raise BLE(ValueError('No such rows in table {} for generator '
+                '{}: {}.'.format(repr(table_name), genid, missing)))
+        return rows
 
     def simulate_joint(self, bdb, generator_id, targets, constraints, modelno,
             num_predictions=1):
@@ -656,23 +1486,107 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             Y_cc = [(r, self.cc_colno(bdb, genid, c), v)
                 for r, c, v in constraints]
             Q_cc = [(r, self.cc_colno(bdb, genid, c)) for r,c in targets]
-            return self.cc(bdb, genid).simulate_joint(bdb,
-                self.cc_id(bdb, genid), Q_cc, Y_cc, modelno,
-                num_predictions=numpredictions)
+            with self._timed('cc_simulate', genid, samples=numpredictions):
+                return self.cc(bdb, genid).simulate_joint(bdb,
+                    self.cc_id(bdb, genid), Q_cc, Y_cc, modelno,
+                    num_predictions=numpredictions)
+        # Rows are simulated separately, each given its own constraints.
+        if any(r != targets[0][0] for r,_ in targets):
+            rows = sorted(set(r for r,_ in targets))
+            queries = {r: [c for rr,c in targets if rr == r] for r in rows}
+            evidence = {r: [(rr,c,v) for rr,c,v in constraints if rr == r]
+                for r in rows}
+            simulated = self._simulate_rows(bdb, genid, modelno, queries,
+                evidence, numpredictions)
+            position = {(r,c): i for r in rows
+                for i, c in enumerate(queries[r])}
+            return [[simulated[r][k][position[(r,c)]] for r,c in targets]
+                for k in xrange(numpredictions)]
         # Solve inference problem by sampling-importance resampling.
-        result = []
-        for r,_ in targets:
-            assert r == targets[0][0], "Cannot simulate more than one row, "\
-                "%s and %s requested" % (targets[0][0], r)
-        for _ in xrange(numpredictions):
+        if self.resampling == 'independent':
+            result = []
+            for _ in xrange(numpredictions):
+                samples, weights = self._weighted_sample(bdb, genid, modelno,
+                    targets[0][0], constraints)
+                p = np.exp(weights - np.max(weights))
+                p /= np.sum(p)
+                draw = np.nonzero(bdb.np_prng.multinomial(1,p))[0][0]
+                s = [_value(samples[col][draw]) for col in colnos]
+                result.append(s)
+            return result
+        # Draw weighted pools until their effective sample size covers the
+        # requested predictions, but never more pools than predictions, the
+        # cost of independent resampling.
+        pools = []
+        ess = 0
+        while ess < numpredictions and len(pools) < numpredictions:
             samples, weights = self._weighted_sample(bdb, genid, modelno,
                 targets[0][0], constraints)
-            p = np.exp(np.asarray(weights) - np.max(weights))
+            pools.append((samples, weights))
+            ess += _effective_sample_size(weights)
+        samples = {col: np.concatenate([pool[col] for pool, _ in pools])
+            for col in colnos}
+        weights = np.concatenate([w for _, w in pools])
+        p = np.exp(weights - np.max(weights))
+        p /= np.sum(p)
+        draws = _resample(bdb.np_prng, p, numpredictions,
+            stratified=(self.resampling == 'stratified'))
+        return [[_value(samples[col][draw]) for col in colnos]
+            for draw in draws]
+
+    def _simulate_rows(self, bdb, genid, modelno, queries, evidence,
+            numpredictions):
+        # Simulates the columns queries[r] of many rows r, each given only
+        # its own constraints evidence[r], as rows are independent given the
+        # model. Returns a dict {r: predictions} as simulate would for each
+        # row. Rows constrained in the same columns share one vectorized
+        # importance sampler.
+        simulated = {}
+        fcols = self.fcols(bdb, genid)
+        groups = {}
+        for r in sorted(queries):
+            Q = [(r, c) for c in queries[r]]
+            Y = evidence[r]
+            if self.resampling == 'independent' or \
+                    (all(c not in fcols for c in queries[r]) and
+                        all(c not in fcols for _,c,_ in Y)):
+                simulated[r] = self.simulate(bdb, genid, modelno, Q, Y,
+                    numpredictions=numpredictions)
+            else:
+                groups.setdefault(frozenset(c for _,c,_ in Y), []).append(r)
+        for _, rows in sorted(groups.iteritems()):
+            simulated.update(self._simulate_group(bdb, genid, modelno,
+                rows, queries, evidence, numpredictions))
+        return simulated
+
+    def _simulate_group(self, bdb, genid, modelno, rows, queries, evidence,
+            numpredictions):
+        # Sampling-importance resampling for rows constrained in the same
+        # columns, drawing weighted pools for all rows at once, as many as
+        # the row with the smallest effective sample size needs, each as
+        # adaptive as the pools of a single row.
+        Ys = [evidence[r] for r in rows]
+        pools = []
+        ess = np.zeros(len(rows))
+        while np.any(ess < numpredictions) and len(pools) < numpredictions:
+            # The crosscat density of the evidence of a row is the same in
+            # all of its samples, so resampling needs no crosscat weights.
+            samples, weights = self._adaptive_sample_rows(bdb, genid,
+                modelno, rows, Ys, cc_weights=False)
+            pools.append((samples, weights))
+            ess += [_effective_sample_size(w) for w in weights]
+        simulated = {}
+        for i, r in enumerate(rows):
+            samples = {col: np.concatenate([pool[col][i] for pool, _ in pools])
+                for col in queries[r]}
+            weights = np.concatenate([w[i] for _, w in pools])
+            p = np.exp(weights - np.max(weights))
             p /= np.sum(p)
-            draw = np.nonzero(bdb.np_prng.multinomial(1,p))[0][0]
-            s = [samples[draw].get(col) for col in colnos]
-            result.append(s)
-        return result
+            draws = _resample(bdb.np_prng, p, numpredictions,
+                stratified=(self.resampling == 'stratified'))
+            simulated[r] = [[_value(samples[col][draw]) for col in queries[r]]
+                for draw in draws]
+        return simulated
 
     def row_similarity(self, bdb, genid, modelno, rowid, target_rowid,
             colnos):
@@ -681,125 +1595,304 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         return self.cc(bdb, genid).row_similarity(bdb, self.cc_id(bdb, genid),
             modelno, rowid, target_rowid, cc_colnos)
 
-    def _weighted_sample(self, bdb, genid, modelno, row_id, Y, n_samples=None):
-        # Returns a pairs of parallel lists ([sample ...], [weight ...])
-        # Each `sample` is a dict {col:v} of values for all nodes in
-        # the network for one row. Y specifies evidence nodes as (row,
-        # col, value) triples: all returned samples have constrained
-        # values at the evidence nodes.
-        # `weight` is the likelihood of the evidence Y under s\Y.
+    def _weighted_sample(self, bdb, genid, modelno, row_id, Y, n_samples=None,
+            target_ess=None, min_samples=None, max_samples=None):
+        # Returns a pair (samples, weights) of likelihood weighted samples,
+        # as _weighted_sample_batch. With a fixed `n_samples`, or when the
+        # composer is not adaptive, draws a single batch. Otherwise keeps
+        # drawing batches until the effective sample size of the weights
+        # reaches `target_ess`, subject to the `min_samples` and
+        # `max_samples` caps, which default to those of the composer.
+        if n_samples is not None:
+            return self._weighted_sample_batch(bdb, genid, modelno, row_id,
+                Y, n_samples=n_samples)
+        samples, weights = self._adaptive_sample_rows(bdb, genid, modelno,
+            [row_id], [Y], target_ess=target_ess, min_samples=min_samples,
+            max_samples=max_samples)
+        return {c: s[0] for c, s in samples.iteritems()}, weights[0]
+
+    def _adaptive_sample_rows(self, bdb, genid, modelno, row_ids, Ys,
+            target_ess=None, min_samples=None, max_samples=None,
+            cc_weights=True):
+        # Likelihood weighted samples of many rows, as
+        # _weighted_sample_rows. When the composer is not adaptive, draws a
+        # single batch of n_samples. Otherwise keeps drawing batches for all
+        # rows until the effective sample size of the weights of every row
+        # reaches `target_ess`, subject to the `min_samples` and
+        # `max_samples` caps, which default to those of the composer.
+        if target_ess is None:
+            target_ess = self.target_ess
+        if target_ess is None:
+            return self._weighted_sample_rows(bdb, genid, modelno, row_ids,
+                Ys, cc_weights=cc_weights)
+        if min_samples is None:
+            min_samples = self.min_samples
+        if max_samples is None:
+            max_samples = self.max_samples
+        batches = []
+        total = 0
+        ess = np.zeros(len(row_ids))
+        while total < max_samples and (total < min_samples or
+                np.any(ess < target_ess)):
+            size = min(max(self.n_samples, min_samples - total),
+                max_samples - total)
+            batches.append(self._weighted_sample_rows(bdb, genid, modelno,
+                row_ids, Ys, n_samples=size, cc_weights=cc_weights))
+            total += size
+            weights = np.concatenate([w for _, w in batches], axis=1)
+            ess = np.array([_effective_sample_size(w) for w in weights])
+        samples = {col: np.concatenate([s[col] for s, _ in batches], axis=1)
+            for col in batches[0][0]}
+        return samples, weights
+
+    def _weighted_sample_batch(self, bdb, genid, modelno, row_id, Y,
+            n_samples=None):
+        # Returns a pair (samples, weights) of likelihood weighted samples,
+        # held columnwise: `samples` is a dict {col:array} mapping every
+        # node in the network to the vector of its values in each of the
+        # n_samples samples for one row, so sample k is {col:samples[col][k]}.
+        # Y specifies evidence nodes as (row, col, value) triples: all
+        # returned samples have constrained values at the evidence nodes.
+        # `weights` is the vector of the log likelihoods of the evidence Y
+        # under each sample s\Y.
+        samples, weights = self._weighted_sample_rows(bdb, genid, modelno,
+            [row_id], [Y], n_samples=n_samples)
+        return {c: s[0] for c, s in samples.iteritems()}, weights[0]
+
+    def _weighted_sample_rows(self, bdb, genid, modelno, row_ids, Ys,
+            n_samples=None, cc_weights=True):
+        # Likelihood weighted samples of many rows at once, as
+        # _weighted_sample_batch for each row_ids[i] given evidence Ys[i],
+        # with arrays of shape (len(row_ids), n_samples). The evidence of all
+        # rows must be in the same columns: crosscat is simulated row by row,
+        # but each foreign predictor is called once for all samples of all
+        # rows. Without `cc_weights`, the crosscat density of the evidence,
+        # constant across the samples of a row, is left out of the weights.
         if n_samples is None:
             n_samples = self.n_samples
-        # Create n_samples dicts, each entry is weighted sample from joint.
-        samples = [{c:v for r,c,v in Y if r == row_id}
-                   for _ in xrange(n_samples)]
-        weights = []
-        w0 = 0
-        # Assess likelihood of evidence at root.
-        Y_cc = [(r, c, v) for r,c,v in Y if c in self.lcols(bdb, genid)]
-        if Y_cc:
-            w0 += self.cc(bdb, genid).logpdf_joint(bdb, self.cc_id(bdb, genid),
-                Y_cc, [], modelno)
-        # Simulate unobserved ccs.
-        Q_cc = [(row_id, c)
-                for c in self.lcols(bdb, genid) if c not in samples[0]]
-        V_cc = self.cc(bdb, genid).simulate_joint(bdb, self.cc_id(bdb, genid),
-            Q_cc, Y_cc, modelno, num_predictions=n_samples)
-        for k in xrange(n_samples):
-            w = w0
-            # Add simulated Q_cc.
-            samples[k].update({c:v for (_, c), v in zip(Q_cc, V_cc[k])})
-            for fcol in self.topo(bdb, genid):
-                pcols = self.pcols(bdb, genid, fcol)
-                predictor = self.predictor(bdb, genid, fcol)
-                # All parents of FP known (evidence or simulated)?
-                assert pcols.issubset(set(samples[k]))
-                conditions = {core.bayesdb_generator_column_name(
-                    bdb, genid, c):v for c,v in samples[k].iteritems()
-                        if c in pcols}
-                if fcol in samples[k]:
-                    # f is evidence: compute likelihood weight.
-                    w += predictor.logpdf(samples[k][fcol], conditions)
-                else:
-                    # f is latent: simulate from conditional distribution.
-                    samples[k][fcol] = predictor.simulate(1, conditions)[0]
-            weights.append(w)
-        return samples, weights
+        n_rows = len(row_ids)
+        lcols = self.lcols(bdb, genid)
+        evidence = [{c:v for r,c,v in Y if r == row_id}
+            for row_id, Y in zip(row_ids, Ys)]
+        assert all(e.viewkeys() == evidence[0].viewkeys() for e in evidence)
+        samples = {c:_column([e[c] for e in evidence for _ in xrange(n_samples)])
+            for c in evidence[0]}
+        weights = np.zeros((n_rows, n_samples))
+        # Simulate unobserved ccs jointly for all samples, row by row, and
+        # assess likelihood of evidence at root.
+        Q_cols = [c for c in sorted(lcols) if c not in evidence[0]]
+        values = {c: [] for c in Q_cols}
+        for i, (row_id, Y) in enumerate(zip(row_ids, Ys)):
+            Y_cc = [(r, c, v) for r,c,v in Y if c in lcols]
+            if Y_cc and cc_weights:
+                with self._timed('cc_logpdf', genid, samples=1):
+                    weights[i] += self.cc(bdb, genid).logpdf_joint(bdb,
+                        self.cc_id(bdb, genid), Y_cc, [], modelno)
+            if Q_cols:
+                with self._timed('cc_simulate', genid, samples=n_samples):
+                    V_cc = self.cc(bdb, genid).simulate_joint(bdb,
+                        self.cc_id(bdb, genid), [(row_id, c) for c in Q_cols],
+                        Y_cc, modelno, num_predictions=n_samples)
+                for j, c in enumerate(Q_cols):
+                    values[c].extend(v[j] for v in V_cc)
+        for c in Q_cols:
+            samples[c] = _column(values[c])
+        weights = weights.ravel()
+        # Propagate through the foreign predictors in topological order,
+        # one batched call per foreign column for all samples.
+        for fcol in self.topo(bdb, genid):
+            pcols = self.pcols(bdb, genid, fcol)
+            predictor = self.predictor(bdb, genid, fcol)
+            # All parents of FP known (evidence or simulated)?
+            assert pcols.issubset(samples)
+            conditions = pd.DataFrame({self.colname(bdb, genid, c):samples[c]
+                for c in pcols}, index=np.arange(n_rows * n_samples))
+            if fcol in samples:
+                # f is evidence: compute likelihood weight.
+                with self._timed('fp_logpdf', genid, fcol, len(conditions)):
+                    weights += logpdf_many(predictor, samples[fcol],
+                        conditions)
+            else:
+                # f is latent: simulate from conditional distribution.
+                with self._timed('fp_simulate', genid, fcol, len(conditions)):
+                    samples[fcol] = _column(simulate_many(predictor,
+                        conditions))
+        shape = (n_rows, n_samples)
+        return ({c: s.reshape(shape) for c, s in samples.iteritems()},
+            weights.reshape(shape))
 
     def cc_colno(self, bdb, genid, colno):
         return self.cc_colnos(bdb, genid, [colno])[0]
 
     def cc_colnos(self, bdb, genid, colnos):
-        lcolnames = [bayeslite.core.bayesdb_generator_column_name(bdb,
-            genid, colno) for colno in colnos]
-        return [bayeslite.core.bayesdb_generator_column_number(bdb,
-            self.cc_id(bdb, genid), lcolname) for lcolname in lcolnames]
+        cc_colnos = self._schema(bdb, genid)['cc_colnos']
+        return [cc_colnos[colno] if colno in cc_colnos else
+            core.bayesdb_generator_column_number(bdb, self.cc_id(bdb, genid),
+                self.colname(bdb, genid, colno))
+            for colno in colnos]
 
     def cc_id(self, bdb, genid):
-        cursor = bdb.sql_execute('''
-            SELECT crosscat_generator_id FROM bayesdb_composer_cc_id
-                WHERE generator_id = ?
-        ''', (genid,))
-        return cursor.fetchall()[0][0]
+        return self._schema(bdb, genid)['cc_id']
 
     def cc(self, bdb, genid):
-        return core.bayesdb_generator_metamodel(bdb, self.cc_id(bdb, genid))
+        return self._schema(bdb, genid)['cc']
 
     def lcols(self, bdb, genid):
-        cursor = bdb.sql_execute('''
-            SELECT colno FROM bayesdb_composer_column_owner
-                WHERE generator_id = ? AND local = 1
-                ORDER BY colno ASC
-        ''', (genid,))
-        return set([row[0] for row in cursor])
+        return self._schema(bdb, genid)['lcols']
 
     def fcols(self, bdb, genid):
-        cursor = bdb.sql_execute('''
-            SELECT colno FROM bayesdb_composer_column_owner
-                WHERE generator_id = ? AND local = 0
-                ORDER BY colno ASC
-        ''', (genid,))
-        return set([row[0] for row in cursor])
+        return self._schema(bdb, genid)['fcols']
 
     def pcols(self, bdb, genid, fcolno):
-        cursor = bdb.sql_execute('''
-            SELECT pcolno FROM bayesdb_composer_column_parents
-                WHERE generator_id = ? AND fcolno = ?
-                ORDER BY pcolno ASC
-        ''', (genid, fcolno))
-        return set([row[0] for row in cursor])
+        return self._schema(bdb, genid)['pcols'].get(fcolno, frozenset())
+
+    def lancestors(self, bdb, genid, colno):
+        return self._schema(bdb, genid)['lancestors'][colno]
 
     def topo(self, bdb, genid):
-        cursor = bdb.sql_execute('''
-            SELECT colno FROM bayesdb_composer_column_toposort
-                WHERE generator_id = ?
-                ORDER BY position ASC
-            ''', (genid,))
-        return [row[0] for row in cursor]
+        return list(self._schema(bdb, genid)['topo'])
 
     def predictor_name(self, bdb, genid, fcol):
-        cursor = bdb.sql_execute('''
-            SELECT predictor_name FROM bayesdb_composer_column_foreign_predictor
-                WHERE generator_id = ? AND colno = ?
-        ''', (genid, fcol))
-        return cursor.fetchall()[0][0]
+        return self._schema(bdb, genid)['predictor_names'][fcol]
+
+    def predictor_options(self, bdb, genid, fcol):
+        return dict(self._schema(bdb, genid)['predictor_options'][fcol])
+
+    def colname(self, bdb, genid, colno):
+        return self._schema(bdb, genid)['colnames'][colno]
+
+    def stattype(self, bdb, genid, colno):
+        return self._schema(bdb, genid)['stattypes'][colno]
 
     def predictor(self, bdb, genid, fcol):
-        if (genid, fcol) not in self._predictor_cache(bdb):
+        # Cached predictors are keyed on the digest of their binary, lest
+        # one outlive a rollback or a store by another connection, e.g.
+        # the parent of the workers of the process pool.
+        if bdb.cache is None:
             cursor = bdb.sql_execute('''
-                SELECT predictor_name, predictor_binary
+                SELECT predictor_digest
                     FROM bayesdb_composer_column_foreign_predictor
                     WHERE generator_id = ? AND colno = ?
             ''', (genid, fcol))
-            name, binary = cursor.fetchall()[0]
-            builder = self.predictor_builder.get(name, None)
-            if builder is None:
-                raise BLE(LookupError('Foreign predictor for column "{}" '
-                    'not registered: "{}".'.format(name,
-                        core.bayesdb_generator_column_name(bdb, genid, fcol))))
-            self._predictor_cache(bdb)[(genid, fcol)] = \
-                builder.deserialize(bdb, binary)
-        return self._predictor_cache(bdb)[(genid, fcol)]
+            digest = cursor.fetchall()[0][0]
+        else:
+            digest = self._schema(bdb, genid)['predictor_digests'][fcol]
+        predictor_cache = self._predictor_cache(bdb)
+        predictor = predictor_cache.get((genid, fcol, digest))
+        if predictor is None:
+            with self._timed('fp_deserialize', genid, fcol):
+                cursor = bdb.sql_execute('''
+                    SELECT predictor_name, predictor_binary
+                        FROM bayesdb_composer_column_foreign_predictor
+                        WHERE generator_id = ? AND colno = ?
+                ''', (genid, fcol))
+                name, binary = cursor.fetchall()[0]
+                builder = self.predictor_builder.get(name, None)
+                if builder is None:
+                    raise BLE(LookupError('Foreign predictor for column "{}" '
+                        'not registered: "{}".'.format(name,
+                            core.bayesdb_generator_column_name(bdb, genid,
+                                fcol))))
+                predictor = builder.deserialize(bdb, binary)
+            for key in predictor_cache.keys():
+                if key[:2] == (genid, fcol):
+                    predictor_cache.pop(key)
+            # The serialized size in bytes stands in for the size in memory.
+            predictor_cache.put((genid, fcol, _digest(binary)), predictor,
+                size=len(binary))
+        return predictor
+
+    def warm(self, bdb, genid):
+        """Deserialize all foreign predictors of a generator into the cache.
+
+        Parameters
+        ----------
+        bdb : bayeslite.BayesDB
+        genid : int
+            Generator id.
+        """
+        with bdb.savepoint():
+            for fcol in sorted(self.fcols(bdb, genid)):
+                self.predictor(bdb, genid, fcol)
+
+    def evict(self, bdb, genid=None):
+        """Discard cached foreign predictors.
+
+        Predictors are deserialized again on their next use.  Cached
+        predictors are never stale, as they are keyed on the digest of
+        their stored binary, so eviction only frees memory.
+
+        Parameters
+        ----------
+        bdb : bayeslite.BayesDB
+        genid : int, optional
+            Generator id.  If None, discard the predictors of all
+            generators.
+        """
+        predictor_cache = self._predictor_cache(bdb)
+        for key in predictor_cache.keys():
+            if genid is None or key[0] == genid:
+                predictor_cache.pop(key)
+
+    def predictor_cache_info(self, bdb):
+        """Report the state of the cache of foreign predictors of `bdb`.
+
+        Returns
+        -------
+        info : dict
+            Counts of cache `hits` and `misses`, number of cached
+            `predictors`, their serialized size `nbytes`, and the
+            budget `max_bytes`.
+        """
+        predictor_cache = self._predictor_cache(bdb)
+        return {
+            'hits': predictor_cache.hits,
+            'misses': predictor_cache.misses,
+            'predictors': len(predictor_cache),
+            'nbytes': predictor_cache.size,
+            'max_bytes': predictor_cache.maxsize,
+        }
+
+    def _timed(self, stage, genid, colno=None, samples=0):
+        # Context timing one call of a stage, if instrumented.
+        if not self.instrument:
+            return _NULL_TIMER
+        entry = self._stats.setdefault((stage, genid, colno), [0, 0., 0])
+        entry[2] += samples
+        return _StageTimer(entry)
+
+    def stats(self):
+        """Return the instrumentation of inference stages.
+
+        Returns
+        -------
+        stats : dict
+            Maps (stage, genid, colno) to a dict of the number of
+            `calls`, their cumulative wall time in `seconds`, and the
+            number of `samples` they produced or assessed.  `colno` is
+            the foreign column of predictor stages, and None otherwise.
+            Stages are 'cc_simulate', 'cc_logpdf', 'cc_dependence',
+            'cc_predict', 'fp_simulate', 'fp_logpdf', 'fp_deserialize',
+            'schema' and 'rows'.  Empty unless the composer was created
+            with `instrument=True`.
+        """
+        return {key: {'calls': calls, 'seconds': seconds, 'samples': samples}
+            for key, (calls, seconds, samples) in self._stats.iteritems()}
+
+    def stats_df(self):
+        """Return the instrumentation of inference stages as a DataFrame.
+
+        One row per (stage, genid, colno), as in `stats`, slowest first.
+        """
+        columns = ['stage', 'genid', 'colno', 'calls', 'seconds', 'samples']
+        df = pd.DataFrame([list(key) + entry
+            for key, entry in self._stats.iteritems()], columns=columns)
+        return df.sort_values('seconds', ascending=False)\
+            .reset_index(drop=True)
+
+    def reset_stats(self):
+        """Discard the instrumentation recorded so far."""
+        self._stats.clear()
 
     def parse(self, schema):
         """Parse the given `schema` for a `composer` metamodel.
@@ -859,6 +1952,17 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         The grammar inside foreign predictor directives is::
 
             <target> <stattype> GIVEN <condition> [...[condition]]
+                [WITH <option> = <value> [, ...]]
+
+        The options are passed as keyword arguments to the `create`
+        method of the foreign predictor, for example::
+
+            random_forest (
+                Type_of_Orbit CATEGORICAL GIVEN Apogee_km, Perigee_km
+                    WITH n_estimators = 20, n_jobs = -1
+            )
+
+        Values are numbers, `true`, `false`, `none` or bare words.
 
         All columns specified in `dependent` and `independent`
         directives must be modeled by the `default` metamodel.
@@ -895,6 +1999,10 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             means the three variables are mutually and pairwise
             *dependent*.
 
+        fcol_to_options : dict(str:dict)
+            A dict(fcol:options) mapping `fcol` to the keyword options of
+            its foreign predictor.
+
         """
         # Allowed keywords.
         DIRECTIVES = ['crosscat', 'default', 'dependent', 'independent'] + \
@@ -907,6 +2015,7 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         fcol_to_pcols = dict()
         fcol_to_fpred = dict()
         dependencies = []
+        fcol_to_options = dict()
         # Parse!
         for block in schema:
             if len(block) == 0:
@@ -961,10 +2070,25 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
                     r = casefold(commands.pop(0))
                     if r == ',':
                         continue
+                    if r == 'with':
+                        break
                     conditions.append(r)
+                options = {}
+                while commands:
+                    o = casefold(commands.pop(0))
+                    if o == ',':
+                        continue
+                    if not commands or commands.pop(0) != '=':
+                        raise BLE(ValueError(
+                            'Expected "=" after option "{}".'.format(o)))
+                    if o in options:
+                        raise BLE(ValueError(
+                            'Duplicate option "{}" for "{}".'.format(o, c)))
+                    options[o] = self._parse_option_value(o, commands)
                 fcols.append(c)
                 fcol_to_pcols[c] = conditions
                 fcol_to_fpred[c] = directive
+                fcol_to_options[c] = options
         # Unique lcols.
         if len(lcols) != len(set(lcols)):
             raise BLE(ValueError(
@@ -993,7 +2117,38 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
                         'must have default model.'.format(col)))
         # Return the hodgepodge.
         return (columns, lcols, fcols, fcol_to_pcols, fcol_to_fpred,
-            dependencies)
+            dependencies, fcol_to_options)
+
+    def _check_predictor_options(self, bdb, fcol, predictor_name, options):
+        # Fail at CREATE GENERATOR, not INITIALIZE, on options which the
+        # factory of the foreign predictor does not accept.
+        accepted = _accepted_options(self.predictor_builder[predictor_name])
+        if accepted is None:
+            return
+        for option in sorted(options):
+            if option not in accepted:
+                raise BLE(ValueError('Unknown option "{}" for foreign '
+                    'predictor {} of column "{}". Accepted options: {}.'
+                    .format(option, predictor_name, fcol,
+                        ', '.join(sorted(accepted)) or 'none')))
+
+    @staticmethod
+    def _parse_option_value(option, commands):
+        # Consumes the tokens of the value of an option: a number, possibly
+        # negative, true, false, none, or a bare word.
+        if not commands or commands[0] == ',':
+            raise BLE(ValueError(
+                'Missing value for option "{}".'.format(option)))
+        v = commands.pop(0)
+        if v == '-' and commands and isinstance(commands[0], (int, float)):
+            return -commands.pop(0)
+        if isinstance(v, (int, float)):
+            return v
+        if commands and commands[0] != ',':
+            raise BLE(ValueError(
+                'Invalid value for option "{}".'.format(option)))
+        return {'true': True, 'false': False, 'none': None}.get(
+            casefold(v), v)
 
     @staticmethod
     def topological_sort(graph):
@@ -1038,3 +2193,185 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
                 raise BLE(ValueError(
                     'A cyclic dependency occurred in topological_sort.'))
         return graph_sorted
+
+# Worker state of the process pool for multi-model estimates.
+_worker_bdb = None
+_worker_composer = None
+
+# Caches of a transaction which depend only on the contents of the
+# database, not on the random choices of a query, and which a worker keeps
+# from one task to the next while no other connection writes.
+_STRUCTURAL_CACHES = ('composer_schema', 'composer_dependence', 'crosscat')
+_worker_caches = {}
+_worker_data_version = None
+
+def _model_worker_init(pathname, config, builders, ready, failed):
+    """Open the database and register a composer in a worker process, and
+    count it as `ready` or `failed`."""
+    global _worker_bdb, _worker_composer
+    try:
+        _worker_bdb = bayeslite.bayesdb_open(pathname=pathname)
+        _worker_bdb.sql_execute('PRAGMA busy_timeout = %d' %
+            (_BUSY_TIMEOUT,))
+        _worker_composer = Composer(**config)
+        for builder in builders:
+            _worker_composer.register_foreign_predictor(builder)
+        bayeslite.bayesdb_register_metamodel(_worker_bdb, _worker_composer)
+        # Workers only read; the parent writes.
+        _worker_bdb.sql_execute('PRAGMA query_only = ON')
+    except Exception:
+        with failed.get_lock():
+            failed.value += 1
+        raise
+    with ready.get_lock():
+        ready.value += 1
+
+def _model_worker_call(task):
+    """Evaluate one model of a multi-model estimate in a worker process.
+
+    Each task runs in its own transaction, so as to see the writes of the
+    parent.  The structural caches of the previous task are carried into
+    it unless PRAGMA data_version says that another connection has
+    committed since, e.g. to analyze the models or alter the schema.
+    """
+    global _worker_caches, _worker_data_version
+    method, genid, modelno, seed, args = task
+    bdb = _worker_bdb
+    bdb.np_prng.seed(seed)
+    bdb.py_prng.seed(seed)
+    with bdb.savepoint():
+        # Read within the transaction, whose snapshot no commit changes.
+        data_version = bdb.sql_execute('PRAGMA data_version').next()[0]
+        if data_version == _worker_data_version:
+            bdb.cache.update(_worker_caches)
+        result = getattr(_worker_composer, method)(bdb, genid, modelno,
+            *args)
+        _worker_caches = {key: bdb.cache[key] for key in _STRUCTURAL_CACHES
+            if key in bdb.cache}
+        _worker_data_version = data_version
+        return result
+
+def _accepted_options(builder):
+    """Names of the options a factory accepts, or None if any.
+
+    They are listed in the `accepted_options` attribute of the factory,
+    if any, or else are the keyword arguments of its `create` method.
+    """
+    accepted = getattr(builder, 'accepted_options', None)
+    if accepted is not None:
+        return frozenset(casefold(option) for option in accepted)
+    args, _varargs, keywords, _defaults = inspect.getargspec(builder.create)
+    if keywords is not None:
+        return None
+    # Skip the bound cls or self, then bdb, table, targets and conditions.
+    if inspect.ismethod(builder.create) \
+            and builder.create.__self__ is not None:
+        args = args[1:]
+    return frozenset(casefold(arg) for arg in args[4:])
+
+def _digest(binary):
+    """SHA-1 hex digest of a serialized foreign predictor."""
+    return hashlib.sha1(binary).hexdigest()
+
+def _train_worker_call(task):
+    """Train and serialize one foreign predictor in a worker process."""
+    fcol, builder, df, targets, conditions, options, seed = task
+    # Forked workers share the global numpy state used by e.g. sklearn.
+    np.random.seed(seed)
+    try:
+        predictor = builder.create_from_df(df, targets, conditions, **options)
+    except NotImplementedError:
+        # The parent trains it from the database instead.
+        return fcol, None
+    return fcol, builder.serialize(None, predictor)
+
+def _trains_from_df(builder):
+    """Whether a factory implements the optional `create_from_df`.
+
+    Factories may leave it unset, set it to None, or inherit the stub of
+    :class:`IBayesDBForeignPredictorFactory`, which raises
+    :class:`NotImplementedError`.
+    """
+    create_from_df = getattr(builder, 'create_from_df', None)
+    if create_from_df is None:
+        return False
+    stub = IBayesDBForeignPredictorFactory.__dict__['create_from_df']
+    return getattr(create_from_df, '__func__', create_from_df) is not stub
+
+class _StageTimer(object):
+    """Context adding a call and its wall time to a stats entry."""
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *_exc_info):
+        self.entry[0] += 1
+        self.entry[1] += time.time() - self.start
+
+class _NullTimer(object):
+    """Context doing nothing, when instrumentation is disabled."""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *_exc_info):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+def _column(values):
+    """Return `values` as a vector, numeric if possible and object otherwise."""
+    column = np.asarray(values)
+    if column.dtype.kind in 'biuf':
+        return column
+    column = np.empty(len(values), dtype=object)
+    column[:] = list(values)
+    return column
+
+def _value(x):
+    """Convert a NumPy scalar from a sample vector to a Python value."""
+    return x.item() if isinstance(x, np.generic) else x
+
+def _modes(samples):
+    """Most frequent value of each row of `samples`, and its frequency."""
+    values, codes = np.unique(samples, return_inverse=True)
+    codes = codes.reshape(samples.shape)
+    rows = np.arange(samples.shape[0])
+    counts = np.zeros((samples.shape[0], len(values)))
+    np.add.at(counts, (rows[:,np.newaxis], codes), 1)
+    best = np.argmax(counts, axis=1)
+    return values[best], counts[rows, best] / samples.shape[1]
+
+def _effective_sample_size(weights):
+    """Effective sample size of importance samples with log `weights`."""
+    weights = np.asarray(weights)
+    if len(weights) == 0 or np.max(weights) == -float('inf'):
+        return 0.
+    p = np.exp(weights - np.max(weights))
+    return np.sum(p)**2 / np.sum(p**2)
+
+def _standard_error(values):
+    """Standard error of the mean of `values`."""
+    if len(values) < 2:
+        return float('inf')
+    return np.std(values, ddof=1) / np.sqrt(len(values))
+
+def _resample(prng, p, n, stratified=False):
+    """Draw `n` indices with probabilities `p` by systematic resampling.
+
+    Systematic resampling uses a single uniform offset for all `n`
+    evenly spaced positions; stratified resampling draws one uniform
+    per stratum.  The draws are returned in random order.
+    """
+    if stratified:
+        positions = (np.arange(n) + prng.uniform(size=n)) / n
+    else:
+        positions = (np.arange(n) + prng.uniform()) / n
+    cdf = np.cumsum(p)
+    draws = np.minimum(np.searchsorted(cdf, positions * cdf[-1],
+        side='right'), len(p)-1)
+    return draws[prng.permutation(n)]
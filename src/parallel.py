@@ -14,38 +14,162 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import itertools
+import math
+import struct
+import time
+
+import pandas as pd
+
+import bayeslite.ast as ast
+import bayeslite.core as core
+import bayeslite.weakprng as weakprng
+from bayeslite.bql import execute_phrase
 from bayeslite.exception import BayesLiteException as BLE
+from bayeslite.parse import parse_bql_string
+from bayeslite.sqlite3_util import sqlite3_quote_name as quote
+from bayeslite.util import casefold
 from bdbcontrib.bql_utils import cursor_to_df
 import multiprocessing as mp
 from bayeslite import bayesdb_open
+from bayeslite import bql_quote_name
+
+
+# Milliseconds for a connection to wait for the locks of others.  Results
+# are inserted while the workers read, so the parent waits for the queries
+# in progress to finish, and the workers wait for the insert to commit.
+_BUSY_TIMEOUT = 3600 * 1000
+
+# Parameters bound per statement, at most.
+_MAX_BINDINGS = 999
+
+# Seconds between checks for a result which is ready, in any order.
+_POLL_SECONDS = 0.01
+
+# Indexes of the similarity table on (rowid0, rowid1).
+_INDEXES = (None, 'deferred', 'without_rowid')
 
+# The partition of each kind of query by parallel_query, and the column
+# whose ranges define the parts.
+_PARTITIONS = {
+    ast.Estimate: ('rows', ast.ExpCol(None, '_rowid_')),
+    ast.InferAuto: ('rows', ast.ExpCol(None, '_rowid_')),
+    ast.InferExplicit: ('rows', ast.ExpCol(None, '_rowid_')),
+    ast.EstPairRow: ('rows', ast.ExpCol('r0', '_rowid_')),
+    ast.EstPairCols: ('columns', ast.ExpCol('c0', 'name')),
+    ast.Simulate: ('samples', None),
+}
 
-def _query_into_queue(query_string, queue, bdb_file):
+# BayesDB handle of each worker process of a BqlWorkerPool, or the error
+# which kept the worker from opening it.
+_worker_bdb = None
+_worker_error = None
+
+
+def _worker_init(bdb_file, generators, setup=None):
     """
-    Estimate pairwise similarity of a certain subset of the bdb according to
-    query_string; place it in the multiprocessing Manager.Queue().
+    Open the read-only BayesDB handle of a worker process, and warm up the
+    metamodels of each of `generators`.
 
-    For two technical reasons, this function is defined as a toplevel class and
-    independently creates a bdb handle:
+    For two technical reasons, the workers are toplevel functions which
+    independently create a bdb handle:
 
     1) Multiprocessing workers must be pickleable, and thus must be
        declared as toplevel functions;
     2) Multiple threads cannot access the same bdb handle, lest concurrency
        issues arise with corrupt data.
 
+    Only what outlives a transaction is worth warming up: a metamodel with
+    a `warm` method, e.g. a composer, loads into it what it caches across
+    transactions. Others, e.g. crosscat, cache their models per
+    transaction, and are not warmed up.
+
     Parameters
     ----------
-    query_string : str
-        Name of the query to execute, determined by estimate_similarity_mp.
-    queue : multiprocessing.Manager.Queue
-        Queue to place results into
     bdb_file : str
-        File location of the BayesDB database. This function will
-        independently open a new BayesDB handler.
+        File location of the BayesDB database. Each worker independently
+        opens a new BayesDB handle, once.
+    generators : list<str>
+        Names of the generators to warm up.
+    setup : callable, optional
+        Toplevel function called with the handle once it is open, e.g. to
+        register the metamodels of `generators`.
     """
-    bdb = bayesdb_open(pathname=bdb_file)
-    res = bdb.execute(query_string)
-    queue.put(cursor_to_df(res))
+    global _worker_bdb, _worker_error
+    # A pool replaces a worker whose initializer raises, without end, so
+    # an error is raised by the queries of the worker instead.
+    try:
+        _worker_bdb = bayesdb_open(pathname=bdb_file)
+        _worker_bdb.sql_execute(
+            "PRAGMA busy_timeout = {}".format(_BUSY_TIMEOUT))
+        _worker_bdb.sql_execute("PRAGMA query_only = ON")
+        if setup is not None:
+            setup(_worker_bdb)
+        for generator in generators:
+            genid = core.bayesdb_get_generator_default(_worker_bdb, generator)
+            metamodel = core.bayesdb_generator_metamodel(_worker_bdb, genid)
+            if hasattr(metamodel, 'warm'):
+                metamodel.warm(_worker_bdb, genid)
+    except Exception as e:
+        _worker_error = '{}: {}'.format(type(e).__name__, e)
+
+
+def _query_chunk(query, bindings=None, seed=None):
+    """
+    Execute a BQL query in a worker process, and return its results as a
+    DataFrame.
+
+    The query runs in its own savepoint, as one held open between
+    queries would keep other connections from writing, and would keep the
+    worker from seeing their writes.
+
+    A query with a seed runs with the generators of the handle reseeded as
+    bayeslite.bayesdb_open seeds them, so that its random choices do not
+    depend on which worker executes it, nor on the queries before it. It
+    runs with writes allowed, as SIMULATE writes its samples into a
+    temporary table.
+
+    Parameters
+    ----------
+    query : str or bayeslite.ast phrase
+        BQL query to execute.
+    bindings : tuple or dict, optional
+        Values of the parameters of the query.
+    seed : str, optional
+        32-byte seed of the handle, as for bayeslite.bayesdb_open.
+    """
+    if _worker_error is not None:
+        raise BLE(ValueError(
+            "Worker failed to start: {}".format(_worker_error)))
+    try:
+        if seed is not None:
+            _reseed(_worker_bdb, seed)
+            _worker_bdb.sql_execute("PRAGMA query_only = OFF")
+        try:
+            with _worker_bdb.savepoint():
+                df = cursor_to_df(_execute(_worker_bdb, query, bindings))
+        finally:
+            if seed is not None:
+                _worker_bdb.sql_execute("PRAGMA query_only = ON")
+    except Exception as e:
+        # Errors of bayeslite hold the bdb or do not unpickle, and an error
+        # which fails to reach the parent leaves it waiting forever.
+        raise BLE(ValueError('{}: {}'.format(type(e).__name__, e)))
+    return df
+
+
+def _reseed(bdb, seed):
+    """Reseed the generators of `bdb` as bayesdb_open(seed=seed) does."""
+    prng = weakprng.weakprng(seed)
+    bdb.py_prng.seed(prng.weakrandom32())
+    bdb.np_prng.seed([prng.weakrandom32() for _ in range(4)])
+
+
+def _execute(bdb, query, bindings):
+    # Phrases are parsed and partitioned by parallel_query.
+    if isinstance(query, basestring):
+        return bdb.execute(query, bindings)
+    return execute_phrase(bdb, query, () if bindings is None else bindings)
 
 
 def _chunks(l, n):
@@ -54,8 +178,183 @@ def _chunks(l, n):
         yield l[i:i+n]
 
 
+def _insert_rows(bdb, table, columns, rows):
+    """
+    Insert `rows` into `columns` of `table`, in a single savepoint.
+
+    The values of as many rows per statement as SQLite allows are bound
+    rather than formatted into the SQL, so that the statement is prepared
+    once for all full chunks.
+    """
+    qcns = ','.join(map(quote, columns))
+    row_sql = '({})'.format(','.join(['?'] * len(columns)))
+    with bdb.savepoint():
+        for rows_chunk in _chunks(rows, max(1, _MAX_BINDINGS // len(columns))):
+            bindings = list(itertools.chain.from_iterable(rows_chunk))
+            bdb.sql_execute('INSERT INTO {} ({}) VALUES {}'.format(
+                quote(table), qcns, ','.join([row_sql] * len(rows_chunk))),
+                bindings)
+
+
+def _pool_cores(bdb_file, cores, pool):
+    """Number of cores of `pool` if given, else `cores`, else all."""
+    if pool is not None:
+        if pool.bdb_file != bdb_file:
+            raise BLE(ValueError(
+                "Pool is for {}, not {}".format(pool.bdb_file, bdb_file)))
+        cores = pool.cores
+    elif cores is None:
+        cores = mp.cpu_count()
+    if cores < 1:
+        raise BLE(ValueError(
+            "Invalid number of cores {}".format(cores)))
+    return cores
+
+
+class BqlWorkerPool(object):
+    """
+    A persistent pool of processes which execute BQL queries on a BayesDB
+    file, each with its own read-only BayesDB handle.
+
+    Each worker opens its handle once, so that queries submitted to the
+    pool, including by successive calls of estimate_pairwise_similarity,
+    do not pay for opening the BayesDB again. Each query sees the models
+    as they are when it starts.
+
+    Example::
+
+        with BqlWorkerPool('foo.bdb', generators=['foo_cc']) as pool:
+            for df in pool.imap(queries):
+                ...
+
+    Parameters
+    ----------
+    bdb_file : str
+        File location of the BayesDB database.
+    cores : int
+        Number of worker processes. Defaults to the number of cores as
+        identified by multiprocessing.cpu_count.
+    generators : list<str>
+        Names of generators whose metamodels each worker warms up when it
+        starts, if they cache anything across queries, e.g. the foreign
+        predictors of a composer.
+    setup : callable, optional
+        Toplevel function which each worker calls with its BayesDB handle
+        when it opens it, e.g. to register a composer, as a worker handle
+        has only the builtin crosscat metamodel.
+
+    An error of a worker when it starts, e.g. of `setup` or of warming up
+    a generator, is raised by each query which it executes.
+    """
+
+    def __init__(self, bdb_file, cores=None, generators=None, setup=None):
+        if cores is None:
+            cores = mp.cpu_count()
+        if cores < 1:
+            raise BLE(ValueError(
+                "Invalid number of cores {}".format(cores)))
+        generators = list(generators or [])
+        if generators:
+            bdb = bayesdb_open(pathname=bdb_file)
+            try:
+                for generator in generators:
+                    if not core.bayesdb_has_generator_default(bdb, generator):
+                        raise BLE(ValueError(
+                            "No such generator: {}".format(generator)))
+            finally:
+                bdb.close()
+        self.bdb_file = bdb_file
+        self.cores = cores
+        self._pool = mp.Pool(processes=cores, initializer=_worker_init,
+                             initargs=(bdb_file, generators, setup))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, _exc_value, _traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def apply_async(self, query, bindings=None, seed=None):
+        """
+        Submit a BQL query to a worker.
+
+        If `seed` is given, a 32-byte seed as for bayeslite.bayesdb_open,
+        the query runs as on a handle opened with it, so that its random
+        choices, e.g. those of SIMULATE, are reproducible.
+
+        Returns
+        -------
+        result : multiprocessing.pool.AsyncResult
+            Its `get` method returns the results of the query as a
+            DataFrame, or raises the error of the query.
+        """
+        return self._pool.apply_async(_query_chunk,
+                                      args=(query, bindings, seed))
+
+    def imap(self, queries, bindings=None, seeds=None, window=None,
+             ordered=True):
+        """
+        Execute BQL queries in the workers, and yield their results as
+        DataFrames.
+
+        A new query is submitted only once a result is consumed, so that
+        results never pile up.
+
+        Parameters
+        ----------
+        queries : iterable<str>
+        bindings : tuple or dict
+            Values of the parameters of every query.
+        seeds : iterable<str>
+            Seed of each query, as for `apply_async`.
+        window : int
+            Maximum number of queries in flight at once. Defaults to two
+            per worker.
+        ordered : bool
+            Yield the results in the order of the queries, rather than as
+            soon as they are ready. Default True.
+        """
+        if window is None:
+            window = 2 * self.cores
+        if seeds is None:
+            seeds = itertools.repeat(None)
+        pending = []
+        for query, seed in itertools.izip(queries, seeds):
+            if len(pending) == window:
+                yield self._pop(pending, ordered)
+            pending.append(self.apply_async(query, bindings, seed))
+        while pending:
+            yield self._pop(pending, ordered)
+
+    @staticmethod
+    def _pop(pending, ordered):
+        # The oldest result, or else the first to be ready.
+        if ordered:
+            return pending.pop(0).get()
+        while True:
+            for i, result in enumerate(pending):
+                if result.ready():
+                    return pending.pop(i).get()
+            pending[0].wait(_POLL_SECONDS)
+
+    def close(self):
+        """Shut down the workers once they finish the queries submitted."""
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        """Shut down the workers now, abandoning any queries in flight."""
+        self._pool.terminate()
+        self._pool.join()
+
+
 def estimate_pairwise_similarity(bdb_file, table, model, sim_table=None,
-                                 cores=None, N=None, overwrite=False):
+                                 cores=None, N=None, overwrite=False,
+                                 chunk_size=100000, mirror=True,
+                                 index=None, pool=None):
     """
     Estimate pairwise similarity from the given model, splitting processing
     across multiple processors, and save results into sim_table.
@@ -78,25 +377,55 @@ def estimate_pairwise_similarity(bdb_file, table, model, sim_table=None,
         table name + '_similarity'.
     cores : int
         Number of processors to use. Defaults to the number of cores as
-        identified by multiprocessing.num_cores.
+        identified by multiprocessing.cpu_count. Ignored if pool is given.
     N : int
-        Number of rows for which to estimate pairwise similarities (so
-        N^2 calculations are done). Should be used just to test small
-        batches; currently, there is no control over what specific pairwise
-        similarities are estimated with this parameter.
+        Number of rows for which to estimate pairwise similarities: the
+        similarities between the first N rows of the table, by rowid.
+        Should be used just to test small batches.
     overwrite : bool
         Whether to overwrite the sim_table if it already exists. If
         overwrite=False and the table exists, function will raise
         sqlite3.OperationalError. Default True.
+    chunk_size : int
+        Maximum number of similarities estimated by each worker query.
+        Results are inserted into sim_table as each chunk arrives, and at
+        most two chunks per core are in flight at once, so memory use is
+        bounded by the chunk size rather than by N^2.
+    mirror : bool
+        Similarity is symmetric, so each unordered pair of rows is
+        estimated only once. If True, also insert the mirrored pair, so
+        that sim_table holds all N^2 ordered pairs. If False, sim_table
+        holds only the pairs with rowid0 <= rowid1, N(N+1)/2 in all, and
+        the view sim_table + '_symmetric' presents all N^2. Default True.
+    index : str
+        Index of sim_table on (rowid0, rowid1). If None, there is none. If
+        'deferred', a unique index is built once all the results are
+        inserted, which is cheaper than maintaining it during the inserts.
+        If 'without_rowid', sim_table is a WITHOUT ROWID table clustered
+        on the primary key (rowid0, rowid1). Default None.
+    pool : BqlWorkerPool
+        Pool of workers on bdb_file to execute the queries, which is left
+        running for further use. Defaults to a pool started and shut down
+        by this call.
+
+    Returns
+    -------
+    stats : dict
+        Cost of writing the results: the number of `rows` inserted, the
+        `insert_seconds` spent inserting them, their `rows_per_second`,
+        and the `index_seconds` spent building a deferred index.
     """
     bdb = bayesdb_open(pathname=bdb_file)
 
-    if cores is None:
-        cores = mp.cpu_count()
+    cores = _pool_cores(bdb_file, cores, pool)
 
-    if cores < 1:
+    if chunk_size < 1:
         raise BLE(ValueError(
-            "Invalid number of cores {}".format(cores)))
+            "Invalid chunk size {}".format(chunk_size)))
+
+    if index not in _INDEXES:
+        raise BLE(ValueError(
+            "Invalid index {}".format(index)))
 
     if sim_table is None:
         sim_table = table + '_similarity'
@@ -110,23 +439,31 @@ def estimate_pairwise_similarity(bdb_file, table, model, sim_table=None,
         raise BLE(ValueError(
             "Asked for N={} rows but {} rows in table".format(N, table_count)))
 
-    # Calculate the size (# of similarities to compute) and
-    # offset (where to start) calculation for each worker query.
+    rowids = [rowid for (rowid,) in bdb.sql_execute(
+        'SELECT _rowid_ FROM {} ORDER BY _rowid_ LIMIT {}'.format(table, N))]
 
-    # Divide sizes evenly, and make the last job finish the remainder
-    sizes = [(N * N) / cores for i in range(cores)]
-    sizes[-1] += (N * N) % cores
-
-    total = 0
-    offsets = [total]
-    for size in sizes[:-1]:
-        total += size
-        offsets.append(total)
+    # Partition the rows into blocks of consecutive rowids, and the upper
+    # triangle of the similarity matrix into tiles of a block of rows
+    # against a later (or the same) block. Each tile holds at most
+    # chunk_size pairs, and there are at least as many tiles as cores.
+    n_blocks = 1
+    while n_blocks * (n_blocks + 1) // 2 < cores:
+        n_blocks += 1
+    block_size = min(max(1, int(math.sqrt(chunk_size))),
+                     max(1, -(-N // n_blocks)))
+    blocks = [(rowids[i], rowids[min(i + block_size, N) - 1])
+              for i in range(0, N, block_size)]
+    tiles = [block0 + block1
+             for i, block0 in enumerate(blocks) for block1 in blocks[i:]]
 
+    # Rowid ranges rather than OFFSET, so that each worker reads only the
+    # rows of its tile.
     q_template = ('ESTIMATE SIMILARITY FROM PAIRWISE {} '.format(model) +
-                  'LIMIT {} OFFSET {}')  # Format sizes/offsets later
+                  'WHERE r0._rowid_ BETWEEN {} AND {} '
+                  'AND r1._rowid_ BETWEEN {} AND {} '
+                  'AND r0._rowid_ <= r1._rowid_')  # Format tiles later
 
-    queries = [q_template.format(*so) for so in zip(sizes, offsets)]
+    queries = [q_template.format(*tile) for tile in tiles]
 
     # Create the similarity table. Assumes original table has rowid column.
     # XXX: tables from verbnet bdb don't necessarily have an
@@ -136,52 +473,284 @@ def estimate_pairwise_similarity(bdb_file, table, model, sim_table=None,
     # would have to be changed first. For now, we eliminate
     # REFERENCE {table}(foreign_key) from the name0 and name1 col specs.
     if overwrite:
+        bdb.sql_execute('DROP VIEW IF EXISTS {}_symmetric'.format(sim_table))
         bdb.sql_execute('DROP TABLE IF EXISTS {}'.format(sim_table))
 
-    bdb.sql_execute('''
-        CREATE TABLE {sim_table} (
-            rowid0 INTEGER NOT NULL,
-            rowid1 INTEGER NOT NULL,
-            value DOUBLE NOT NULL
-        )
-    '''.format(sim_table=sim_table))
+    if index == 'without_rowid':
+        bdb.sql_execute('''
+            CREATE TABLE {sim_table} (
+                rowid0 INTEGER NOT NULL,
+                rowid1 INTEGER NOT NULL,
+                value DOUBLE NOT NULL,
+                PRIMARY KEY (rowid0, rowid1)
+            ) WITHOUT ROWID
+        '''.format(sim_table=sim_table))
+    else:
+        bdb.sql_execute('''
+            CREATE TABLE {sim_table} (
+                rowid0 INTEGER NOT NULL,
+                rowid1 INTEGER NOT NULL,
+                value DOUBLE NOT NULL
+            )
+        '''.format(sim_table=sim_table))
+
+    if not mirror:
+        bdb.sql_execute('''
+            CREATE VIEW {sim_table}_symmetric AS
+                SELECT rowid0, rowid1, value FROM {sim_table}
+                UNION ALL
+                SELECT rowid1, rowid0, value FROM {sim_table}
+                    WHERE rowid0 != rowid1
+        '''.format(sim_table=sim_table))
+
+    stats = {'rows': 0, 'insert_seconds': 0., 'index_seconds': 0.}
 
     # Define the helper which inserts data into table in batches
     def insert_into_sim(df):
         """
-        Use the main thread bdb handle to successively insert results of
-        ESTIMATEs into the table.
+        Use the main thread bdb handle to insert results of ESTIMATEs into
+        the table, in a single savepoint per result.
         """
-        # Because the bayeslite implementation of sqlite3 doesn't allow
-        # inserts of > 500 rows at a time (else sqlite3.OperationalError),
-        # we split the list into chunks of size 500 and perform multiple
-        # insert statements.
-        rows = map(list, df.values)
-        rows_str = ['({})'.format(','.join(map(str, r))) for r in rows]
-        for rows_chunk in _chunks(rows_str, 500):
-            insert_str = '''
-                INSERT INTO {} (rowid0, rowid1, value) VALUES {};
-            '''.format(sim_table, ','.join(rows_chunk))
-            bdb.sql_execute(insert_str)
-
-    pool = mp.Pool(processes=cores)
-
-    manager = mp.Manager()
-    queue = manager.Queue()
-
-    for query in queries:
-        pool.apply_async(
-            _query_into_queue, args=(query, queue, bdb_file)
-        )
-
-    # Close pool and wait for processes to finish
-    # FIXME: This waits for all processes to finish before inserting
-    # into the table, which means that memory usage is potentially very
-    # high!
-    pool.close()
-    pool.join()
-
-    # Process returned results
-    while not queue.empty():
-        df = queue.get()
-        insert_into_sim(df)
+        rows = [(int(rowid0), int(rowid1), value)
+                for rowid0, rowid1, value in df.values]
+        if mirror:
+            rows += [(rowid1, rowid0, value)
+                     for rowid0, rowid1, value in rows if rowid0 != rowid1]
+        start = time.time()
+        _insert_rows(bdb, sim_table, ['rowid0', 'rowid1', 'value'], rows)
+        stats['insert_seconds'] += time.time() - start
+        stats['rows'] += len(rows)
+
+    bdb.sql_execute("PRAGMA busy_timeout = {}".format(_BUSY_TIMEOUT))
+    own_pool = pool is None
+    if own_pool:
+        pool = BqlWorkerPool(bdb_file, cores=cores)
+
+    # Insert the results of each query as it arrives.
+    try:
+        for df in pool.imap(queries):
+            insert_into_sim(df)
+    except:
+        if own_pool:
+            pool.terminate()
+        raise
+    if own_pool:
+        pool.close()
+
+    if index == 'deferred':
+        start = time.time()
+        bdb.sql_execute('''
+            CREATE UNIQUE INDEX {sim_table}_rowids
+                ON {sim_table} (rowid0, rowid1)
+        '''.format(sim_table=sim_table))
+        stats['index_seconds'] = time.time() - start
+
+    stats['rows_per_second'] = (stats['rows'] / stats['insert_seconds']
+                                if stats['insert_seconds'] else 0.)
+    return stats
+
+
+def parallel_query(bdb_file, bql, bindings=None, partition_by=None,
+                   cores=None, chunk_size=None, ordered=True, table=None,
+                   overwrite=False, seed=None, pool=None):
+    """
+    Execute a BQL query in parts across multiple processors, and collect
+    the results into a DataFrame or a table.
+
+    The query is partitioned by
+
+    - 'rows': ranges of rowids of the table of the generator, for
+      ESTIMATE ... FROM, INFER, and ESTIMATE ... FROM PAIRWISE, whose
+      first row of each pair is partitioned;
+    - 'columns': ranges of names of the first column of each pair, for
+      ESTIMATE ... FROM PAIRWISE COLUMNS OF;
+    - 'samples': parts of the LIMIT of SIMULATE, each simulated with an
+      independent seed.
+
+    The results of parts of rows or columns cannot be combined by GROUP
+    BY, ORDER BY, LIMIT or DISTINCT, so apply those to the results
+    instead.
+
+    Parameters
+    ----------
+    bdb_file : str
+        File location of the BayesDB database.
+    bql : str
+        A single BQL query.
+    bindings : tuple or dict
+        Values of the parameters of the query.
+    partition_by : str
+        'rows', 'columns' or 'samples'. Defaults to the partition of the
+        query.
+    cores : int
+        Number of processors to use. Defaults to the number of cores as
+        identified by multiprocessing.cpu_count. Ignored if pool is given.
+    chunk_size : int
+        Number of rows, columns or samples of each part. Defaults to two
+        parts per core.
+    ordered : bool
+        If True, the results of the parts are collected in the order of
+        the parts: by rowid, by name of the first column, or by sample.
+        If False, in the order they are ready. Default True.
+    table : str
+        Name of a table, with the columns of the results, to insert them
+        into rather than return them. The table is not created if there
+        are no results.
+    overwrite : bool
+        Whether to overwrite the table if it already exists. Default False.
+    seed : str
+        32-byte seed, as for bayeslite.bayesdb_open, from which the seeds
+        of the parts of SIMULATE are drawn.
+    pool : BqlWorkerPool
+        Pool of workers on bdb_file to execute the parts, which is left
+        running for further use. Defaults to a pool started and shut down
+        by this call.
+
+    Returns
+    -------
+    results : pandas.DataFrame or int
+        The results of the query, or the number of them inserted into
+        table.
+    """
+    bdb = bayesdb_open(pathname=bdb_file, seed=seed)
+    try:
+        cores = _pool_cores(bdb_file, cores, pool)
+
+        if chunk_size is not None and chunk_size < 1:
+            raise BLE(ValueError(
+                "Invalid chunk size {}".format(chunk_size)))
+
+        phrases = list(parse_bql_string(bql))
+        if len(phrases) != 1:
+            raise BLE(ValueError(
+                "Expected one BQL phrase, not {}".format(len(phrases))))
+        phrase = phrases[0]
+        if isinstance(phrase, ast.Parametrized):
+            query = phrase.phrase
+        else:
+            query = phrase
+        if type(query) not in _PARTITIONS:
+            raise BLE(ValueError(
+                "Cannot partition query: {}".format(bql)))
+        partition, column = _PARTITIONS[type(query)]
+        if partition_by is None:
+            partition_by = partition
+        elif partition_by != partition:
+            raise BLE(ValueError(
+                "Cannot partition query by {}, only by {}: {}".format(
+                    partition_by, partition, bql)))
+
+        if not core.bayesdb_has_generator_default(bdb, query.generator):
+            raise BLE(ValueError(
+                "No such generator: {}".format(query.generator)))
+        generator_id = core.bayesdb_get_generator_default(bdb, query.generator)
+
+        if partition_by == 'samples':
+            sizes = _chunk_sizes(_nsamples(query, bindings), chunk_size, cores)
+            parts = [query._replace(nsamples=ast.ExpLit(ast.LitInt(size)))
+                     for size in sizes]
+            seeds = [struct.pack('<QQQQ', *[bdb.py_prng.getrandbits(64)
+                                            for _ in range(4)])
+                     for _size in sizes]
+        else:
+            for clause in ['grouping', 'order', 'limit']:
+                if getattr(query, clause, None) is not None:
+                    raise BLE(ValueError(
+                        "Cannot partition query with {}: {}".format(
+                            clause.upper(), bql)))
+            if getattr(query, 'quantifier', None) == ast.SELQUANT_DISTINCT:
+                raise BLE(ValueError(
+                    "Cannot partition query with DISTINCT: {}".format(bql)))
+            if partition_by == 'rows':
+                keys = [rowid for (rowid,) in bdb.sql_execute(
+                    'SELECT _rowid_ FROM {} ORDER BY _rowid_'.format(quote(
+                        core.bayesdb_generator_table(bdb, generator_id))))]
+                literal = ast.LitInt
+            else:
+                # By name, the order of the pairs of the whole query, in
+                # the case-insensitive collation of the column names.
+                keys = sorted(core.bayesdb_generator_column_names(
+                    bdb, generator_id), key=casefold)
+                literal = ast.LitString
+            # Ranges of keys, and the query restricted to each.
+            parts = []
+            start = 0
+            for size in _chunk_sizes(len(keys), chunk_size, cores):
+                in_range = ast.ExpOp(ast.OP_BETWEEN, (
+                    column,
+                    ast.ExpLit(literal(keys[start])),
+                    ast.ExpLit(literal(keys[start + size - 1]))))
+                if query.condition is not None:
+                    in_range = ast.ExpOp(ast.OP_BOOLAND,
+                                         (query.condition, in_range))
+                parts.append(query._replace(condition=in_range))
+                start += size
+            seeds = None
+        if isinstance(phrase, ast.Parametrized):
+            parts = [phrase._replace(phrase=part) for part in parts]
+
+        if table is not None:
+            if overwrite:
+                bdb.sql_execute('DROP TABLE IF EXISTS {}'.format(quote(table)))
+            elif core.bayesdb_has_table(bdb, table):
+                raise BLE(ValueError(
+                    "Table {} already exists".format(table)))
+
+        bdb.sql_execute("PRAGMA busy_timeout = {}".format(_BUSY_TIMEOUT))
+        own_pool = pool is None
+        if own_pool:
+            pool = BqlWorkerPool(bdb_file, cores=cores)
+
+        # Insert the results of each part into the table as they arrive, or
+        # else collect them.
+        results = []
+        n_results = 0
+        try:
+            for df in pool.imap(parts, bindings=bindings, seeds=seeds,
+                                ordered=ordered):
+                if df.empty:
+                    continue
+                if table is None:
+                    results.append(df)
+                    continue
+                if n_results == 0:
+                    bdb.sql_execute('CREATE TABLE {} ({})'.format(
+                        quote(table), ','.join(map(quote, df.columns))))
+                _insert_rows(bdb, table, list(df.columns), df.values.tolist())
+                n_results += len(df)
+        except:
+            if own_pool:
+                pool.terminate()
+            raise
+        if own_pool:
+            pool.close()
+
+        if table is not None:
+            return n_results
+        if not results:
+            return pd.DataFrame()
+        return pd.concat(results, ignore_index=True)
+    finally:
+        bdb.close()
+
+
+def _chunk_sizes(n, chunk_size, cores):
+    """Sizes of the parts of `n` items, of at most `chunk_size` each, or
+    else two parts per core."""
+    if chunk_size is None:
+        chunk_size = max(1, -(-n // (2 * cores)))
+    return [min(chunk_size, n - start) for start in xrange(0, n, chunk_size)]
+
+
+def _nsamples(simulate, bindings):
+    """The LIMIT of `simulate`, a literal or a parameter."""
+    nsamples = simulate.nsamples
+    if isinstance(nsamples, ast.ExpLit) and \
+            isinstance(nsamples.value, ast.LitInt):
+        return nsamples.value.value
+    if isinstance(nsamples, (ast.ExpNumpar, ast.ExpNampar)) and \
+            isinstance(bindings, (tuple, list)):
+        return int(bindings[nsamples.number - 1])
+    raise BLE(ValueError(
+        "Cannot partition SIMULATE without a LIMIT of an integer or a "
+        "parameter bound by position"))
@@ -19,3 +19,4 @@ from predictor import IBayesDBForeignPredictor
 from keplers_law import KeplersLaw
 from multiple_regression import MultipleRegression
 from random_forest import RandomForest
+from streaming_regression import StreamingRegression
@@ -20,6 +20,7 @@ import numpy as np
 
 import bdbcontrib
 from bdbcontrib.predictors import predictor
+from bdbcontrib.predictors import serialization
 from bayeslite.exception import BayesLiteException as BLE
 
 class KeplersLaw(predictor.IBayesDBForeignPredictor):
@@ -34,9 +35,14 @@ class KeplersLaw(predictor.IBayesDBForeignPredictor):
     def create(cls, bdb, table, targets, conditions):
         cols = [c for c,_ in targets+conditions]
         df = bdbcontrib.table_to_df(bdb, table, cols)
+        kl = cls.create_from_df(df, targets, conditions)
+        kl.prng = bdb.np_prng
+        return kl
+
+    @classmethod
+    def create_from_df(cls, df, targets, conditions):
         kl = cls()
         kl.train(df, targets, conditions)
-        kl.prng = bdb.np_prng
         return kl
 
     @classmethod
@@ -46,11 +52,14 @@ class KeplersLaw(predictor.IBayesDBForeignPredictor):
             'conditions': pred.conditions,
             'noise': pred.noise
         }
-        return pickle.dumps(state)
+        return serialization.dumps(cls.name(), state, {})
 
     @classmethod
     def deserialize(cls, bdb, binary):
-        state = pickle.loads(binary)
+        if serialization.is_compact(binary):
+            state, _arrays = serialization.loads(binary, cls.name())
+        else:
+            state = pickle.loads(binary)
         kl = cls(targets=state['targets'], conditions=state['conditions'],
             noise=state['noise'])
         kl.prng = bdb.np_prng
@@ -122,6 +131,30 @@ class KeplersLaw(predictor.IBayesDBForeignPredictor):
         period_minutes = satellite_period_minutes(apogee_km, perigee_km)
         return logpdfGaussian(value, period_minutes, self.noise)
 
+    def _conditions_many(self, conditions):
+        if not set(self.conditions).issubset(set(conditions.columns)):
+            raise BLE(ValueError(
+                'Must specify values for all the conditionals.\n'
+                'Received: {}\n'
+                'Expected: {}'.format(list(conditions.columns),
+                    self.conditions)))
+        apogee_km_i = self.conditions[0]
+        perigee_km_i = self.conditions[1]
+        return (conditions[apogee_km_i].values.astype(float),
+            conditions[perigee_km_i].values.astype(float))
+
+    def simulate_many(self, conditions):
+        apogee_km, perigee_km = self._conditions_many(conditions)
+        period_minutes = satellite_period_minutes(apogee_km, perigee_km)
+        return period_minutes + self.prng.normal(scale=self.noise,
+            size=len(conditions))
+
+    def logpdf_many(self, values, conditions):
+        apogee_km, perigee_km = self._conditions_many(conditions)
+        period_minutes = satellite_period_minutes(apogee_km, perigee_km)
+        return logpdfGaussian(np.asarray(values, dtype=float), period_minutes,
+            self.noise)
+
 HALF_LOG2PI = 0.5 * math.log(2 * math.pi)
 def logpdfGaussian(x, mu, sigma):
     deviation = x - mu
@@ -25,50 +25,105 @@ from sklearn.linear_model import LinearRegression
 from bayeslite.exception import BayesLiteException as BLE
 import bdbcontrib
 from bdbcontrib.predictors import predictor
+from bdbcontrib.predictors import serialization
 from bdbcontrib.predictors import sklearn_utils as utils
+from bdbcontrib.py_utils import LRUCache
 
 class MultipleRegression(predictor.IBayesDBForeignPredictor):
     """A linear regression foreign predictor.
 
     The `targets` must be a single numerical stattype.  The `conditions`
     may be arbitrary numerical or categorical columns.
+
+    The predictive distribution of each distinct tuple of condition
+    values is memoized by `simulate` and `logpdf`, up to `memo_size`
+    entries, an option of `create`.  The batched `simulate_many` and
+    `logpdf_many` evaluate all of their rows at once and bypass the memo.
     """
 
+    # Number of distinct conditions whose predictive distribution is memoized.
+    default_memo_size = 1024
+
+    # Compress serialized predictors with zlib.
+    compress = False
+
     @classmethod
-    def create(cls, bdb, table, targets, conditions):
+    def create(cls, bdb, table, targets, conditions, memo_size=None):
         cols = [c for c,_ in targets+conditions]
         df = bdbcontrib.table_to_df(bdb, table, cols)
-        mr = cls()
-        mr.train(df, targets, conditions)
+        mr = cls.create_from_df(df, targets, conditions, memo_size=memo_size)
         mr.prng = bdb.np_prng
         return mr
 
+    @classmethod
+    def create_from_df(cls, df, targets, conditions, memo_size=None):
+        mr = cls(memo_size=memo_size)
+        mr.train(df, targets, conditions)
+        return mr
+
     @classmethod
     def serialize(cls, _bdb, pred):
+        state, arrays = pred._compact_state()
+        return serialization.dumps(cls.name(), state, arrays,
+            compress=cls.compress)
+
+    @classmethod
+    def deserialize(cls, bdb, binary):
+        if serialization.is_compact(binary):
+            state, arrays = serialization.loads(binary, cls.name())
+            mr = cls._from_compact_state(state, arrays)
+        else:
+            mr = cls._deserialize_pickle(binary)
+        mr.prng = bdb.np_prng
+        return mr
+
+    def _compact_state(self):
+        # Only the coefficients of the regressions are stored.
         state = {
-            'targets': pred.targets,
-            'conditions_numerical': pred.conditions_numerical,
-            'conditions_categorical': pred.conditions_categorical,
-            'mr_full': pred.mr_full,
-            'mr_partial': pred.mr_partial,
-            'mr_full_noise': pred.mr_full_noise,
-            'mr_partial_noise': pred.mr_partial_noise,
-            'categories_to_val_map': pred.categories_to_val_map
+            'targets': self.targets,
+            'conditions_numerical': self.conditions_numerical,
+            'conditions_categorical': self.conditions_categorical,
+            'categories': serialization.encode_categories(
+                self.categories_to_val_map),
+            'intercept_full': self.mr_full.intercept_,
+            'intercept_partial': self.mr_partial.intercept_,
+            'mr_full_noise': self.mr_full_noise,
+            'mr_partial_noise': self.mr_partial_noise,
+            'memo_size': self.memo_size,
+        }
+        arrays = {
+            'coef_full': self.mr_full.coef_,
+            'coef_partial': self.mr_partial.coef_,
         }
-        return pickle.dumps(state)
+        return state, arrays
 
     @classmethod
-    def deserialize(cls, bdb, binary):
+    def _from_compact_state(cls, state, arrays):
+        return cls(targets=state['targets'],
+            conditions_numerical=state['conditions_numerical'],
+            conditions_categorical=state['conditions_categorical'],
+            mr_full=_LinearModel(arrays['coef_full'],
+                state['intercept_full']),
+            mr_partial=_LinearModel(arrays['coef_partial'],
+                state['intercept_partial']),
+            mr_full_noise=state['mr_full_noise'],
+            mr_partial_noise=state['mr_partial_noise'],
+            categories_to_val_map=serialization.decode_categories(
+                state['categories']),
+            memo_size=state['memo_size'])
+
+    @classmethod
+    def _deserialize_pickle(cls, binary):
+        # Predictors serialized before the compact format.
         state = pickle.loads(binary)
-        mr = cls(targets=state['targets'],
+        return cls(targets=state['targets'],
             conditions_numerical=state['conditions_numerical'],
             conditions_categorical=state['conditions_categorical'],
             mr_full=state['mr_full'], mr_partial=state['mr_partial'],
             mr_full_noise=state['mr_full_noise'],
             mr_partial_noise=state['mr_partial_noise'],
-            categories_to_val_map=state['categories_to_val_map'])
-        mr.prng = bdb.np_prng
-        return mr
+            categories_to_val_map=state['categories_to_val_map'],
+            memo_size=state.get('memo_size'))
 
     @classmethod
     def name(cls):
@@ -77,7 +132,7 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
     def __init__(self, targets=None, conditions_numerical=None,
             conditions_categorical=None, mr_full=None, mr_partial=None,
             mr_full_noise=None, mr_partial_noise=None,
-            categories_to_val_map=None):
+            categories_to_val_map=None, memo_size=None):
         self.targets = targets
         self.conditions_numerical = conditions_numerical
         self.conditions_categorical = conditions_categorical
@@ -90,8 +145,24 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
         self.mr_full_noise = mr_full_noise
         self.mr_partial_noise = mr_partial_noise
         self.categories_to_val_map = categories_to_val_map
+        # Memo of the predictive distribution for each tuple of condition
+        # values, holding at most `memo_size` entries.
+        if memo_size is None:
+            memo_size = self.default_memo_size
+        self.memo_size = memo_size
+        self._memo = LRUCache(maxsize=memo_size)
 
-    def train(self, df, targets, conditions):
+    def memo_info(self):
+        """Return the size and hit counters of the memo of predictive
+        distributions."""
+        return {
+            'size': len(self._memo),
+            'memo_size': self.memo_size,
+            'hits': self._memo.hits,
+            'misses': self._memo.misses,
+        }
+
+    def _set_columns(self, targets, conditions):
         # Obtain the targets column.
         if len(targets) != 1:
             raise BLE(ValueError(
@@ -117,6 +188,9 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
         self.conditions = self.conditions_numerical + \
             self.conditions_categorical
 
+    def train(self, df, targets, conditions):
+        self._set_columns(targets, conditions)
+
         # The dataset.
         self.dataset = pd.DataFrame()
         # Lookup for categoricals to code.
@@ -143,6 +217,8 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
             self.dataset)
         # Train the multiple regression.
         self._train_mr()
+        # Distributions memoized from a previous fit are stale.
+        self._memo = LRUCache(maxsize=self.memo_size)
 
     def _train_mr(self):
         """Trains the regressions.
@@ -177,6 +253,10 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
                 'Received: {}\n'
                 'Expected: {}'.format(conditions, self.conditions_numerical +
                 self.conditions_categorical)))
+        key = tuple(conditions[col] for col in self.conditions)
+        memoized = self._memo.get(key)
+        if memoized is not None:
+            return memoized
 
         # Are there any category values in conditions which never appeared during
         # training? If yes, we need to run the partial RF.
@@ -202,7 +282,45 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
             predictions = self.mr_full.predict(inputs)
             noise = self.mr_full_noise
 
-        return predictions[0], noise
+        memoized = (predictions[0], noise)
+        if 0 < self.memo_size:
+            self._memo.put(key, memoized)
+        return memoized
+
+    def _compute_targets_distribution_many(self, conditions):
+        """Given a DataFrame of conditions, returns the vector of conditional
+        means of the `targets` and the vector of scales of the Gaussian
+        noise, one entry per condition row.
+        """
+        if not set(self.conditions).issubset(set(conditions.columns)):
+            raise BLE(ValueError(
+                'Must specify values for all the conditionals.\n'
+                'Received: {}\n'
+                'Expected: {}'.format(list(conditions.columns),
+                self.conditions_numerical + self.conditions_categorical)))
+        # Rows with a category value which never appeared during training
+        # are answered by the partial regression, the rest by the full one.
+        unseen = np.zeros(len(conditions), dtype=bool)
+        for cat in self.conditions_categorical:
+            unseen |= ~conditions[cat].isin(
+                self.categories_to_val_map[cat].keys()).values
+        X_numerical = conditions[self.conditions_numerical].values.astype(
+            float).reshape(len(conditions), len(self.conditions_numerical))
+        predictions = np.zeros(len(conditions))
+        noise = np.where(unseen, self.mr_partial_noise, self.mr_full_noise)
+        if np.any(unseen):
+            predictions[unseen] = self.mr_partial.predict(X_numerical[unseen])
+        if not np.all(unseen):
+            seen = ~unseen
+            X_categorical = utils.binarize_categorical_rows(
+                self.conditions_categorical, self.categories_to_val_map,
+                conditions[seen])
+            predictions[seen] = self.mr_full.predict(
+                np.hstack((X_numerical[seen], X_categorical)))
+        return predictions, noise
+
+    def predictive_distribution_many(self, conditions):
+        return self._compute_targets_distribution_many(conditions)
 
     def simulate(self, n_samples, conditions):
         prediction, noise = self._compute_targets_distribution(conditions)
@@ -212,8 +330,29 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
         prediction, noise = self._compute_targets_distribution(conditions)
         return logpdfGaussian(value, prediction, noise)
 
+    def simulate_many(self, conditions):
+        predictions, noise = self._compute_targets_distribution_many(
+            conditions)
+        return predictions + noise * self.prng.normal(size=len(conditions))
+
+    def logpdf_many(self, values, conditions):
+        predictions, noise = self._compute_targets_distribution_many(
+            conditions)
+        return logpdfGaussian(np.asarray(values, dtype=float), predictions,
+            noise)
+
 HALF_LOG2PI = 0.5 * math.log(2 * math.pi)
 def logpdfGaussian(x, mu, sigma):
     deviation = x - mu
-    return - math.log(sigma) - HALF_LOG2PI \
+    return - np.log(sigma) - HALF_LOG2PI \
         - (0.5 * deviation * deviation / (sigma * sigma))
+
+class _LinearModel(object):
+    """Fitted coefficients with the `predict` of sklearn's regressions."""
+
+    def __init__(self, coef, intercept):
+        self.coef_ = coef
+        self.intercept_ = intercept
+
+    def predict(self, X):
+        return np.dot(np.asarray(X, dtype=float), self.coef_) + self.intercept_
@@ -14,6 +14,8 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import numpy as np
+
 class IBayesDBForeignPredictorFactory(object):
     """PRELIMINARY BayesDB foreign predictor factory interface.
 
@@ -34,7 +36,7 @@ class IBayesDBForeignPredictorFactory(object):
         """
         raise NotImplementedError
 
-    def create(self, bdb, table, targets, conditions):
+    def create(self, bdb, table, targets, conditions, **options):
         """Create and train a foreign predictor for the given circumstances.
 
         The `targets` and `conditions` ultimately come from the schema
@@ -64,6 +66,14 @@ class IBayesDBForeignPredictorFactory(object):
             The columns to be used as inputs, as pairs of column name and
             stattype.
 
+        options : keyword arguments
+            The options given after WITH in the schema, if any.  Factories
+            which take no options need not accept them.  Options are
+            checked against the keyword arguments of `create` when the
+            generator is created, unless `create` takes arbitrary keyword
+            arguments; such factories may list the names of the options
+            they accept in an `accepted_options` attribute.
+
         Returns
         -------
         predictor : :class:`~.IBayesDBForeignPredictor`
@@ -79,6 +89,65 @@ class IBayesDBForeignPredictorFactory(object):
         """
         raise NotImplementedError
 
+    def create_from_df(self, df, targets, conditions, **options):
+        """Create and train a foreign predictor from a Pandas DataFrame.
+
+        Optional.  Factories which implement it can be trained without
+        access to the BayesDB, which lets the :class:`.Composer`
+        metamodel read the table once for all of its foreign predictors
+        and train them concurrently in worker processes.  The trained
+        predictor is serialized with `bdb` set to None, so
+        :meth:`serialize` must not use it; it is reconstituted with
+        :meth:`deserialize` before use.  Factories which do not override
+        it, set it to None, or raise :class:`NotImplementedError` from it
+        are trained with :meth:`create` instead, e.g. to read the table
+        themselves out of core.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            The data to train on, with at least the columns named in
+            `targets` and `conditions`.
+
+        targets, conditions, options
+            As for :meth:`create`.
+
+        Returns
+        -------
+        predictor : :class:`~.IBayesDBForeignPredictor`
+            A trained instance of the foreign predictor.
+        """
+        raise NotImplementedError
+
+    def update(self, bdb, predictor, df):
+        """Update a trained foreign predictor with new rows of data.
+
+        Optional.  Called by :meth:`.Composer.refresh_predictors` when
+        rows are added to the table, so that the foreign predictor need
+        not be retrained on the whole table.  Factories which cannot
+        update `predictor` may raise :class:`NotImplementedError`, and
+        the predictor is then retrained with :meth:`create`.
+
+        Parameters
+        ----------
+        bdb : :class:`bayeslite.BayesDB`
+            The BayesDB containing the data.
+
+        predictor : :class:`~.IBayesDBForeignPredictor`
+            The trained predictor, as returned by :meth:`create` or
+            :meth:`deserialize`.  It may be modified in place.
+
+        df : pandas.DataFrame
+            The new rows, with the columns of the targets and conditions
+            of `predictor`.
+
+        Returns
+        -------
+        predictor : :class:`~.IBayesDBForeignPredictor`
+            The predictor trained on the previous data and `df`.
+        """
+        raise NotImplementedError
+
     def serialize(self, bdb, predictor):
         """Serialize the given predictor instance to a string.
 
@@ -174,3 +243,120 @@ class IBayesDBForeignPredictor(object):
             given the conditions.
         """
         raise NotImplementedError
+
+    def simulate_many(self, conditions):
+        """Simulate one value of `target` for each row of `conditions`.
+
+        Optional batched counterpart of :meth:`simulate`.  Foreign
+        predictors which can evaluate their predictive distribution for
+        many conditions at once should override this method; the
+        default implementation calls :meth:`simulate` once per row.
+
+        Parameters
+        ----------
+        conditions : pandas.DataFrame
+            One row per simulation, with a column for each of the
+            `conditions` required by the FP.
+
+        Returns
+        -------
+        numpy.ndarray
+            A vector of length `len(conditions)` with the simulated
+            values, where entry i is drawn given row i.
+        """
+        return np.asarray([self.simulate(1, row)[0]
+            for row in _condition_rows(conditions)])
+
+    def logpdf_many(self, values, conditions):
+        """Evaluate the log-density of each value given its conditions.
+
+        Optional batched counterpart of :meth:`logpdf`.  The default
+        implementation calls :meth:`logpdf` once per row.
+
+        Parameters
+        ----------
+        values : array-like
+            A vector of values of `target`, one per row of `conditions`.
+
+        conditions : pandas.DataFrame
+            One row per value, with a column for each of the
+            `conditions` required by the FP.
+
+        Returns
+        -------
+        numpy.ndarray
+            A vector of log probability densities, where entry i is the
+            density of `values[i]` given row i of `conditions`.
+        """
+        return np.asarray([self.logpdf(value, row)
+            for value, row in zip(values, _condition_rows(conditions))],
+            dtype=float)
+
+    def predictive_distribution_many(self, conditions):
+        """Evaluate the distribution of `target` given each row of
+        `conditions`.
+
+        Optional.  Foreign predictors whose predictive distribution has a
+        closed form may override this method, so that e.g.
+        :meth:`.Composer.predict_confidence` need not simulate to impute
+        the target.  The default implementation returns None.
+
+        Parameters
+        ----------
+        conditions : pandas.DataFrame
+            One row per distribution, with a column for each of the
+            `conditions` required by the FP.
+
+        Returns
+        -------
+        tuple or None
+            For a categorical target, `(probabilities, classes)`, where
+            `probabilities` is an array with one row per row of
+            `conditions` and one column per entry of the vector
+            `classes`.  For a numerical target, `(means, scales)`, the
+            vectors of the mean and standard deviation of the Gaussian of
+            each row.  None if the FP does not evaluate its distribution.
+        """
+        return None
+
+def simulate_many(predictor, conditions):
+    """Batched simulate from any foreign predictor.
+
+    Uses `predictor.simulate_many` when the predictor provides it, and
+    otherwise falls back to one :meth:`~IBayesDBForeignPredictor.simulate`
+    call per row, so that third-party predictors which implement only
+    the single-row interface remain usable.
+    """
+    if hasattr(predictor, 'simulate_many'):
+        return predictor.simulate_many(conditions)
+    return IBayesDBForeignPredictor.simulate_many.__func__(
+        predictor, conditions)
+
+def logpdf_many(predictor, values, conditions):
+    """Batched logpdf from any foreign predictor.
+
+    Uses `predictor.logpdf_many` when the predictor provides it, and
+    otherwise falls back to one :meth:`~IBayesDBForeignPredictor.logpdf`
+    call per row.
+    """
+    if hasattr(predictor, 'logpdf_many'):
+        return predictor.logpdf_many(values, conditions)
+    return IBayesDBForeignPredictor.logpdf_many.__func__(
+        predictor, values, conditions)
+
+def predictive_distribution_many(predictor, conditions):
+    """Predictive distributions from any foreign predictor.
+
+    Uses `predictor.predictive_distribution_many` when the predictor
+    provides it, and otherwise returns None, as
+    :meth:`~IBayesDBForeignPredictor.predictive_distribution_many` does.
+    """
+    if hasattr(predictor, 'predictive_distribution_many'):
+        return predictor.predictive_distribution_many(conditions)
+    return None
+
+def _condition_rows(conditions):
+    """Yield each row of the DataFrame `conditions` as a dict."""
+    columns = list(conditions.columns)
+    for row in conditions.itertuples(index=False):
+        yield dict(zip(columns, row))
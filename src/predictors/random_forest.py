@@ -14,7 +14,9 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import multiprocessing
 import pickle
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import pandas as pd
@@ -23,54 +25,116 @@ from sklearn.ensemble import RandomForestClassifier
 from bayeslite.exception import BayesLiteException as BLE
 import bdbcontrib
 from bdbcontrib.predictors import predictor
+from bdbcontrib.predictors import serialization
 from bdbcontrib.predictors import sklearn_utils as utils
+from bdbcontrib.py_utils import LRUCache
 
 class RandomForest(predictor.IBayesDBForeignPredictor):
     """A Random Forest foreign predictor.
 
     The `targets` must be a single categorical stattype.  The `conditions`
     may be arbitrary numerical or categorical columns.
+
+    The predictive distribution of each distinct tuple of condition
+    values is memoized by `simulate` and `logpdf`, up to `memo_size`
+    entries, an option of `create`.  The batched `simulate_many` and
+    `logpdf_many` evaluate all of their rows at once and bypass the memo.
     """
 
+    # Number of distinct conditions whose predictive distribution is memoized.
+    default_memo_size = 1024
+
+    # Compress serialized forests with zlib.
+    compress = False
+
+    # Options of `create`: `memo_size`, and those of `train`, which it
+    # passes on as keyword arguments.  Not lazy_partial: a predictor is
+    # serialized as soon as it is created for a generator, which fits the
+    # partial forest anyway.
+    accepted_options = ('n_estimators', 'max_depth', 'min_samples_leaf',
+        'n_jobs', 'memo_size')
+
     @classmethod
-    def create(cls, bdb, table, targets, conditions):
+    def create(cls, bdb, table, targets, conditions, **options):
         cols = [c for c,_ in targets+conditions]
         df = bdbcontrib.table_to_df(bdb, table, cols)
-        rf = cls()
-        rf.train(df, targets, conditions)
+        rf = cls.create_from_df(df, targets, conditions, **options)
         rf.prng = bdb.np_prng
         return rf
 
+    @classmethod
+    def create_from_df(cls, df, targets, conditions, **options):
+        rf = cls(memo_size=options.pop('memo_size', None))
+        rf.train(df, targets, conditions, **options)
+        return rf
+
     @classmethod
     def serialize(cls, _bdb, pred):
+        # The forests are stored as flat arrays of nodes; see _FlatForest.
+        # A deferred partial forest is fit now rather than storing its
+        # training set.
+        rf_full = _FlatForest.flatten(pred.rf_full)
+        arrays = rf_full.arrays('full')
+        arrays.update(_FlatForest.flatten(pred._partial_rf()).arrays(
+            'partial'))
         state = {
             'targets': pred.targets,
             'conditions_numerical': pred.conditions_numerical,
             'conditions_categorical': pred.conditions_categorical,
-            'rf_full': pred.rf_full,
-            'rf_partial': pred.rf_partial,
-            'categories_to_val_map': pred.categories_to_val_map
+            'categories': serialization.encode_categories(
+                pred.categories_to_val_map),
+            'classes': list(rf_full.classes_),
+            'forest_options': pred.forest_options,
+            'memo_size': pred.memo_size,
         }
-        return pickle.dumps(state)
+        return serialization.dumps(cls.name(), state, arrays,
+            compress=cls.compress)
 
     @classmethod
     def deserialize(cls, bdb, binary):
-        state = pickle.loads(binary)
+        if not serialization.is_compact(binary):
+            rf = cls._deserialize_pickle(binary)
+            rf.prng = bdb.np_prng
+            return rf
+        state, arrays = serialization.loads(binary, cls.name())
+        classes = np.asarray(state['classes'], dtype=object)
+        n_jobs = state['forest_options'].get('n_jobs', 1)
         rf = cls(targets=state['targets'],
             conditions_numerical=state['conditions_numerical'],
             conditions_categorical=state['conditions_categorical'],
-            rf_full=state['rf_full'], rf_partial=state['rf_partial'],
-            categories_to_val_map=state['categories_to_val_map'])
+            rf_full=_FlatForest.from_arrays('full', arrays, classes,
+                n_jobs=n_jobs),
+            rf_partial=_FlatForest.from_arrays('partial', arrays, classes,
+                n_jobs=n_jobs),
+            categories_to_val_map=serialization.decode_categories(
+                state['categories']),
+            forest_options=state['forest_options'],
+            memo_size=state['memo_size'])
         rf.prng = bdb.np_prng
         return rf
 
+    @classmethod
+    def _deserialize_pickle(cls, binary):
+        # Predictors serialized before the compact format.
+        state = pickle.loads(binary)
+        params = state['rf_partial'].get_params()
+        return cls(targets=state['targets'],
+            conditions_numerical=state['conditions_numerical'],
+            conditions_categorical=state['conditions_categorical'],
+            rf_full=state['rf_full'], rf_partial=state['rf_partial'],
+            categories_to_val_map=state['categories_to_val_map'],
+            forest_options={option: params[option] for option in
+                ['n_estimators', 'max_depth', 'min_samples_leaf', 'n_jobs']},
+            memo_size=state.get('memo_size'))
+
     @classmethod
     def name(cls):
         return 'random_forest'
 
     def __init__(self, targets=None, conditions_numerical=None,
             conditions_categorical=None, rf_full=None, rf_partial=None,
-            categories_to_val_map=None):
+            partial_data=None, categories_to_val_map=None,
+            forest_options=None, memo_size=None):
         self.targets = targets
         self.conditions_numerical = conditions_numerical
         self.conditions_categorical = conditions_categorical
@@ -80,9 +144,47 @@ class RandomForest(predictor.IBayesDBForeignPredictor):
                 self.conditions_categorical
         self.rf_full = rf_full
         self.rf_partial = rf_partial
+        # Training set (X_numerical, Y) of a partial forest not yet fit.
+        self.partial_data = partial_data
         self.categories_to_val_map = categories_to_val_map
+        # Keyword arguments of RandomForestClassifier for both forests.
+        self.forest_options = forest_options
+        # Memo of the predictive distribution for each tuple of condition
+        # values, holding at most `memo_size` entries.
+        if memo_size is None:
+            memo_size = self.default_memo_size
+        self.memo_size = memo_size
+        self._memo = LRUCache(maxsize=memo_size)
+
+    def memo_info(self):
+        """Return the size and hit counters of the memo of predictive
+        distributions."""
+        return {
+            'size': len(self._memo),
+            'memo_size': self.memo_size,
+            'hits': self._memo.hits,
+            'misses': self._memo.misses,
+        }
 
-    def train(self, df, targets, conditions):
+    def train(self, df, targets, conditions, n_estimators=100, max_depth=None,
+            min_samples_leaf=1, n_jobs=1, lazy_partial=False):
+        """Train the forests on the `targets` and `conditions` columns of `df`.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+        targets, conditions : list<tuple>
+            The (name, stattype) pairs of the target and condition columns.
+        n_estimators, max_depth, min_samples_leaf : optional
+            Size of each forest, passed to sklearn's RandomForestClassifier.
+        n_jobs : int, optional
+            Number of cores to fit and predict with; -1 uses all cores.
+        lazy_partial : bool, optional
+            Defer fitting the partial forest on the numerical conditions
+            until a query has a category value unseen in training, or the
+            predictor is serialized.  The training set of the partial
+            forest is kept meanwhile.
+        """
         # Obtain the targets column.
         if len(targets) != 1:
             raise BLE(ValueError('RandomForest requires exactly one column in '
@@ -113,8 +215,11 @@ class RandomForest(predictor.IBayesDBForeignPredictor):
         self.X_categorical = np.ndarray(0)
         self.Y = np.ndarray(0)
         # Random Forests.
-        self.rf_partial = RandomForestClassifier(n_estimators=100)
-        self.rf_full = RandomForestClassifier(n_estimators=100)
+        self.forest_options = {'n_estimators': n_estimators,
+            'max_depth': max_depth, 'min_samples_leaf': min_samples_leaf,
+            'n_jobs': n_jobs}
+        self.rf_partial = RandomForestClassifier(**self.forest_options)
+        self.rf_full = RandomForestClassifier(**self.forest_options)
         # Preprocess the data.
         self.dataset = utils.extract_sklearn_dataset(self.conditions,
             self.targets, df)
@@ -128,9 +233,11 @@ class RandomForest(predictor.IBayesDBForeignPredictor):
         self.Y = utils.extract_sklearn_univariate_target(self.targets,
             self.dataset)
         # Train the random forest.
-        self._train_rf()
+        self._train_rf(lazy_partial=lazy_partial)
+        # Distributions memoized from a previous fit are stale.
+        self._memo = LRUCache(maxsize=self.memo_size)
 
-    def _train_rf(self):
+    def _train_rf(self, lazy_partial=False):
         """Trains the random forests classifiers.
 
         We train two classifiers, `partial` which is just trained on
@@ -142,10 +249,20 @@ class RandomForest(predictor.IBayesDBForeignPredictor):
         filtering (but existant in df nevertheless) was passed in.
         """
         # pylint: disable=no-member
-        self.rf_partial.fit_transform(self.X_numerical, self.Y)
-        self.rf_full.fit_transform(
+        self.partial_data = (self.X_numerical, self.Y)
+        if not lazy_partial:
+            self._partial_rf()
+        self.rf_full.fit(
             np.hstack((self.X_numerical, self.X_categorical)), self.Y)
 
+    def _partial_rf(self):
+        """Returns the partial random forest, fitting it if it was deferred."""
+        if self.partial_data is not None:
+            X_numerical, Y = self.partial_data
+            self.rf_partial.fit(X_numerical, Y)
+            self.partial_data = None
+        return self.rf_partial
+
     def _compute_targets_distribution(self, conditions):
         """Given conditions dict {feature_col:val}, returns the
         distribution and (class mapping for lookup) of the random label
@@ -157,6 +274,10 @@ class RandomForest(predictor.IBayesDBForeignPredictor):
                 'Received: {}\n'
                 'Expected: {}'.format(conditions, self.conditions_numerical +
                 self.conditions_categorical)))
+        key = tuple(conditions[col] for col in self.conditions)
+        memoized = self._memo.get(key)
+        if memoized is not None:
+            return memoized
 
         # Are there any category values in conditions which never appeared during
         # training? If yes, we need to run the partial RF.
@@ -165,7 +286,7 @@ class RandomForest(predictor.IBayesDBForeignPredictor):
 
         X_numerical = [conditions[col] for col in self.conditions_numerical]
         if unseen:
-            distribution = self.rf_partial.predict_proba(X_numerical)
+            distribution = self._partial_rf().predict_proba([X_numerical])
             classes = self.rf_partial.classes_
         else:
             X_categorical = [conditions[col] for col in
@@ -174,9 +295,48 @@ class RandomForest(predictor.IBayesDBForeignPredictor):
                 self.conditions_categorical, self.categories_to_val_map,
                 X_categorical)
             distribution = self.rf_full.predict_proba(
-                np.hstack((X_numerical, X_categorical)))
-            classes = self.rf_partial.classes_
-        return distribution[0], classes
+                [np.hstack((X_numerical, X_categorical))])
+            classes = self.rf_full.classes_
+        memoized = (distribution[0], classes)
+        if 0 < self.memo_size:
+            self._memo.put(key, memoized)
+        return memoized
+
+    def _compute_targets_distribution_many(self, conditions):
+        """Given a DataFrame of conditions, returns the matrix of
+        distributions (one row per condition row) and the class mapping
+        for lookup of the random label self.targets|conditions.
+        """
+        if not set(self.conditions).issubset(set(conditions.columns)):
+            raise BLE(ValueError(
+                'Must specify values for all the conditionals.\n'
+                'Received: {}\n'
+                'Expected: {}'.format(list(conditions.columns),
+                self.conditions_numerical + self.conditions_categorical)))
+        # Rows with a category value which never appeared during training
+        # are answered by the partial RF, the rest by the full RF.
+        unseen = np.zeros(len(conditions), dtype=bool)
+        for cat in self.conditions_categorical:
+            unseen |= ~conditions[cat].isin(
+                self.categories_to_val_map[cat].keys()).values
+        X_numerical = conditions[self.conditions_numerical].values.astype(
+            float).reshape(len(conditions), len(self.conditions_numerical))
+        classes = self.rf_full.classes_
+        distribution = np.zeros((len(conditions), len(classes)))
+        if np.any(unseen):
+            distribution[unseen] = self._partial_rf().predict_proba(
+                X_numerical[unseen])
+        if not np.all(unseen):
+            seen = ~unseen
+            X_categorical = utils.binarize_categorical_rows(
+                self.conditions_categorical, self.categories_to_val_map,
+                conditions[seen])
+            distribution[seen] = self.rf_full.predict_proba(
+                np.hstack((X_numerical[seen], X_categorical)))
+        return distribution, classes
+
+    def predictive_distribution_many(self, conditions):
+        return self._compute_targets_distribution_many(conditions)
 
     def simulate(self, n_samples, conditions):
         distribution, classes = self._compute_targets_distribution(conditions)
@@ -188,3 +348,116 @@ class RandomForest(predictor.IBayesDBForeignPredictor):
         if value not in classes:
             return -float('inf')
         return np.log(distribution[np.where(classes==value)[0][0]])
+
+    def simulate_many(self, conditions):
+        distribution, classes = \
+            self._compute_targets_distribution_many(conditions)
+        # Inverse cdf sampling of one label per row.
+        cdf = np.cumsum(distribution, axis=1)
+        u = self.prng.uniform(size=(len(conditions), 1)) * cdf[:,-1:]
+        draws = np.minimum(np.sum(cdf <= u, axis=1), len(classes)-1)
+        return classes[draws]
+
+    def logpdf_many(self, values, conditions):
+        distribution, classes = \
+            self._compute_targets_distribution_many(conditions)
+        lookup = {c:i for i, c in enumerate(classes)}
+        logpdfs = np.empty(len(conditions))
+        for i, value in enumerate(values):
+            if value in lookup:
+                logpdfs[i] = np.log(distribution[i, lookup[value]])
+            else:
+                logpdfs[i] = -float('inf')
+        return logpdfs
+
+class _FlatForest(object):
+    """A fitted random forest flattened into arrays of nodes, with the
+    `classes_` and `predict_proba` of sklearn's RandomForestClassifier.
+
+    The nodes of all trees are concatenated, and `roots` holds the index
+    of the root of each tree.  Leaves have left child -1 and feature 0,
+    and `proba` holds the distribution of the classes at every node.
+    Like the `n_jobs` of sklearn's forests, `n_jobs` threads share the
+    rows to predict, -1 meaning one per core.
+    """
+
+    ARRAYS = ['roots', 'left', 'right', 'feature', 'threshold', 'proba']
+
+    def __init__(self, classes, roots, left, right, feature, threshold,
+            proba, n_jobs=1):
+        self.classes_ = classes
+        self.roots = roots
+        self.left = left
+        self.right = right
+        self.feature = feature
+        self.threshold = threshold
+        self.proba = proba
+        self.n_jobs = n_jobs
+
+    @classmethod
+    def flatten(cls, forest):
+        if isinstance(forest, cls):
+            return forest
+        trees = [estimator.tree_ for estimator in forest.estimators_]
+        roots = np.cumsum([0] + [tree.node_count for tree in trees[:-1]])
+        def children(which):
+            return np.concatenate([np.where(which(tree) == -1, -1,
+                    which(tree) + root)
+                for tree, root in zip(trees, roots)]).astype(np.int32)
+        left = children(lambda tree: tree.children_left)
+        right = children(lambda tree: tree.children_right)
+        feature = np.concatenate([tree.feature for tree in trees])
+        threshold = np.concatenate([tree.threshold for tree in trees])
+        # Class distributions as normalized by each tree's predict_proba.
+        value = np.concatenate([tree.value[:,0,:] for tree in trees])
+        normalizer = value.sum(axis=1)
+        normalizer[normalizer == 0] = 1
+        return cls(forest.classes_, roots.astype(np.int32), left, right,
+            np.where(left == -1, 0, feature).astype(np.int32), threshold,
+            value / normalizer[:,np.newaxis], n_jobs=forest.n_jobs)
+
+    @classmethod
+    def from_arrays(cls, prefix, arrays, classes, n_jobs=1):
+        return cls(classes, *[arrays['%s_%s' % (prefix, name)]
+            for name in cls.ARRAYS], n_jobs=n_jobs)
+
+    def arrays(self, prefix):
+        return {'%s_%s' % (prefix, name): getattr(self, name)
+            for name in self.ARRAYS}
+
+    @property
+    def n_estimators(self):
+        return len(self.roots)
+
+    def predict_proba(self, X):
+        # Like sklearn, compare the features as float32 to the thresholds.
+        X = np.asarray(X, dtype=np.float32)
+        n_jobs = self.n_jobs
+        if n_jobs < 0:
+            n_jobs += multiprocessing.cpu_count() + 1
+        n_jobs = max(1, min(n_jobs, len(X)))
+        if n_jobs == 1:
+            return self._predict_proba(X)
+        # NumPy releases the GIL while indexing the nodes, so threads
+        # descend the trees for their share of the rows concurrently.
+        pool = ThreadPool(n_jobs)
+        try:
+            return np.vstack(pool.map(self._predict_proba,
+                np.array_split(X, n_jobs)))
+        finally:
+            pool.close()
+            pool.join()
+
+    def _predict_proba(self, X):
+        rows = np.arange(len(X))[:,np.newaxis]
+        # Descend all trees for all rows at once, until all are at leaves.
+        nodes = np.repeat(self.roots[np.newaxis,:], len(X), axis=0)
+        while True:
+            left = self.left[nodes]
+            internal = left != -1
+            if not np.any(internal):
+                break
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(internal,
+                np.where(go_left, left, self.right[nodes]), nodes)
+        return self.proba[nodes].mean(axis=1)
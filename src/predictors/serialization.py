@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Compact binary format for trained foreign predictors.
+
+A serialized predictor is laid out as::
+
+    magic       6 bytes, 'BDBFP\\0'
+    version     uint16, little-endian
+    flags       uint16, little-endian; bit 0 set if the data is zlib'd
+    length      uint32, little-endian; bytes of the header
+    header      JSON object, padded with spaces to a multiple of 8 bytes
+    data        raw little-endian array buffers, each at a multiple of 8
+                bytes from the start
+
+The header holds the `kind` of predictor (its `name()`), a JSON `state`,
+and the dtype, shape and offset in the data of every array.  Readers
+ignore header entries they do not know, and refuse a newer `version`.
+Uncompressed arrays are mapped from the binary without copying, and so
+are read-only.
+"""
+
+import json
+import struct
+import zlib
+
+import numpy as np
+
+from bayeslite.exception import BayesLiteException as BLE
+
+MAGIC = 'BDBFP\0'
+VERSION = 1
+
+_PREAMBLE = struct.Struct('<HHI')
+_COMPRESSED = 1
+_ALIGN = 8
+
+def is_compact(binary):
+    """True if `binary` was serialized by :func:`dumps`, rather than e.g.
+    pickled by an older version of a predictor."""
+    return binary[:len(MAGIC)] == MAGIC
+
+def dumps(kind, state, arrays, compress=False):
+    """Serialize a predictor.
+
+    Parameters
+    ----------
+    kind : str
+        The `name()` of the predictor.
+    state : dict
+        JSON-serializable state of the predictor.  Numpy scalars are
+        converted to Python scalars.
+    arrays : dict<str:np.ndarray>
+        Arrays of numbers or booleans.
+    compress : bool, optional
+        Compress the arrays with zlib, at the cost of a copy when loading.
+
+    Returns
+    -------
+    binary : str
+    """
+    specs = []
+    buffers = []
+    offset = 0
+    for name in sorted(arrays):
+        array = np.asarray(arrays[name])
+        if array.dtype.hasobject:
+            raise BLE(ValueError('Cannot serialize array of objects: '
+                '{}.'.format(name)))
+        array = np.ascontiguousarray(array,
+            dtype=array.dtype.newbyteorder('<'))
+        specs.append({'name': name, 'dtype': array.dtype.str,
+            'shape': list(array.shape), 'offset': offset})
+        data = array.tostring()
+        padding = -len(data) % _ALIGN
+        buffers.append(data + '\0' * padding)
+        offset += len(data) + padding
+    header = json.dumps({'kind': kind, 'state': state, 'arrays': specs},
+        default=_json_scalar, sort_keys=True)
+    header += ' ' * (-(len(MAGIC) + _PREAMBLE.size + len(header)) % _ALIGN)
+    data = ''.join(buffers)
+    flags = 0
+    if compress:
+        data = zlib.compress(data)
+        flags |= _COMPRESSED
+    return ''.join([MAGIC, _PREAMBLE.pack(VERSION, flags, len(header)),
+        header, data])
+
+def loads(binary, kind):
+    """Deserialize a predictor serialized by :func:`dumps`.
+
+    Parameters
+    ----------
+    binary : str or buffer
+    kind : str
+        The `name()` of the predictor expected.
+
+    Returns
+    -------
+    state : dict
+    arrays : dict<str:np.ndarray>
+    """
+    if not is_compact(binary):
+        raise BLE(ValueError('Not a serialized foreign predictor.'))
+    start = len(MAGIC) + _PREAMBLE.size
+    version, flags, length = _PREAMBLE.unpack(binary[len(MAGIC):start])
+    if VERSION < version:
+        raise BLE(ValueError('Foreign predictor serialized with newer '
+            'format version {}; this version reads up to {}.'.format(
+                version, VERSION)))
+    header = json.loads(str(binary[start:start+length]))
+    if header['kind'] != kind:
+        raise BLE(ValueError('Expected serialized {}, received {}.'.format(
+            kind, header['kind'])))
+    start += length
+    if flags & _COMPRESSED:
+        data = zlib.decompress(binary[start:])
+        start = 0
+    else:
+        data = binary
+    arrays = {}
+    for spec in header['arrays']:
+        dtype = np.dtype(str(spec['dtype']))
+        count = int(np.prod(spec['shape']))
+        if count == 0:
+            arrays[spec['name']] = np.empty(spec['shape'], dtype=dtype)
+            continue
+        arrays[spec['name']] = np.frombuffer(data, dtype=dtype, count=count,
+            offset=start + spec['offset']).reshape(spec['shape'])
+    return header['state'], arrays
+
+def encode_categories(categories_to_val_map):
+    """Convert a {category: {value: code}} map to JSON-serializable
+    {category: [value, ...]} in order of code."""
+    return {category: sorted(val_map, key=val_map.get)
+        for category, val_map in categories_to_val_map.iteritems()}
+
+def decode_categories(categories):
+    """Inverse of :func:`encode_categories`."""
+    return {category: {value: code for code, value in enumerate(values)}
+        for category, values in categories.iteritems()}
+
+def _json_scalar(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
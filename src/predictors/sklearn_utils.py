@@ -16,6 +16,7 @@
 
 import numpy as np
 import pandas as pd
+import scipy.sparse
 
 from sklearn.preprocessing import Imputer
 
@@ -59,7 +60,7 @@ def extract_sklearn_features_numerical(columns, dataset):
     return Imputer().fit_transform(X_numerical)
 
 def extract_sklearn_features_categorical(categories,  categories_to_val_map,
-        dataset):
+        dataset, sparse=False):
     """Converts each categorical column i (Ki categories, N rows) into an
     N x Ki matrix. Each row in the matrix is a binary vector.
 
@@ -87,20 +88,18 @@ def extract_sklearn_features_categorical(categories,  categories_to_val_map,
     dataset : pandas.DataFrame
         The matrix stored as a pandas dataframe. The `categories` must appear
         as columns in the dataframe.
+    sparse : bool, optional
+        Return a scipy.sparse CSR matrix instead of a dense array.
 
     Returns
     -------
     dataset_binary : np.array
         Refined dataset with the same number of rows and appropriate number
-        of columns representing the binary version of dataset.
+        of columns representing the binary version of dataset, of dtype
+        uint8.
     """
-    dataset_binary = []
-    for row in dataset.iterrows():
-        row = list(row[1][categories])
-        row_binary = binarize_categorical_row(
-            categories, categories_to_val_map, row)
-        dataset_binary.append(row_binary)
-    return np.asarray(dataset_binary)
+    return binarize_categorical_rows(categories, categories_to_val_map,
+        dataset, sparse=sparse)
 
 def binarize_categorical_row(categories, categories_to_val_map, row):
     """Unrolls a row of categorical data into the corresponding binary
@@ -117,6 +116,52 @@ def binarize_categorical_row(categories, categories_to_val_map, row):
         binary_data.extend(encoding)
     return binary_data
 
+def binarize_categorical_rows(categories, categories_to_val_map, rows,
+        sparse=False):
+    """Unrolls rows of categorical data into the corresponding binary
+    matrix, as `binarize_categorical_row` does for each row, in the layout of
+    `extract_sklearn_features_categorical`.
+
+    Parameters
+    ----------
+    categories : list<str>
+        List of column names corresponding to the categoricals.
+    categories_to_val_map : dict<category : dict<cat:code>>
+        A dictionary of the code lookup dictionary for each category.
+    rows : pandas.DataFrame
+        The rows to encode, with the `categories` as columns.  Every value
+        must have a code.
+    sparse : bool, optional
+        Return a scipy.sparse CSR matrix instead of a dense array.
+
+    Returns
+    -------
+    rows_binary : np.array
+        Matrix of dtype uint8 with one row per row of `rows`.
+    """
+    n_rows = len(rows)
+    widths = [len(categories_to_val_map[categorical])
+        for categorical in categories]
+    offsets = np.cumsum([0] + widths[:-1])
+    # Column of the one in each row, for each categorical.
+    hot = np.empty((n_rows, len(categories)), dtype=int)
+    for i, categorical in enumerate(categories):
+        val_map = categories_to_val_map[categorical]
+        values = np.asarray(rows[categorical], dtype=object)
+        positions = pd.Index(val_map.keys(), dtype=object).get_indexer(values)
+        if np.any(positions < 0):
+            raise KeyError(values[np.argmax(positions < 0)])
+        codes = np.asarray(val_map.values(), dtype=int)
+        hot[:,i] = offsets[i] + codes[positions]
+    shape = (n_rows, sum(widths))
+    if sparse:
+        row_index = np.repeat(np.arange(n_rows), len(categories))
+        return scipy.sparse.csr_matrix((np.ones(hot.size, dtype=np.uint8),
+            (row_index, hot.ravel())), shape=shape)
+    rows_binary = np.zeros(shape, dtype=np.uint8)
+    rows_binary[np.arange(n_rows)[:,np.newaxis], hot] = 1
+    return rows_binary
+
 def build_categorical_to_value_map(columns, dataset):
     """Builds a dictionary of dictionaries.
 
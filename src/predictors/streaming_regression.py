@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from bayeslite.exception import BayesLiteException as BLE
+from bayeslite.sqlite3_util import sqlite3_quote_name as quote
+
+from bdbcontrib.predictors import serialization
+from bdbcontrib.predictors import sklearn_utils as utils
+from bdbcontrib.predictors.multiple_regression import MultipleRegression
+from bdbcontrib.predictors.multiple_regression import _LinearModel
+from bdbcontrib.py_utils import LRUCache
+
+class StreamingRegression(MultipleRegression):
+    """A linear regression foreign predictor trained out of core.
+
+    The model is that of :class:`.MultipleRegression`, but it is fit by
+    solving the normal equations from the sufficient statistics X'X, X'y
+    and y'y of the design matrix, accumulated from the table a chunk of
+    rows at a time.  Training memory is quadratic in the number of
+    features rather than linear in the number of rows.  The statistics
+    are kept with the coefficients, so that `update` adds new rows
+    without revisiting the old ones.
+
+    Missing numerical conditions are imputed with their mean over the
+    rows of the initial training.  Category values first seen in an
+    update get new indicator features.
+    """
+
+    # Train from the table in chunks, never from a DataFrame of all of it.
+    create_from_df = None
+
+    # Number of rows read and encoded at a time.
+    chunk_size = 10000
+
+    @classmethod
+    def create(cls, bdb, table, targets, conditions, chunk_size=None,
+            memo_size=None):
+        sr = cls(memo_size=memo_size)
+        sr._set_columns(targets, conditions)
+        if chunk_size is None:
+            chunk_size = cls.chunk_size
+        qt = quote(table)
+        where = 'WHERE {} IS NOT NULL'.format(quote(sr.targets[0]))
+        # Means of the numerical conditions over the rows with a target,
+        # for imputation.
+        sr.means = {}
+        if sr.conditions_numerical:
+            cursor = bdb.sql_execute('SELECT {} FROM {} {}'.format(
+                ','.join('AVG({})'.format(quote(c))
+                    for c in sr.conditions_numerical), qt, where))
+            for c, mean in zip(sr.conditions_numerical, cursor.fetchall()[0]):
+                sr.means[c] = 0. if mean is None else mean
+        sr._reset_statistics()
+        columns = sr.targets + sr.conditions
+        cursor = bdb.sql_execute('SELECT {} FROM {} {}'.format(
+            ','.join(map(quote, columns)), qt, where))
+        while True:
+            rows = list(itertools.islice(cursor, chunk_size))
+            if not rows:
+                break
+            sr._accumulate(pd.DataFrame(rows, columns=columns, dtype=object))
+        sr._solve()
+        sr.prng = bdb.np_prng
+        return sr
+
+    @classmethod
+    def deserialize(cls, bdb, binary):
+        # Only ever serialized in the compact format.
+        if not serialization.is_compact(binary):
+            raise BLE(ValueError(
+                'Not a serialized {} predictor.'.format(cls.name())))
+        return super(StreamingRegression, cls).deserialize(bdb, binary)
+
+    @classmethod
+    def update(cls, _bdb, pred, df):
+        for start in xrange(0, len(df), cls.chunk_size):
+            pred._accumulate(df.iloc[start:start+cls.chunk_size])
+        pred._solve()
+        # Distributions memoized from the previous fit are stale.
+        pred._memo = LRUCache(maxsize=pred.memo_size)
+        return pred
+
+    def _compact_state(self):
+        # The statistics are kept for updates.
+        state, arrays = super(StreamingRegression, self)._compact_state()
+        state['means'] = self.means
+        state['yty'] = self.yty
+        state['n'] = self.n
+        arrays['XtX'] = self.XtX
+        arrays['Xty'] = self.Xty
+        return state, arrays
+
+    @classmethod
+    def _from_compact_state(cls, state, arrays):
+        sr = super(StreamingRegression, cls)._from_compact_state(state,
+            arrays)
+        sr.means = state['means']
+        sr.yty = state['yty']
+        sr.n = state['n']
+        # Copied from the read-only binary, to accumulate into.
+        sr.XtX = np.array(arrays['XtX'])
+        sr.Xty = np.array(arrays['Xty'])
+        return sr
+
+    @classmethod
+    def name(cls):
+        return 'streaming_regression'
+
+    def train(self, df, targets, conditions):
+        raise NotImplementedError('StreamingRegression trains from a table '
+            'with create.')
+
+    def _reset_statistics(self):
+        # The design matrix has an intercept column, the numerical
+        # conditions, then the indicators of each categorical condition.
+        p = 1 + len(self.conditions_numerical)
+        self.categories_to_val_map = {c: {}
+            for c in self.conditions_categorical}
+        self.XtX = np.zeros((p, p))
+        self.Xty = np.zeros(p)
+        self.yty = 0.
+        self.n = 0
+
+    def _accumulate(self, df):
+        """Adds the rows of `df` to the sufficient statistics."""
+        y = pd.to_numeric(df[self.targets[0]], errors='coerce').values
+        observed = ~np.isnan(y)
+        df = df[observed]
+        y = y[observed]
+        # Category values are None when missing, as in the table.
+        categorical = pd.DataFrame({c: df[c].astype(object).where(
+                df[c].notnull(), None)
+            for c in self.conditions_categorical}, index=df.index)
+        self._add_categories(categorical)
+        X_numerical = df[self.conditions_numerical].apply(pd.to_numeric,
+            errors='coerce').fillna(self.means).values.astype(float)
+        X_categorical = utils.binarize_categorical_rows(
+            self.conditions_categorical, self.categories_to_val_map,
+            categorical)
+        X = np.hstack((np.ones((len(y), 1)), X_numerical, X_categorical))
+        self.XtX += np.dot(X.T, X)
+        self.Xty += np.dot(X.T, y)
+        self.yty += np.dot(y, y)
+        self.n += len(y)
+
+    def _add_categories(self, categorical):
+        # Code the new values of each categorical condition, and add their
+        # indicators, zero in every row so far, to the statistics.
+        end = 1 + len(self.conditions_numerical)
+        for c in self.conditions_categorical:
+            val_map = self.categories_to_val_map[c]
+            end += len(val_map)
+            new = [v for v in pd.unique(categorical[c].values)
+                if v not in val_map]
+            for v in new:
+                val_map[v] = len(val_map)
+            if new:
+                self.XtX = np.insert(self.XtX, [end] * len(new), 0, axis=0)
+                self.XtX = np.insert(self.XtX, [end] * len(new), 0, axis=1)
+                self.Xty = np.insert(self.Xty, [end] * len(new), 0)
+                end += len(new)
+
+    def _solve(self):
+        """Fits the full and partial regressions from the statistics.
+
+        The design of the partial regression is a prefix of that of the
+        full one, so its statistics are the leading blocks.
+        """
+        if self.n == 0:
+            raise BLE(ValueError('StreamingRegression requires at least one '
+                'row with a value for {}.'.format(self.targets[0])))
+        p = 1 + len(self.conditions_numerical)
+        self.mr_full, self.mr_full_noise = self._fit(self.XtX, self.Xty)
+        self.mr_partial, self.mr_partial_noise = self._fit(self.XtX[:p,:p],
+            self.Xty[:p])
+
+    def _fit(self, XtX, Xty):
+        # Least-norm solution of the normal equations, and the noise of
+        # MultipleRegression, the norm of the residuals over the count.
+        beta = np.linalg.lstsq(XtX, Xty, rcond=None)[0]
+        rss = self.yty - 2*np.dot(beta, Xty) + np.dot(beta, np.dot(XtX, beta))
+        return _LinearModel(beta[1:], beta[0]), np.sqrt(max(rss, 0.))/self.n
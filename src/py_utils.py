@@ -15,6 +15,8 @@
 #   limitations under the License.
 
 import re
+from collections import OrderedDict
+
 def helpsub(pattern, replacement):
   """Set docstring = re.sub(pattern, replacement, original_docstring)."""
   assert pattern
@@ -24,3 +26,59 @@ def helpsub(pattern, replacement):
     fn.__doc__ = re.sub(pattern, replacement, fn.__doc__)
     return fn
   return _helpsub
+
+class LRUCache(object):
+  """Mapping which discards its least recently used entries beyond a budget.
+
+  Every entry has a size, in units of the caller's choosing: 1 by
+  default, so that `maxsize` bounds the number of entries, or e.g. an
+  estimate of its bytes.  When the total `size` exceeds `maxsize`,
+  least recently used entries are discarded, but the most recent entry
+  is always kept.  With `maxsize` None the cache is unbounded.  Lookups
+  through `get` are counted in `hits` and `misses`.
+  """
+
+  def __init__(self, maxsize=None):
+    assert maxsize is None or 0 <= maxsize
+    self.maxsize = maxsize
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def keys(self):
+    return self._entries.keys()
+
+  def get(self, key, default=None):
+    """Return the value of `key`, marking it most recently used."""
+    if key not in self._entries:
+      self.misses += 1
+      return default
+    self.hits += 1
+    value, size = self._entries.pop(key)
+    self._entries[key] = (value, size)
+    return value
+
+  def put(self, key, value, size=1):
+    """Store `value` under `key` with a size of `size`."""
+    self.pop(key)
+    self._entries[key] = (value, size)
+    self.size += size
+    if self.maxsize is not None:
+      while self.maxsize < self.size and 1 < len(self._entries):
+        _key, (_value, evicted) = self._entries.popitem(last=False)
+        self.size -= evicted
+
+  def pop(self, key, default=None):
+    """Remove `key` and return its value."""
+    if key not in self._entries:
+      return default
+    value, size = self._entries.pop(key)
+    self.size -= size
+    return value
@@ -16,16 +16,23 @@
 
 import os
 import pytest
+import tempfile
+
+import numpy as np
+import pandas as pd
 
 import bayeslite
 from bayeslite.exception import BayesLiteException as BLE
 from bayeslite.sqlite3_util import sqlite3_quote_name as quote
 
 import bdbcontrib
+from bdbcontrib.metamodels import composer as composer_module
 from bdbcontrib.metamodels.composer import Composer
 from bdbcontrib.predictors import random_forest
 from bdbcontrib.predictors import keplers_law
 from bdbcontrib.predictors import multiple_regression
+from bdbcontrib.predictors import predictor
+from bdbcontrib.predictors import streaming_regression
 
 
 # Use satellites for all tests.
@@ -324,6 +331,72 @@ def test_register_foreign_predictor():
     with pytest.raises(AssertionError):
         composer.register_foreign_predictor('bans')
 
+class _CreateOnlyFactory(predictor.IBayesDBForeignPredictorFactory):
+    """Factory implementing only the required methods of the interface."""
+
+    @classmethod
+    def name(cls):
+        return 'create_only'
+
+    @classmethod
+    def create(cls, bdb, table, targets, conditions):
+        return multiple_regression.MultipleRegression.create(bdb, table,
+            targets, conditions)
+
+    @classmethod
+    def serialize(cls, bdb, predictor):
+        return multiple_regression.MultipleRegression.serialize(bdb,
+            predictor)
+
+    @classmethod
+    def deserialize(cls, bdb, binary):
+        return multiple_regression.MultipleRegression.deserialize(bdb, binary)
+
+class _DecliningFactory(_CreateOnlyFactory):
+    """Factory whose `create_from_df` declines to train."""
+
+    @classmethod
+    def name(cls):
+        return 'declining'
+
+    @classmethod
+    def create_from_df(cls, df, targets, conditions):
+        raise NotImplementedError
+
+@pytest.mark.parametrize('processes', [None, 2])
+def test_create_only_factory(processes):
+    bdb = bayeslite.bayesdb_open()
+    bayeslite.bayesdb_read_csv_file(bdb, 'satellites', PATH_SATELLITES_CSV,
+        header=True, create=True)
+    bdbcontrib.nullify(bdb, 'satellites', 'NaN')
+    composer = Composer(n_samples=5, processes=processes)
+    composer.register_foreign_predictor(_CreateOnlyFactory)
+    composer.register_foreign_predictor(_DecliningFactory)
+    bayeslite.bayesdb_register_metamodel(bdb, composer)
+    bdb.execute('''
+        CREATE GENERATOR t1 FOR satellites USING composer(
+            default (
+                Purpose CATEGORICAL, Launch_Mass_kg NUMERICAL,
+                Dry_Mass_kg NUMERICAL
+            ),
+            create_only (
+                Anticipated_Lifetime NUMERICAL GIVEN Dry_Mass_kg, Purpose
+            ),
+            declining (
+                Power_watts NUMERICAL GIVEN Launch_Mass_kg, Purpose
+            )
+        );''')
+    assert not composer_module._trains_from_df(_CreateOnlyFactory)
+    assert composer_module._trains_from_df(_DecliningFactory)
+    bdb.execute('INITIALIZE 1 MODEL FOR t1')
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    for name in ['Anticipated_Lifetime', 'Power_watts']:
+        fcol = bayeslite.core.bayesdb_generator_column_number(bdb, genid,
+            name)
+        assert isinstance(composer.predictor(bdb, genid, fcol),
+            multiple_regression.MultipleRegression)
+    composer.shutdown()
+    bdb.close()
 
 def test_drop_generator():
     bdb = bayeslite.bayesdb_open()
@@ -394,6 +467,588 @@ def test_drop_generator():
     assert not bayeslite.core.bayesdb_has_generator(bdb, 't1_cc')
     bdb.close()
 
+def test_schema_cache():
+    bdb = bayeslite.bayesdb_open()
+    bayeslite.bayesdb_read_csv_file(bdb, 'satellites', PATH_SATELLITES_CSV,
+        header=True, create=True)
+    composer = Composer(n_samples=5)
+    bayeslite.bayesdb_register_metamodel(bdb, composer)
+    composer.register_foreign_predictor(random_forest.RandomForest)
+    composer.register_foreign_predictor(multiple_regression.MultipleRegression)
+    bdb.execute('''
+        CREATE GENERATOR t1 FOR satellites USING composer(
+            default (
+                Operator_Owner CATEGORICAL, Users CATEGORICAL,
+                Perigee_km NUMERICAL
+            ),
+            random_forest (
+                Purpose CATEGORICAL GIVEN Operator_Owner, Users
+            ),
+            multiple_regression (
+                Apogee_km NUMERICAL GIVEN Purpose, Perigee_km
+            )
+        );''')
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    purpose, apogee = colno('Purpose'), colno('Apogee_km')
+    with bdb.savepoint():
+        # Structure is loaded once per transaction and served from memory.
+        assert composer._schema(bdb, genid) is composer._schema(bdb, genid)
+        assert composer.lcols(bdb, genid) == set([colno('Operator_Owner'),
+            colno('Users'), colno('Perigee_km')])
+        assert composer.fcols(bdb, genid) == set([purpose, apogee])
+        assert composer.pcols(bdb, genid, apogee) == \
+            set([purpose, colno('Perigee_km')])
+        assert composer.topo(bdb, genid) == [purpose, apogee]
+        assert composer.predictor_name(bdb, genid, purpose) == \
+            'random_forest'
+        assert bayeslite.core.bayesdb_generator_name(bdb,
+            composer.cc_id(bdb, genid)) == 't1_cc'
+        # Dropping the generator invalidates its cached structure.
+        bdb.execute('DROP GENERATOR t1')
+        assert genid not in composer._schema_cache(bdb)
+    bdb.close()
+
+def _small_composer_bdb(pathname=None, models=2, **kwargs):
+    # A small initialized composer generator with one foreign predictor of
+    # each kind, for tests of the inference internals.
+    bdb = bayeslite.bayesdb_open(pathname=pathname)
+    bayeslite.bayesdb_read_csv_file(bdb, 'satellites', PATH_SATELLITES_CSV,
+        header=True, create=True)
+    bdbcontrib.nullify(bdb, 'satellites', 'NaN')
+    composer = Composer(**kwargs)
+    composer.register_foreign_predictor(random_forest.RandomForest)
+    composer.register_foreign_predictor(multiple_regression.MultipleRegression)
+    composer.register_foreign_predictor(keplers_law.KeplersLaw)
+    bayeslite.bayesdb_register_metamodel(bdb, composer)
+    bdb.execute('''
+        CREATE GENERATOR t1 FOR satellites USING composer(
+            default (
+                Users CATEGORICAL, Purpose CATEGORICAL,
+                Perigee_km NUMERICAL, Apogee_km NUMERICAL,
+                Launch_Mass_kg NUMERICAL, Dry_Mass_kg NUMERICAL
+            ),
+            keplers_law (
+                Period_minutes NUMERICAL GIVEN Perigee_km, Apogee_km
+            ),
+            multiple_regression (
+                Anticipated_Lifetime NUMERICAL
+                    GIVEN Dry_Mass_kg, Launch_Mass_kg, Purpose
+            ),
+            random_forest (
+                Type_of_Orbit CATEGORICAL GIVEN Period_minutes, Users
+            )
+        );''')
+    bdb.execute('INITIALIZE %d MODELS FOR t1' % (models,))
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    return bdb, composer, genid
+
+def test_adaptive_weighted_sample():
+    bdb, composer, genid = _small_composer_bdb(n_samples=10, target_ess=25,
+        max_samples=60)
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    row_id = bayeslite.core.bayesdb_generator_fresh_row_id(bdb, genid)
+    with bdb.savepoint():
+        # Without evidence the weights are uniform, so batches of n_samples
+        # are drawn until their number reaches the target.
+        samples, weights = composer._weighted_sample(bdb, genid, 0, row_id,
+            [])
+        assert len(weights) == 30
+        assert np.allclose(composer_module._effective_sample_size(weights),
+            len(weights))
+        # With evidence, batches are added until the target or the cap.
+        Y = [(row_id, colno('Period_minutes'), 1436)]
+        samples, weights = composer._weighted_sample(bdb, genid, 0, row_id, Y)
+        assert composer_module._effective_sample_size(weights) >= 25 \
+            or len(weights) == 60
+        assert all(len(v) == len(weights) for v in samples.itervalues())
+        # A fixed number of samples disables adaptation.
+        _, weights = composer._weighted_sample(bdb, genid, 0, row_id, Y,
+            n_samples=3)
+        assert len(weights) == 3
+        # Pools of many rows grow until every row reaches the target.
+        rows = [row_id, row_id + 1]
+        Ys = [[(r, colno('Period_minutes'), 1436)] for r in rows]
+        samples, weights = composer._adaptive_sample_rows(bdb, genid, 0,
+            rows, Ys)
+        assert weights.shape[0] == 2
+        assert all(composer_module._effective_sample_size(w) >= 25
+            for w in weights) or weights.shape[1] == 60
+        assert all(v.shape == weights.shape for v in samples.itervalues())
+        # So do the pools of multi-row simulations.
+        n_samples = []
+        sample_rows = composer._weighted_sample_rows
+        def weighted_sample_rows(*args, **kwargs):
+            samples, weights = sample_rows(*args, **kwargs)
+            n_samples.append(weights.shape[1])
+            return samples, weights
+        composer._weighted_sample_rows = weighted_sample_rows
+        composer.simulate(bdb, genid, 0,
+            [(r, colno('Type_of_Orbit')) for r in rows],
+            [y for Y in Ys for y in Y])
+        # An effective sample size of 25 needs at least 30 samples.
+        assert sum(n_samples) >= 30
+    bdb.close()
+
+def test_evidence_cache():
+    bdb, composer, genid = _small_composer_bdb(n_samples=5)
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    row_id = bayeslite.core.bayesdb_generator_fresh_row_id(bdb, genid)
+    Y = [(row_id, colno('Apogee_km'), 1000),
+        (row_id, colno('Period_minutes'), 1436)]
+    Q0 = [(row_id, colno('Perigee_km'), 980)]
+    Q1 = [(row_id, colno('Type_of_Orbit'), 'Polar')]
+    with bdb.savepoint():
+        composer._joint_logpdf(bdb, genid, 0, Q0, Y)
+        assert len(composer._evidence_cache(bdb)) == 1
+        # The evidence marginal is shared by queries with the same evidence.
+        logpY = composer._evidence_cache(bdb).values()[0]
+        assert composer._evidence_logpdf(bdb, genid, 0, row_id,
+            list(reversed(Y))) == logpY
+        composer._joint_logpdf(bdb, genid, 0, Q1, Y)
+        assert len(composer._evidence_cache(bdb)) == 1
+        # Other models and evidence are estimated separately.
+        composer._joint_logpdf(bdb, genid, 1, Q0, Y)
+        composer._joint_logpdf(bdb, genid, 0, Q0, Y[:1])
+        assert len(composer._evidence_cache(bdb)) == 3
+        # Analysis changes the models and invalidates the estimates.
+        bdb.execute('ANALYZE t1 FOR 1 ITERATION WAIT')
+        assert len(composer._evidence_cache(bdb)) == 0
+    bdb.close()
+
+def test_dependence_matrix():
+    bdb, composer, genid = _small_composer_bdb(n_samples=5)
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    # Type_of_Orbit descends from Perigee_km, Apogee_km through
+    # Period_minutes, and from Users.
+    assert composer.lancestors(bdb, genid, colno('Type_of_Orbit')) == \
+        frozenset([colno('Perigee_km'), colno('Apogee_km'), colno('Users')])
+    colnos = bayeslite.core.bayesdb_generator_column_numbers(bdb, genid)
+    with bdb.savepoint():
+        for modelno in [0, 1, None]:
+            matrix = composer.column_dependence_probability_matrix(bdb, genid,
+                modelno, colnos)
+            assert np.allclose(matrix, matrix.T)
+            for i, colno0 in enumerate(colnos):
+                for j, colno1 in enumerate(colnos):
+                    assert matrix[i,j] == \
+                        composer.column_dependence_probability(bdb, genid,
+                            modelno, colno0, colno1)
+        # Crosscat dependence is computed once per pair of local columns.
+        n = len(composer.lcols(bdb, genid))
+        assert len(composer._dependence_cache(bdb)) == n*(n-1)
+        bdb.execute('ANALYZE t1 FOR 1 ITERATION WAIT')
+        assert len(composer._dependence_cache(bdb)) == 0
+    bdb.close()
+
+def test_multirow():
+    bdb, composer, genid = _small_composer_bdb(n_samples=10)
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    orbit = colno('Type_of_Orbit')
+    perigee = colno('Perigee_km')
+    with bdb.savepoint():
+        # Rows constrained in the same columns are sampled together.
+        Ys = [[(r, colno('Apogee_km'), 1000+r)] for r in [101, 102, 103]]
+        samples, weights = composer._weighted_sample_rows(bdb, genid, 0,
+            [101, 102, 103], Ys)
+        assert weights.shape == (3, 10)
+        assert samples[orbit].shape == (3, 10)
+        assert list(samples[colno('Apogee_km')][:,0]) == [1101, 1102, 1103]
+        # Multi-row simulate returns the targets in order, per prediction.
+        targets = [(101, orbit), (102, perigee), (101, perigee), (103, orbit)]
+        constraints = [(r, c, v) for Y in Ys for r, c, v in Y] + \
+            [(102, colno('Users'), 'Civil')]
+        predictions = composer.simulate(bdb, genid, 0, targets, constraints,
+            numpredictions=4)
+        assert len(predictions) == 4
+        assert all(len(p) == 4 for p in predictions)
+        assert all(isinstance(p[1], float) and isinstance(p[3], basestring)
+            for p in predictions)
+        # Densities of many rows are assessed row by row.
+        Q = [(101, perigee, 900), (102, perigee, 1000)]
+        assert np.isfinite(composer._joint_logpdf(bdb, genid, 0, Q,
+            Ys[0] + Ys[1]))
+        # Imputation of many rows, in bulk.
+        rowids = [1, 2, 3, 1]
+        imputations = composer.impute_column(bdb, genid, 0, perigee, rowids,
+            numsamples=5)
+        assert len(imputations) == 4
+        assert imputations[0] == imputations[3]
+        assert all(0 <= conf <= 1 for _, conf in imputations)
+        imputations = composer.impute_column(bdb, genid, 0, orbit, rowids,
+            numsamples=5)
+        assert all(isinstance(val, basestring) for val, _ in imputations)
+        with pytest.raises(BLE):
+            composer.impute_column(bdb, genid, 0, orbit, [1, 10**6])
+    bdb.close()
+
+def test_impute_foreign_column():
+    bdb, composer, genid = _small_composer_bdb(n_samples=10)
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    orbit = colno('Type_of_Orbit')
+    lifetime = colno('Anticipated_Lifetime')
+    parents = ['Period_minutes', 'Users']
+    rows = bdb.sql_execute('''
+        SELECT _rowid_, Period_minutes, Users FROM satellites
+            WHERE _rowid_ <= 30 OR Period_minutes IS NULL
+    ''').fetchall()
+    rowids = [row[0] for row in rows]
+    assert any(row[1] is None for row in rows)
+    with bdb.savepoint():
+        imputations = composer.impute_column(bdb, genid, 0, orbit, rowids,
+            numsamples=20)
+        predictor = composer.predictor(bdb, genid, orbit)
+        for row, (value, conf) in zip(rows, imputations):
+            assert value in predictor.rf_full.classes_
+            if row[1] is not None:
+                # Confidence is the predictive probability of the mode.
+                conditions = dict(zip(parents, row[1:]))
+                assert np.allclose(conf,
+                    np.exp(predictor.logpdf(value, conditions)))
+        imputations = composer.impute_column(bdb, genid, 0, lifetime, rowids,
+            numsamples=20)
+        assert all(isinstance(value, float) and 0 <= conf <= 1
+            for value, conf in imputations)
+        # Rows with observed parents get the mean of their Gaussian, with
+        # the confidence of samples of it.
+        parents = ['Dry_Mass_kg', 'Launch_Mass_kg', 'Purpose']
+        observed = bdb.sql_execute('''
+            SELECT _rowid_, Dry_Mass_kg, Launch_Mass_kg, Purpose
+                FROM satellites
+                WHERE Dry_Mass_kg IS NOT NULL
+                    AND Launch_Mass_kg IS NOT NULL AND Purpose IS NOT NULL
+                LIMIT 5
+        ''').fetchall()
+        imputations = composer.impute_column(bdb, genid, 0, lifetime,
+            [row[0] for row in observed], numsamples=20)
+        assert len(imputations) == 5
+        means, _scales = composer.predictor(bdb, genid, lifetime)\
+            .predictive_distribution_many(pd.DataFrame(
+                [row[1:] for row in observed], columns=parents))
+        assert np.allclose([value for value, _conf in imputations], means)
+        assert all(0 < conf <= 1 for _value, conf in imputations)
+        assert not all(conf == 1 for _value, conf in imputations)
+        # Predictors without distributions are sampled.
+        imputations = composer.impute_column(bdb, genid, 0,
+            colno('Period_minutes'), rowids[:5], numsamples=20)
+        assert all(isinstance(value, float) and 0 <= conf <= 1
+            for value, conf in imputations)
+    bdb.close()
+
+def test_modes():
+    samples = np.array([['a', 'b', 'b', 'c'], ['c', 'c', 'c', 'a']],
+        dtype=object)
+    modes, frequencies = composer_module._modes(samples)
+    assert list(modes) == ['b', 'c']
+    assert np.allclose(frequencies, [.5, .75])
+
+def test_mutual_information_stderr():
+    bdb, composer, genid = _small_composer_bdb(n_samples=5, max_samples=20)
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    row_id = bayeslite.core.bayesdb_generator_fresh_row_id(bdb, genid)
+    X = [(row_id, colno('Anticipated_Lifetime'))]
+    W = [(row_id, colno('Dry_Mass_kg'))]
+    Y = [(row_id, colno('Users'), 'Civil')]
+    calls = []
+    simulate = composer.simulate
+    def counting_simulate(*args, **kwargs):
+        calls.append(kwargs['numpredictions'])
+        return simulate(*args, **kwargs)
+    composer.simulate = counting_simulate
+    with bdb.savepoint():
+        mi, stderr = composer.conditional_mutual_information_stderr(bdb,
+            genid, 0, X, W, [], Y, numsamples=4)
+        assert calls == [4]
+        assert np.isfinite(mi) and 0 <= stderr < float('inf')
+        # Early stopping at the target standard error, within max_samples.
+        del calls[:]
+        composer.conditional_mutual_information_stderr(bdb, genid, 0, X, W,
+            [], Y, numsamples=4, target_stderr=1e6)
+        assert calls == [4]
+        del calls[:]
+        composer.conditional_mutual_information_stderr(bdb, genid, 0, X, W,
+            [], Y, numsamples=8, target_stderr=1e-9)
+        assert calls == [8, 8, 4]
+    bdb.close()
+
+def test_instrumentation():
+    bdb, composer, genid = _small_composer_bdb(n_samples=10, instrument=True)
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    orbit = colno('Type_of_Orbit')
+    composer.evict(bdb)
+    composer.reset_stats()
+    with bdb.savepoint():
+        composer.impute_column(bdb, genid, 0, orbit, [1, 2, 3], numsamples=5)
+        composer.simulate(bdb, genid, 0, [(1, colno('Users'))], [],
+            numpredictions=2)
+    stats = composer.stats()
+    assert stats[('fp_deserialize', genid, orbit)]['calls'] == 1
+    # Imputation evaluates the predictive distribution of each row once.
+    assert ('fp_simulate', genid, orbit) not in stats
+    assert stats[('fp_logpdf', genid, orbit)]['samples'] == 3
+    assert stats[('rows', genid, None)]['samples'] == 3
+    assert stats[('cc_simulate', genid, None)]['samples'] == 2
+    assert all(entry['seconds'] >= 0 for entry in stats.itervalues())
+    df = composer.stats_df()
+    assert len(df) == len(stats)
+    assert list(df.columns) == \
+        ['stage', 'genid', 'colno', 'calls', 'seconds', 'samples']
+    composer.reset_stats()
+    assert composer.stats() == {}
+    # Nothing is recorded unless instrumented.
+    composer.instrument = False
+    with bdb.savepoint():
+        composer.impute_column(bdb, genid, 0, orbit, [1, 2, 3], numsamples=5)
+    assert composer.stats() == {}
+    bdb.close()
+
+def test_refresh_predictors(monkeypatch):
+    bdb, composer, genid = _small_composer_bdb(n_samples=5)
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    period = colno('Period_minutes')
+    orbit = colno('Type_of_Orbit')
+    binary = lambda fcol: bdb.sql_execute('''
+        SELECT predictor_binary FROM bayesdb_composer_column_foreign_predictor
+            WHERE generator_id = ? AND colno = ?
+    ''', (genid, fcol)).fetchall()[0][0]
+    cc_models = lambda: bdb.sql_execute('''
+        SELECT modelno, theta_json FROM bayesdb_crosscat_theta
+    ''').fetchall()
+    models = cc_models()
+    # Append rows to the table.
+    bdb.sql_execute('''
+        INSERT INTO satellites (Perigee_km, Apogee_km, Period_minutes, Users)
+            SELECT Perigee_km, Apogee_km, Period_minutes, Users
+                FROM satellites WHERE _rowid_ <= 10
+    ''')
+    rowids = [r[0] for r in bdb.sql_execute('''
+        SELECT _rowid_ FROM satellites ORDER BY _rowid_ DESC LIMIT 10
+    ''')]
+    updates = []
+    def update(cls, bdb, predictor, df):
+        updates.append(df)
+        predictor.noise = 1.5
+        return predictor
+    monkeypatch.setattr(keplers_law.KeplersLaw, 'update',
+        classmethod(update), raising=False)
+    row_id = bayeslite.core.bayesdb_generator_fresh_row_id(bdb, genid)
+    Y = [(row_id, colno('Perigee_km'), 35000),
+        (row_id, colno('Apogee_km'), 36000), (row_id, period, 1436)]
+    with bdb.savepoint():
+        logpY = composer._evidence_logpdf(bdb, genid, 0, row_id, Y)
+        # Predictors which support it are updated with the new rows only.
+        composer.refresh_predictors(bdb, genid, rowids, fcols=[period])
+        # Later estimates use the updated predictor.
+        assert composer._evidence_cache(bdb) == {}
+        assert composer._evidence_logpdf(bdb, genid, 0, row_id, Y) != logpY
+    assert len(updates) == 1 and len(updates[0]) == 10
+    assert set(updates[0].columns) == \
+        set(['Period_minutes', 'Perigee_km', 'Apogee_km'])
+    with bdb.savepoint():
+        assert composer.predictor(bdb, genid, period).noise == 1.5
+    # The others are retrained on the whole table.
+    old_binary = binary(orbit)
+    composer.refresh_predictors(bdb, genid, rowids)
+    assert len(updates) == 2
+    assert binary(orbit) != old_binary
+    assert cc_models() == models
+    with pytest.raises(BLE):
+        composer.refresh_predictors(bdb, genid, rowids, fcols=[colno('Users')])
+    bdb.close()
+
+def test_predictor_cache():
+    bdb, composer, genid = _small_composer_bdb(n_samples=5)
+    fcols = sorted(composer.fcols(bdb, genid))
+    composer.evict(bdb)
+    composer.warm(bdb, genid)
+    info = composer.predictor_cache_info(bdb)
+    assert info['predictors'] == len(fcols)
+    assert info['misses'] == len(fcols)
+    assert info['hits'] == 0
+    # Cached predictors outlive the transaction.
+    with bdb.savepoint():
+        predictor = composer.predictor(bdb, genid, fcols[0])
+    with bdb.savepoint():
+        assert composer.predictor(bdb, genid, fcols[0]) is predictor
+    assert composer.predictor_cache_info(bdb)['hits'] == 2
+    composer.evict(bdb, genid)
+    assert composer.predictor_cache_info(bdb)['predictors'] == 0
+    assert composer.predictor_cache_info(bdb)['nbytes'] == 0
+    # Beyond the budget the least recently used predictors are discarded.
+    composer.predictor_cache_bytes = 1
+    composer.predictor_cache.clear()
+    composer.warm(bdb, genid)
+    info = composer.predictor_cache_info(bdb)
+    assert info['predictors'] == 1
+    assert [key[:2] for key in composer._predictor_cache(bdb).keys()] == \
+        [(genid, fcols[-1])]
+    # INITIALIZE discards the predictors it retrains.
+    bdb.execute('DROP MODELS FROM t1')
+    bdb.execute('INITIALIZE 2 MODELS FOR t1')
+    assert composer.predictor_cache_info(bdb)['predictors'] == 0
+    composer.predictor_cache_bytes = None
+    composer.predictor_cache.clear()
+    # Predictors stored in a rolled back transaction are not served.
+    fcol = bayeslite.core.bayesdb_generator_column_number(bdb, genid,
+        'Anticipated_Lifetime')
+    noise = composer.predictor(bdb, genid, fcol).mr_full_noise
+    bdb.sql_execute('BEGIN')
+    bdb.sql_execute('''
+        UPDATE satellites SET Anticipated_Lifetime = 100 * Anticipated_Lifetime
+    ''')
+    composer.refresh_predictors(bdb, genid, fcols=[fcol])
+    assert composer.predictor(bdb, genid, fcol).mr_full_noise != noise
+    bdb.sql_execute('ROLLBACK')
+    assert composer.predictor(bdb, genid, fcol).mr_full_noise == noise
+    assert composer.predictor_cache_info(bdb)['predictors'] == 1
+    bdb.close()
+
+def test_predictor_cache_connections():
+    # Predictors stored by another connection to the database, like the
+    # parent of the workers of the process pool, are not served stale.
+    fd, pathname = tempfile.mkstemp(suffix='.bdb')
+    os.close(fd)
+    try:
+        bdb, composer, genid = _small_composer_bdb(pathname=pathname,
+            n_samples=5)
+        other = bayeslite.bayesdb_open(pathname=pathname)
+        other_composer = Composer(n_samples=5)
+        for name in ['random_forest', 'multiple_regression', 'keplers_law']:
+            other_composer.register_foreign_predictor(
+                composer.predictor_builder[name])
+        bayeslite.bayesdb_register_metamodel(other, other_composer)
+        fcol = bayeslite.core.bayesdb_generator_column_number(bdb, genid,
+            'Anticipated_Lifetime')
+        with other.savepoint():
+            noise = other_composer.predictor(other, genid, fcol).mr_full_noise
+        with bdb.savepoint():
+            bdb.sql_execute('''
+                UPDATE satellites
+                    SET Anticipated_Lifetime = 100 * Anticipated_Lifetime
+            ''')
+            composer.refresh_predictors(bdb, genid, fcols=[fcol])
+            refreshed = composer.predictor(bdb, genid, fcol).mr_full_noise
+        assert refreshed != noise
+        with other.savepoint():
+            assert other_composer.predictor(other, genid, fcol).mr_full_noise \
+                == refreshed
+        other.close()
+        bdb.close()
+    finally:
+        os.remove(pathname)
+
+def test_parallel_initialize():
+    class Logger(object):
+        def __init__(self):
+            self.messages = []
+        def info(self, msg, *args):
+            self.messages.append(msg % args)
+    logger = Logger()
+    bdb, composer, genid = _small_composer_bdb(n_samples=5, processes=2,
+        logger=logger)
+    assert len(logger.messages) == 3
+    assert logger.messages[-1].endswith('(3/3).')
+    with bdb.savepoint():
+        for fcol in composer.fcols(bdb, genid):
+            predictor = composer.predictor(bdb, genid, fcol)
+            assert predictor.prng is bdb.np_prng
+            name = composer.colname(bdb, genid, fcol)
+            assert name in predictor.targets
+            assert any(name in m for m in logger.messages)
+    bdb.close()
+
+def test_parallel_models():
+    with tempfile.NamedTemporaryFile(suffix='.bdb') as bdb_file:
+        bdb, composer, genid = _small_composer_bdb(pathname=bdb_file.name,
+            models=4, n_samples=5)
+        colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+            bdb, genid, name)
+        row_id = bayeslite.core.bayesdb_generator_fresh_row_id(bdb, genid)
+        Q = [(row_id, colno('Period_minutes'), 1436)]
+        Y = [(row_id, colno('Apogee_km'), 1000)]
+        def estimates():
+            bdb.np_prng.seed(0)
+            return (
+                composer.column_dependence_probability(bdb, genid, None,
+                    colno('Type_of_Orbit'), colno('Anticipated_Lifetime')),
+                composer.column_mutual_information(bdb, genid, None,
+                    colno('Period_minutes'), colno('Perigee_km')),
+                composer.logpdf_joint(bdb, genid, Q, Y, None))
+        serial = estimates()
+        try:
+            # Per-model seeds make the estimates independent of the
+            # number of workers.
+            composer.processes = 1
+            parallel1 = estimates()
+            composer.shutdown()
+            composer.processes = 3
+            parallel3 = estimates()
+            # The workers of a fresh pool have opened the database, and
+            # the parent writes right after their reads.
+            composer.shutdown()
+            composer.processes = 8
+            for _ in range(3):
+                estimates()
+                bdb.sql_execute('CREATE TABLE scratch (x)')
+                bdb.sql_execute('DROP TABLE scratch')
+                composer.shutdown()
+        finally:
+            composer.shutdown()
+        assert np.allclose(parallel1, parallel3)
+        # Dependence probability is exact.
+        assert np.allclose(serial[0], parallel3[0])
+        assert all(np.isfinite(parallel3))
+        bdb.close()
+
+def test_worker_caches():
+    # A worker loads the schema of a generator once for all of its tasks,
+    # and again once another connection writes.
+    with tempfile.NamedTemporaryFile(suffix='.bdb') as bdb_file:
+        bdb, composer, genid = _small_composer_bdb(pathname=bdb_file.name,
+            n_samples=5)
+        colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+            bdb, genid, name)
+        worker = bayeslite.bayesdb_open(pathname=bdb_file.name)
+        worker_composer = Composer(n_samples=5, instrument=True)
+        for builder in composer.predictor_builder.values():
+            worker_composer.register_foreign_predictor(builder)
+        bayeslite.bayesdb_register_metamodel(worker, worker_composer)
+        composer_module._worker_bdb = worker
+        composer_module._worker_composer = worker_composer
+        try:
+            def task(modelno):
+                return composer_module._model_worker_call(
+                    ('_column_dependence_probability', genid, modelno, 0,
+                        (colno('Type_of_Orbit'), colno('Perigee_km'))))
+            def schema_loads():
+                return worker_composer.stats()[('schema', genid, None)]\
+                    ['calls']
+            p = [task(0), task(1)]
+            assert schema_loads() == 1
+            with bdb.savepoint():
+                assert p == [composer._column_dependence_probability(bdb,
+                    genid, modelno, colno('Type_of_Orbit'),
+                    colno('Perigee_km')) for modelno in [0, 1]]
+            task(0)
+            assert schema_loads() == 1
+            bdb.execute('ANALYZE t1 FOR 1 ITERATION WAIT')
+            task(0)
+            assert schema_loads() == 2
+        finally:
+            composer_module._worker_bdb = None
+            composer_module._worker_composer = None
+            worker.close()
+        bdb.close()
+
 def test_composer_integration__ci_slow():
     # But currently difficult to seperate these tests into smaller tests because
     # of their sequential nature. We will still test all internal functions
@@ -615,6 +1270,22 @@ def test_composer_integration__ci_slow():
     ''')
     assert [s[0] for s in curs] == [102] * 2
 
+    # Likelihood weighted samples are held columnwise, one vector per node.
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    row_id = bayeslite.core.bayesdb_generator_fresh_row_id(bdb, genid)
+    Y = [(row_id, colno('Period_minutes'), 102),
+        (row_id, colno('Apogee_km'), 1000)]
+    with bdb.savepoint():
+        samples, weights = composer._weighted_sample(bdb, genid, 0, row_id, Y,
+            n_samples=7)
+        assert len(weights) == 7
+        assert set(samples) == \
+            composer.lcols(bdb, genid) | composer.fcols(bdb, genid)
+        assert all(len(v) == 7 for v in samples.itervalues())
+        assert all(v == 102 for v in samples[colno('Period_minutes')])
+
     # -----------------------------
     # TEST COLUMN VALUE PROBABILITY
     # -----------------------------
@@ -731,3 +1402,158 @@ def test_topological_sort():
     graph = {1:[], 2:[1], 3:[2,4,6], 4:[2], 5:[3,4], 6:[4,5,1]}
     with pytest.raises(BLE):
         topo = Composer.topological_sort(graph)
+
+def test_resample():
+    prng = np.random.RandomState(0)
+    # Uniform weights have full effective sample size, degenerate weights 1.
+    assert np.allclose(composer_module._effective_sample_size(np.zeros(10)),
+        10)
+    assert np.allclose(composer_module._effective_sample_size(
+        [0, -float('inf'), -float('inf')]), 1)
+    # Resampled counts are within one of their expectation.
+    p = np.array([.1, .2, .3, .4])
+    for stratified in [False, True]:
+        draws = composer_module._resample(prng, p, 100, stratified=stratified)
+        assert len(draws) == 100
+        counts = np.bincount(draws, minlength=len(p))
+        assert np.all(np.abs(counts - 100*p) <= 1 + stratified)
+    # Zero probability particles are never drawn.
+    draws = composer_module._resample(prng, np.array([0, 1., 0]), 20)
+    assert np.all(draws == 1)
+
+def test_predictor_options():
+    bdb = bayeslite.bayesdb_open()
+    bayeslite.bayesdb_read_csv_file(bdb, 'satellites', PATH_SATELLITES_CSV,
+        header=True, create=True)
+    bdbcontrib.nullify(bdb, 'satellites', 'NaN')
+    composer = Composer(n_samples=5)
+    composer.register_foreign_predictor(random_forest.RandomForest)
+    composer.register_foreign_predictor(keplers_law.KeplersLaw)
+    bayeslite.bayesdb_register_metamodel(bdb, composer)
+    # Options need a value.
+    with pytest.raises(BLE):
+        bdb.execute('''
+            CREATE GENERATOR t0 FOR satellites USING composer(
+                default (Perigee_km NUMERICAL, Users CATEGORICAL),
+                random_forest (
+                    Type_of_Orbit CATEGORICAL GIVEN Perigee_km, Users
+                        WITH n_estimators
+                )
+            );''')
+    # Options are checked against the factory when the generator is created.
+    # A partial forest is not deferred by a composer, which stores the
+    # predictor, fitting it, when the models are initialized.
+    for directive in [
+            'random_forest (Type_of_Orbit CATEGORICAL GIVEN Perigee_km, Users '
+                'WITH lazy_partial = true)',
+            'random_forest (Type_of_Orbit CATEGORICAL GIVEN Perigee_km, Users '
+                'WITH n_estimator = 7)',
+            'keplers_law (Period_minutes NUMERICAL GIVEN Perigee_km '
+                'WITH n_estimator = 7)']:
+        with pytest.raises(BLE) as exc:
+            bdb.execute('''
+                CREATE GENERATOR t0 FOR satellites USING composer(
+                    default (Perigee_km NUMERICAL, Users CATEGORICAL),
+                    %s
+                );''' % (directive,))
+        assert 'n_estimator' in str(exc.value) \
+            or 'lazy_partial' in str(exc.value)
+        assert 'type_of_orbit' in str(exc.value) \
+            or 'period_minutes' in str(exc.value)
+    assert not bayeslite.core.bayesdb_has_generator(bdb, 't0')
+    bdb.execute('''
+        CREATE GENERATOR t1 FOR satellites USING composer(
+            default (
+                Perigee_km NUMERICAL, Apogee_km NUMERICAL, Users CATEGORICAL
+            ),
+            keplers_law (
+                Period_minutes NUMERICAL GIVEN Perigee_km, Apogee_km
+            ),
+            random_forest (
+                Type_of_Orbit CATEGORICAL GIVEN Period_minutes, Users
+                    WITH n_estimators = 7, max_depth = 4, n_jobs = -1,
+                        memo_size = 16
+            )
+        );''')
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    assert composer.predictor_options(bdb, genid, colno('Type_of_Orbit')) == \
+        {'n_estimators': 7, 'max_depth': 4, 'n_jobs': -1, 'memo_size': 16}
+    assert composer.predictor_options(bdb, genid, colno('Period_minutes')) \
+        == {}
+    bdb.execute('INITIALIZE 1 MODEL FOR t1')
+    rf = composer.predictor(bdb, genid, colno('Type_of_Orbit'))
+    assert rf.rf_full.n_estimators == 7
+    assert rf.memo_size == 16
+    assert rf.forest_options == {'n_estimators': 7, 'max_depth': 4,
+        'min_samples_leaf': 1, 'n_jobs': -1}
+    assert rf.rf_partial.n_estimators == 7
+    assert rf.rf_full.n_jobs == rf.rf_partial.n_jobs == -1
+    conditions = {'Period_minutes': 100., 'Users': 'Military'}
+    rf.logpdf('LEO', conditions)
+    rf.logpdf('LEO', dict(conditions, Users='Unseen'))
+    bdb.close()
+
+def test_upgrade_schema_1():
+    bdb = bayeslite.bayesdb_open()
+    with bdb.savepoint():
+        for stmt in composer_module.composer_schema_1:
+            bdb.sql_execute(stmt)
+    bayeslite.bayesdb_register_metamodel(bdb, Composer())
+    version = bdb.sql_execute('''
+        SELECT version FROM bayesdb_metamodel WHERE name = 'composer'
+    ''').fetchall()
+    assert version == [(3,)]
+    bdb.sql_execute('''
+        SELECT predictor_options, predictor_digest
+            FROM bayesdb_composer_column_foreign_predictor
+    ''').fetchall()
+    bdb.close()
+
+def test_streaming_regression():
+    bdb = bayeslite.bayesdb_open()
+    bayeslite.bayesdb_read_csv_file(bdb, 'satellites', PATH_SATELLITES_CSV,
+        header=True, create=True)
+    bdbcontrib.nullify(bdb, 'satellites', 'NaN')
+    composer = Composer(n_samples=5, processes=2)
+    composer.register_foreign_predictor(random_forest.RandomForest)
+    composer.register_foreign_predictor(
+        streaming_regression.StreamingRegression)
+    bayeslite.bayesdb_register_metamodel(bdb, composer)
+    bdb.execute('''
+        CREATE GENERATOR t1 FOR satellites USING composer(
+            default (
+                Users CATEGORICAL, Purpose CATEGORICAL,
+                Launch_Mass_kg NUMERICAL, Dry_Mass_kg NUMERICAL
+            ),
+            streaming_regression (
+                Anticipated_Lifetime NUMERICAL
+                    GIVEN Dry_Mass_kg, Launch_Mass_kg, Purpose
+                    WITH chunk_size = 100
+            ),
+            random_forest (
+                Type_of_Orbit CATEGORICAL GIVEN Users, Anticipated_Lifetime
+            )
+        );''')
+    bdb.execute('INITIALIZE 1 MODEL FOR t1')
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    lifetime = bayeslite.core.bayesdb_generator_column_number(bdb, genid,
+        'Anticipated_Lifetime')
+    with bdb.savepoint():
+        n = composer.predictor(bdb, genid, lifetime).n
+    # New rows are added to the statistics of the regression.
+    bdb.sql_execute('''
+        INSERT INTO satellites (Anticipated_Lifetime, Dry_Mass_kg, Purpose)
+            VALUES (10, 1000, 'A new purpose')
+    ''')
+    rowid = bdb.sql_execute('SELECT MAX(_rowid_) FROM satellites').next()[0]
+    composer.refresh_predictors(bdb, genid, [rowid], fcols=[lifetime])
+    with bdb.savepoint():
+        assert composer.predictor(bdb, genid, lifetime).n == n + 1
+        bdb.execute('''
+            SIMULATE Anticipated_Lifetime FROM t1
+                GIVEN Purpose = 'Communications' LIMIT 2
+        ''').fetchall()
+    composer.shutdown()
+    bdb.close()
@@ -14,15 +14,24 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import pickle
+import pytest
+
 import numpy as np
 import pandas as pd
 
+from bayeslite.exception import BayesLiteException as BLE
+
 from bdbcontrib import df_to_table
+from bdbcontrib import table_to_df
 from crosscat.tests import synthetic_data_generator as sdg
 
+from bdbcontrib.predictors import predictor
+from bdbcontrib.predictors import serialization
 from bdbcontrib.predictors.random_forest import RandomForest
 from bdbcontrib.predictors.keplers_law import KeplersLaw
 from bdbcontrib.predictors.multiple_regression import MultipleRegression
+from bdbcontrib.predictors.streaming_regression import StreamingRegression
 
 # TODO: More robust tests exploring more interesting cases. The main use
 # right now is crash testing. Moreover common patterns can be automated.
@@ -156,3 +165,172 @@ def test_multiple_regression():
     mr_predictor2.simulate(10, inputs)
     pdf_val2 = mr_predictor2.logpdf(-0.4, inputs)
     assert np.allclose(pdf_val, pdf_val2)
+
+def test_streaming_regression():
+    (bdb, table) = get_synthetic_data(150)
+    conditions = [(c, 'NUMERICAL') for c in ['c1','c2','c4','c8']] + \
+        [(c, 'CATEGORICAL') for c in ['m1', 'm3']]
+    target = [('c7', 'NUMERICAL')]
+    mr_predictor = MultipleRegression.create(bdb, table, target, conditions)
+    sr_predictor = StreamingRegression.create(bdb, table, target, conditions,
+        chunk_size=40)
+    # Same fit as the in-memory regression, with seen and unseen values.
+    for m3 in [4, 7]:
+        inputs = {'c1':1.3, 'c2':-2.1, 'c4':0.2, 'c8':0.2, 'm1':1, 'm3':m3}
+        assert np.allclose(sr_predictor.logpdf(-0.4, inputs),
+            mr_predictor.logpdf(-0.4, inputs))
+    # Training on a prefix of the table and updating with the rest, whose
+    # category values may be new, amounts to training on all of it.
+    bdb.sql_execute('CREATE TABLE head AS SELECT * FROM %s LIMIT 60' % table)
+    head_predictor = StreamingRegression.create(bdb, 'head', target,
+        conditions)
+    head_predictor.means = sr_predictor.means
+    df = table_to_df(bdb, table, ['c7','c1','c2','c4','c8','m1','m3'])
+    head_predictor = StreamingRegression.update(bdb, head_predictor,
+        df.iloc[60:])
+    # Serialization keeps the statistics.
+    binary = StreamingRegression.serialize(bdb, head_predictor)
+    head_predictor = StreamingRegression.deserialize(bdb, binary)
+    assert head_predictor.n == 150
+    batch = df.iloc[::10]
+    assert np.allclose(
+        head_predictor.logpdf_many(batch['c7'].values, batch),
+        sr_predictor.logpdf_many(batch['c7'].values, batch))
+    # Nor was it ever pickled.
+    with pytest.raises(BLE):
+        StreamingRegression.deserialize(bdb, pickle.dumps({}))
+
+def test_batched_interface():
+    # The batched interface must agree with the single-row interface.
+    (bdb, table) = get_synthetic_data(150)
+    conditions = [(c, 'NUMERICAL') for c in ['c1','c2','c4','c8']] + \
+        [(c, 'CATEGORICAL') for c in ['m1', 'm3']]
+    rows = pd.DataFrame([
+        {'c1':1.3, 'c2':-2.1, 'c4':0.2, 'c8':0.2, 'm1':1, 'm3':7},
+        {'c1':1.3, 'c2':-2.1, 'c4':0.2, 'c8':0.2, 'm1':1, 'm3':4},
+        {'c1':0.1, 'c2':1.7, 'c4':-0.5, 'c8':1.2, 'm1':2, 'm3':3},
+    ])
+    row_dicts = [dict(r) for _, r in rows.iterrows()]
+    srf = RandomForest.create(bdb, table, [('m5', 'CATEGORICAL')], conditions)
+    values = [7, 7, -1]
+    expected = [srf.logpdf(v, r) for v, r in zip(values, row_dicts)]
+    assert np.allclose(srf.logpdf_many(values, rows), expected)
+    assert len(srf.simulate_many(rows)) == len(rows)
+    probabilities, classes = srf.predictive_distribution_many(rows)
+    assert np.allclose(np.log(probabilities[0, list(classes).index(7)]),
+        expected[0])
+    mr = MultipleRegression.create(bdb, table, [('c7', 'NUMERICAL')],
+        conditions)
+    values = [-0.4, 0.3, 1.1]
+    expected = [mr.logpdf(v, r) for v, r in zip(values, row_dicts)]
+    assert np.allclose(mr.logpdf_many(values, rows), expected)
+    assert len(mr.simulate_many(rows)) == len(rows)
+    means, scales = mr.predictive_distribution_many(rows)
+    assert np.allclose(mr.logpdf_many(means, rows),
+        -np.log(scales) - 0.5 * np.log(2 * np.pi))
+    kl = KeplersLaw.create(bdb, table, [('c4', 'NUMERICAL')],
+        [('c1','NUMERICAL'), ('c2', 'NUMERICAL')])
+    values = [1.2, 0.3, -0.2]
+    expected = [kl.logpdf(v, r) for v, r in zip(values, row_dicts)]
+    assert np.allclose(kl.logpdf_many(values, rows), expected)
+    assert len(kl.simulate_many(rows)) == len(rows)
+    # Predictors without a batched interface fall back to row loops.
+    class Constant(object):
+        def simulate(self, n_samples, conditions):
+            return [conditions['c1']] * n_samples
+        def logpdf(self, value, conditions):
+            return 0. if value == conditions['c1'] else -float('inf')
+    const = Constant()
+    assert list(predictor.simulate_many(const, rows)) == list(rows['c1'])
+    assert list(predictor.logpdf_many(const, [1.3, 0., 0.1], rows)) == \
+        [0., -float('inf'), 0.]
+    # Nor do they evaluate their distributions.
+    assert predictor.predictive_distribution_many(const, rows) is None
+    assert kl.predictive_distribution_many(rows) is None
+
+def test_memoized_distributions():
+    (bdb, table) = get_synthetic_data(150)
+    conditions = [(c, 'NUMERICAL') for c in ['c1','c2','c4','c8']] + \
+        [(c, 'CATEGORICAL') for c in ['m1', 'm3']]
+    parents = {'c1':1.3, 'c2':-2.1, 'c4':0.2, 'c8':0.2, 'm1':1, 'm3':4, 'm5':5}
+    for pred_class, target, value in [
+            (RandomForest, [('m5', 'CATEGORICAL')], 7),
+            (MultipleRegression, [('c5', 'NUMERICAL')], 0.5)]:
+        pred = pred_class.create(bdb, table, target, conditions)
+        logp = pred.logpdf(value, parents)
+        pred.simulate(3, parents)
+        # Conditions outside the predictor's inputs do not affect the key.
+        assert pred.logpdf(value, dict(parents, m5=0)) == logp
+        info = pred.memo_info()
+        assert (info['size'], info['hits'], info['misses']) == (1, 2, 1)
+        # The memo size is kept across serialization; zero disables it.
+        pred.memo_size = 0
+        pred2 = pred_class.deserialize(bdb, pred_class.serialize(bdb, pred))
+        assert pred2.memo_size == 0
+        assert np.allclose(pred2.logpdf(value, parents), logp)
+        pred2.logpdf(value, parents)
+        assert pred2.memo_info()['size'] == 0
+        assert pred2.memo_info()['hits'] == 0
+        # Its size is an option of create.
+        pred = pred_class.create(bdb, table, target, conditions,
+            memo_size=16)
+        assert pred.memo_info()['memo_size'] == 16
+
+def test_compact_serialization():
+    (bdb, table) = get_synthetic_data(150)
+    conditions = [(c, 'NUMERICAL') for c in ['c1','c2','c4','c8']] + \
+        [(c, 'CATEGORICAL') for c in ['m1', 'm3']]
+    df = table_to_df(bdb, table).iloc[::5]
+    # Category values unseen for some rows, to query the partial models.
+    df.loc[df.index[::2], 'm3'] = 100
+    rf = RandomForest.create(bdb, table, [('m5', 'CATEGORICAL')], conditions)
+    mr = MultipleRegression.create(bdb, table, [('c7', 'NUMERICAL')],
+        conditions)
+    for pred, target in [(rf, 'm5'), (mr, 'c7')]:
+        pred_class = type(pred)
+        expected = pred.logpdf_many(df[target].values, df)
+        for compress in [False, True]:
+            pred_class.compress = compress
+            try:
+                binary = pred_class.serialize(bdb, pred)
+            finally:
+                pred_class.compress = False
+            pred2 = pred_class.deserialize(bdb, buffer(binary))
+            assert np.allclose(pred2.logpdf_many(df[target].values, df),
+                expected)
+            assert np.allclose(pred2.logpdf(df[target].values[0],
+                    df.iloc[0].to_dict()), expected[0])
+        # Much smaller than the pickled sklearn models.
+        assert len(binary) < len(pickle.dumps(pred))
+    # Predictors pickled by earlier versions still load.
+    old_binary = pickle.dumps({
+        'targets': rf.targets,
+        'conditions_numerical': rf.conditions_numerical,
+        'conditions_categorical': rf.conditions_categorical,
+        'rf_full': rf.rf_full,
+        'rf_partial': rf.rf_partial,
+        'categories_to_val_map': rf.categories_to_val_map,
+    })
+    rf2 = RandomForest.deserialize(bdb, old_binary)
+    assert np.allclose(rf2.logpdf_many(df['m5'].values, df),
+        rf.logpdf_many(df['m5'].values, df))
+    # A partial forest trained lazily is fit when serialized, rather than
+    # storing its training set.
+    rf = RandomForest.create(bdb, table, [('m5', 'CATEGORICAL')], conditions,
+        n_estimators=5, lazy_partial=True)
+    assert rf.partial_data is not None
+    binary = RandomForest.serialize(bdb, rf)
+    assert rf.partial_data is None
+    _state, arrays = serialization.loads(binary, RandomForest.name())
+    assert 'partial_X' not in arrays
+    rf2 = RandomForest.deserialize(bdb, binary)
+    assert rf2.partial_data is None
+    assert rf2.rf_partial.n_estimators == 5
+    assert np.allclose(rf2.logpdf_many(df['m5'].values, df),
+        rf.logpdf_many(df['m5'].values, df))
+    # Flattened forests share the rows among n_jobs threads.
+    X = np.random.RandomState(0).normal(size=(50, 4))
+    expected = rf2.rf_partial.predict_proba(X)
+    for n_jobs in [2, -1, 100]:
+        rf2.rf_partial.n_jobs = n_jobs
+        assert np.allclose(rf2.rf_partial.predict_proba(X), expected)
@@ -23,6 +23,8 @@ import tempfile
 from pandas.util.testing import assert_frame_equal
 import pytest
 from bdbcontrib import cursor_to_df, parallel
+from bdbcontrib.metamodels.composer import Composer
+from bdbcontrib.predictors import random_forest
 from apsw import SQLError
 
 def test_estimate_pairwise_similarity():
@@ -112,6 +114,315 @@ def test_estimate_pairwise_similarity():
         assert_frame_equal(std_sim, parallel_sim, check_column_type=True)
 
 
+def test_bql_worker_pool():
+    """
+    Tests queries in a persistent pool of workers, and its reuse across
+    estimate_pairwise_similarity calls.
+    """
+    os.environ['BAYESDB_WIZARD_MODE'] = '1'
+
+    with tempfile.NamedTemporaryFile(suffix='.bdb') as bdb_file:
+        bdb = bayeslite.bayesdb_open(bdb_file.name)
+        with tempfile.NamedTemporaryFile() as temp:
+            temp.write(test_utils.csv_data)
+            temp.seek(0)
+            bayeslite.bayesdb_read_csv_file(
+                bdb, 't', temp.name, header=True, create=True)
+
+        bdb.execute('''
+            CREATE GENERATOR t_cc FOR t USING crosscat (
+                GUESS(*),
+                id IGNORE
+            )
+        ''')
+
+        bdb.execute('INITIALIZE 3 MODELS FOR t_cc')
+        bdb.execute('ANALYZE t_cc MODELS 0-2 FOR 10 ITERATIONS WAIT')
+
+        with pytest.raises(BLE):
+            parallel.BqlWorkerPool(bdb_file.name, cores=0)
+        with pytest.raises(BLE):
+            parallel.BqlWorkerPool(bdb_file.name, cores=1,
+                                   generators=['no_such_generator'])
+
+        # Workers which fail to open the BayesDB report it to queries.
+        pool = parallel.BqlWorkerPool(
+            os.path.join(tempfile.gettempdir(), 'no_such_dir', 'x.bdb'),
+            cores=1)
+        try:
+            with pytest.raises(BLE):
+                pool.apply_async('SELECT 1').get(timeout=60)
+        finally:
+            pool.terminate()
+
+        # Generators are named by quoted names.
+        bdb.execute('''
+            CREATE GENERATOR "t cc" FOR t USING crosscat (
+                GUESS(*),
+                id IGNORE
+            )
+        ''')
+        bdb.execute('INITIALIZE 1 MODEL FOR "t cc"')
+        query = 'ESTIMATE SIMILARITY FROM PAIRWISE "t cc" WHERE r0._rowid_ = 1'
+        with parallel.BqlWorkerPool(
+                bdb_file.name, cores=1, generators=['t cc']) as pool:
+            assert_frame_equal(cursor_to_df(bdb.execute(query)),
+                               pool.apply_async(query).get())
+
+        queries = [
+            'ESTIMATE SIMILARITY FROM PAIRWISE t_cc '
+            'WHERE r0._rowid_ = {}'.format(rowid)
+            for rowid in range(1, 11)
+        ]
+        with parallel.BqlWorkerPool(
+                bdb_file.name, cores=2, generators=['t_cc']) as pool:
+            # Results are in the order of the queries, whichever worker
+            # executes them.
+            for query, df in zip(queries, pool.imap(queries, window=3)):
+                assert_frame_equal(cursor_to_df(bdb.execute(query)), df)
+            assert_frame_equal(
+                cursor_to_df(bdb.execute('SELECT * FROM t WHERE id = ?',
+                                         (3,))),
+                pool.apply_async('SELECT * FROM t WHERE id = ?', (3,)).get())
+
+            # The workers see the models as analyzed since they started.
+            bdb.execute('ANALYZE t_cc MODELS 0-2 FOR 1 ITERATION WAIT')
+            assert_frame_equal(cursor_to_df(bdb.execute(queries[0])),
+                               pool.apply_async(queries[0]).get())
+
+            # The workers are read-only, and their errors are raised in the
+            # parent.
+            with pytest.raises(BLE):
+                pool.apply_async('DROP TABLE t').get()
+            with pytest.raises(BLE):
+                pool.apply_async('SELECT * FROM no_such_table').get()
+            with pytest.raises(BLE):
+                pool.apply_async('ESTIMATE').get()
+            assert bdb.execute('SELECT COUNT(*) FROM t').fetchall() == [(10,)]
+
+            # The pool outlives the calls which use it.
+            for sim_table in ['t_similarity', 't_similarity_2']:
+                parallel.estimate_pairwise_similarity(
+                    bdb_file.name, 't', 't_cc', sim_table=sim_table,
+                    pool=pool
+                )
+            std_sim = cursor_to_df(
+                bdb.execute('ESTIMATE SIMILARITY FROM PAIRWISE t_cc')
+            )
+            for sim_table in ['t_similarity', 't_similarity_2']:
+                pool_sim = cursor_to_df(
+                    bdb.execute('SELECT * FROM {}'.format(sim_table))
+                ).sort_values(by=['rowid0', 'rowid1'])
+                pool_sim.index = range(pool_sim.shape[0])
+                assert_frame_equal(std_sim, pool_sim, check_column_type=True)
+
+            # A pool serves only its own BayesDB.
+            with tempfile.NamedTemporaryFile(suffix='.bdb') as other:
+                with pytest.raises(BLE):
+                    parallel.estimate_pairwise_similarity(
+                        other.name, 't', 't_cc', pool=pool
+                    )
+
+
+def _register_composer(bdb):
+    composer = Composer()
+    composer.register_foreign_predictor(random_forest.RandomForest)
+    bayeslite.bayesdb_register_metamodel(bdb, composer)
+
+
+def test_bql_worker_pool_setup():
+    """
+    Tests that workers register metamodels by the setup of the pool, and
+    warm up the generators of those metamodels.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.bdb') as bdb_file:
+        bdb = bayeslite.bayesdb_open(bdb_file.name)
+        with tempfile.NamedTemporaryFile() as temp:
+            temp.write(test_utils.csv_data)
+            temp.seek(0)
+            bayeslite.bayesdb_read_csv_file(
+                bdb, 't', temp.name, header=True, create=True)
+        _register_composer(bdb)
+        bdb.execute('''
+            CREATE GENERATOR t_cp FOR t USING composer (
+                default (one NUMERICAL, two NUMERICAL),
+                random_forest (four CATEGORICAL GIVEN one, two)
+            )
+        ''')
+        bdb.execute('INITIALIZE 2 MODELS FOR t_cp')
+
+        # Predictive probabilities are estimated by sampling, so they are
+        # compared on handles with the same seed.
+        query = 'ESTIMATE PREDICTIVE PROBABILITY OF four FROM t_cp'
+        seed = 'y' * 32
+        seeded = bayeslite.bayesdb_open(bdb_file.name, seed=seed)
+        _register_composer(seeded)
+        with parallel.BqlWorkerPool(bdb_file.name, cores=1,
+                                    generators=['t_cp'],
+                                    setup=_register_composer) as pool:
+            assert_frame_equal(cursor_to_df(seeded.execute(query)),
+                               pool.apply_async(query, seed=seed).get())
+        seeded.close()
+
+        # Without the composer, the worker fails to warm up the generator,
+        # and says so to its queries.
+        pool = parallel.BqlWorkerPool(bdb_file.name, cores=1,
+                                      generators=['t_cp'])
+        try:
+            with pytest.raises(BLE):
+                pool.apply_async('SELECT 1').get(timeout=60)
+        finally:
+            pool.terminate()
+        bdb.close()
+
+
+def test_parallel_query():
+    """
+    Tests queries partitioned by rows, columns and samples against the
+    whole queries.
+    """
+    os.environ['BAYESDB_WIZARD_MODE'] = '1'
+
+    with tempfile.NamedTemporaryFile(suffix='.bdb') as bdb_file:
+        bdb = bayeslite.bayesdb_open(bdb_file.name)
+        with tempfile.NamedTemporaryFile() as temp:
+            temp.write(test_utils.csv_data)
+            temp.seek(0)
+            bayeslite.bayesdb_read_csv_file(
+                bdb, 't', temp.name, header=True, create=True)
+
+        bdb.execute('''
+            CREATE GENERATOR t_cc FOR t USING crosscat (
+                GUESS(*),
+                id IGNORE
+            )
+        ''')
+
+        bdb.execute('INITIALIZE 3 MODELS FOR t_cc')
+        bdb.execute('ANALYZE t_cc MODELS 0-2 FOR 10 ITERATIONS WAIT')
+
+        with parallel.BqlWorkerPool(bdb_file.name, cores=2) as pool:
+            # Partitioned by rows, and first rows of pairs, in parts of a
+            # few each, the results are those of the whole query in the
+            # same order.
+            for bql, bindings in [
+                    ('ESTIMATE _rowid_, PREDICTIVE PROBABILITY OF one '
+                     'FROM t_cc WHERE two > ?', (1,)),
+                    ('ESTIMATE SIMILARITY FROM PAIRWISE t_cc', None)]:
+                expected = cursor_to_df(bdb.execute(bql, bindings))
+                assert_frame_equal(expected, parallel.parallel_query(
+                    bdb_file.name, bql, bindings=bindings, chunk_size=3,
+                    pool=pool))
+                # Unordered, the results are the same once sorted.
+                results = parallel.parallel_query(
+                    bdb_file.name, bql, bindings=bindings, chunk_size=1,
+                    ordered=False, pool=pool)
+                assert_frame_equal(
+                    expected.sort_values(list(expected.columns))
+                        .reset_index(drop=True),
+                    results.sort_values(list(results.columns))
+                        .reset_index(drop=True))
+
+            # Partitioned by the first column of pairs, the results are in
+            # order of it.
+            bql = ('ESTIMATE DEPENDENCE PROBABILITY '
+                   'FROM PAIRWISE COLUMNS OF t_cc')
+            expected = cursor_to_df(bdb.execute(bql)).sort_values(
+                ['name0', 'name1']).reset_index(drop=True)
+            results = parallel.parallel_query(
+                bdb_file.name, bql, chunk_size=1, pool=pool)
+            assert list(results['name0']) == sorted(results['name0'])
+            assert_frame_equal(expected, results.sort_values(
+                ['name0', 'name1']).reset_index(drop=True))
+
+            # Column names are compared without regard to case, so mixed
+            # case names fall in exactly one part each.
+            bdb.sql_execute('''
+                CREATE TABLE m AS
+                    SELECT one AS A, two AS b, three AS C, four AS d FROM t
+            ''')
+            bdb.execute('CREATE GENERATOR m_cc FOR m USING crosscat (GUESS(*))')
+            bdb.execute('INITIALIZE 1 MODEL FOR m_cc')
+            bql = ('ESTIMATE DEPENDENCE PROBABILITY '
+                   'FROM PAIRWISE COLUMNS OF m_cc')
+            expected = cursor_to_df(bdb.execute(bql)).sort_values(
+                ['name0', 'name1']).reset_index(drop=True)
+            results = parallel.parallel_query(
+                bdb_file.name, bql, chunk_size=2, pool=pool)
+            assert len(results) == 16
+            assert_frame_equal(expected, results.sort_values(
+                ['name0', 'name1']).reset_index(drop=True))
+
+            # INFER samples its predictions, but keeps its rows in order.
+            inferred = parallel.parallel_query(
+                bdb_file.name,
+                'INFER EXPLICIT _rowid_, PREDICT one CONFIDENCE c FROM t_cc',
+                chunk_size=4, pool=pool)
+            assert list(inferred['_rowid_']) == range(1, 11)
+
+            # Into a table.
+            bql = 'ESTIMATE _rowid_, PREDICTIVE PROBABILITY OF one FROM t_cc'
+            assert parallel.parallel_query(
+                bdb_file.name, bql, table='t_pp', pool=pool) == 10
+            assert_frame_equal(
+                cursor_to_df(bdb.execute(bql)),
+                cursor_to_df(bdb.execute('SELECT * FROM t_pp')),
+                check_names=False)
+            with pytest.raises(BLE):
+                parallel.parallel_query(
+                    bdb_file.name, bql, table='t_pp', pool=pool)
+            assert parallel.parallel_query(
+                bdb_file.name, bql + ' WHERE one IS NULL', table='t_pp',
+                overwrite=True, pool=pool) == 0
+
+            # Partitioned by samples, simulations are reproducible from
+            # the seed, whichever worker simulates each part.
+            bql = 'SIMULATE one, four FROM t_cc LIMIT ?'
+            simulated = parallel.parallel_query(
+                bdb_file.name, bql, bindings=(25,), chunk_size=10, pool=pool)
+            assert simulated.shape == (25, 2)
+            assert_frame_equal(simulated, parallel.parallel_query(
+                bdb_file.name, bql, bindings=(25,), chunk_size=10,
+                pool=pool))
+            other_seed = parallel.parallel_query(
+                bdb_file.name, bql, bindings=(25,), chunk_size=10,
+                seed='x' * 32, pool=pool)
+            assert not simulated.equals(other_seed)
+            # A seeded query runs as on a handle opened with the seed, and
+            # leaves the workers read-only.
+            seed = 'y' * 32
+            seeded_bdb = bayeslite.bayesdb_open(bdb_file.name, seed=seed)
+            bql = 'SIMULATE one, four FROM t_cc LIMIT 5'
+            expected = cursor_to_df(seeded_bdb.execute(bql))
+            seeded_bdb.close()
+            for _ in range(3):
+                assert_frame_equal(
+                    expected, pool.apply_async(bql, seed=seed).get())
+            for _ in range(3):
+                with pytest.raises(BLE):
+                    pool.apply_async('DROP TABLE t').get()
+
+            for bql in [
+                    # Not partitioned.
+                    'SELECT * FROM t',
+                    'DROP TABLE t',
+                    # Not combined from its parts.
+                    'ESTIMATE _rowid_ FROM t_cc ORDER BY one',
+                    'ESTIMATE _rowid_ FROM t_cc LIMIT 3',
+                    'ESTIMATE DISTINCT one FROM t_cc',
+                    'ESTIMATE DEPENDENCE PROBABILITY '
+                    'FROM PAIRWISE COLUMNS OF t_cc ORDER BY value',
+                    'SIMULATE one FROM t_cc LIMIT 2 + 3',
+                    # No such generator.
+                    'SIMULATE one FROM t LIMIT 3']:
+                with pytest.raises(BLE):
+                    parallel.parallel_query(bdb_file.name, bql, pool=pool)
+            with pytest.raises(BLE):
+                parallel.parallel_query(
+                    bdb_file.name, 'SIMULATE one FROM t_cc LIMIT 3',
+                    partition_by='rows', pool=pool)
+
+
 def _bigger_csv_data(n=30):
     """
     Bigger, but not *too* big, csv data to test batch uploading without
@@ -172,6 +483,10 @@ def test_estimate_pairwise_similarity_long():
             assert cursor_to_df(
                 bdb.execute('SELECT * FROM t_similarity')
             ).shape == (N**2, 3)
+            # ...between the first N rows.
+            assert bdb.execute('''
+                SELECT MAX(rowid0), MAX(rowid1) FROM t_similarity
+            ''').fetchall() == [(N, N)]
         # N too high should fail
         with pytest.raises(BLE):
             parallel.estimate_pairwise_similarity(
@@ -188,3 +503,62 @@ def test_estimate_pairwise_similarity_long():
         )
 
         assert_frame_equal(std_sim, parallel_sim, check_column_type=True)
+
+        # Chunks much smaller than the share of each core are consumed as
+        # they arrive, with the same result.
+        parallel.estimate_pairwise_similarity(
+            bdb_file.name, 't', 't_cc', cores=2, chunk_size=7, overwrite=True
+        )
+        chunked_sim = cursor_to_df(
+            bdb.execute('SELECT * FROM t_similarity')
+        ).sort_values(by=['rowid0', 'rowid1'])
+        chunked_sim.index = range(chunked_sim.shape[0])
+        assert_frame_equal(std_sim, chunked_sim, check_column_type=True)
+
+        # Without mirroring, each unordered pair is stored once, and the
+        # symmetric view presents them all.
+        parallel.estimate_pairwise_similarity(
+            bdb_file.name, 't', 't_cc', cores=3, chunk_size=50, mirror=False,
+            overwrite=True
+        )
+        assert bdb.execute('''
+            SELECT COUNT(*) FROM t_similarity WHERE rowid0 <= rowid1
+        ''').fetchall() == [(40 * 41 / 2,)]
+        assert bdb.execute('''
+            SELECT COUNT(*) FROM t_similarity
+        ''').fetchall() == [(40 * 41 / 2,)]
+        symmetric_sim = cursor_to_df(
+            bdb.execute('SELECT * FROM t_similarity_symmetric')
+        ).sort_values(by=['rowid0', 'rowid1'])
+        symmetric_sim.index = range(symmetric_sim.shape[0])
+        assert_frame_equal(std_sim, symmetric_sim, check_column_type=True)
+
+        # The results are the same with an index on the rowids, deferred
+        # or clustered.
+        for index in ['deferred', 'without_rowid']:
+            stats = parallel.estimate_pairwise_similarity(
+                bdb_file.name, 't', 't_cc', index=index, overwrite=True
+            )
+            assert stats['rows'] == 40**2
+            assert 0 < stats['rows_per_second']
+            indexed_sim = cursor_to_df(
+                bdb.execute('SELECT * FROM t_similarity')
+            ).sort_values(by=['rowid0', 'rowid1'])
+            indexed_sim.index = range(indexed_sim.shape[0])
+            assert_frame_equal(std_sim, indexed_sim, check_column_type=True)
+            assert len(bdb.sql_execute(
+                'PRAGMA index_list(t_similarity)').fetchall()) == 1
+        with pytest.raises(BLE):
+            parallel.estimate_pairwise_similarity(
+                bdb_file.name, 't', 't_cc', index='clustered', overwrite=True
+            )
+
+        # Errors in the workers are raised in the parent.
+        with pytest.raises(BLE):
+            parallel.estimate_pairwise_similarity(
+                bdb_file.name, 't', 'no_such_model', overwrite=True
+            )
+        with pytest.raises(BLE):
+            parallel.estimate_pairwise_similarity(
+                bdb_file.name, 't', 't_cc', chunk_size=0, overwrite=True
+            )
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import struct
+
+import numpy as np
+import pytest
+
+from bayeslite.exception import BayesLiteException as BLE
+from bdbcontrib.predictors import serialization
+
+def test_round_trip():
+    arrays = {
+        'coef': np.arange(5, dtype=float),
+        'nodes': np.arange(12, dtype=np.int32).reshape(3, 4),
+        'big': np.arange(3, dtype='>i8'),
+        'mask': np.array([True, False, True]),
+        'empty': np.zeros((0, 2)),
+    }
+    state = {'targets': ['a'], 'noise': np.float64(0.5), 'count': np.int64(3)}
+    for compress in [False, True]:
+        binary = serialization.dumps('kind', state, arrays, compress=compress)
+        assert serialization.is_compact(binary)
+        # As read back from a BLOB.
+        state2, arrays2 = serialization.loads(buffer(binary), 'kind')
+        assert state2 == {'targets': ['a'], 'noise': 0.5, 'count': 3}
+        assert sorted(arrays2) == sorted(arrays)
+        for name in arrays:
+            assert arrays2[name].shape == arrays[name].shape
+            assert np.array_equal(arrays2[name], arrays[name])
+            assert arrays2[name].dtype.byteorder in '<|='
+        # Uncompressed arrays are views of the binary.
+        assert compress or not arrays2['coef'].flags.writeable
+
+def test_invalid():
+    binary = serialization.dumps('kind', {}, {'x': np.zeros(2)})
+    with pytest.raises(BLE):
+        serialization.loads(binary, 'other_kind')
+    assert not serialization.is_compact('(dp0\n')
+    with pytest.raises(BLE):
+        serialization.loads('(dp0\n', 'kind')
+    with pytest.raises(BLE):
+        serialization.dumps('kind', {}, {'x': np.array(['a'], dtype=object)})
+    # A newer format version is refused.
+    start = len(serialization.MAGIC)
+    newer = binary[:start] + struct.pack('<H', serialization.VERSION + 1) + \
+        binary[start+2:]
+    with pytest.raises(BLE):
+        serialization.loads(newer, 'kind')
+
+def test_categories():
+    categories_to_val_map = {'a': {'x': 1, None: 0, 'y': 2}, 'b': {1.5: 0}}
+    encoded = serialization.encode_categories(categories_to_val_map)
+    assert encoded == {'a': [None, 'x', 'y'], 'b': [1.5]}
+    assert serialization.decode_categories(encoded) == categories_to_val_map
@@ -16,6 +16,7 @@
 
 import numpy as np
 import pandas as pd
+import pytest
 from bdbcontrib.predictors import sklearn_utils as sku
 
 def test_extract_sklearn_dataset():
@@ -71,6 +72,37 @@ def test_extract_sklearn_features_categorical():
         [0, 0, 0, 1, 0, 0, 1]])
     assert np.array_equal(matrix, expected)
 
+def test_binarize_categorical_rows():
+    dataset = pd.DataFrame({
+        'Nationality':['USA', 'USA', 'France', 'Germany', 'Bengal'],
+        'Gender':['M', 'F', None, 'M', 'T'],
+        })
+    categories = ['Nationality', 'Gender']
+    categories_to_val_map = sku.build_categorical_to_value_map(
+        categories, dataset)
+    expected = np.asarray([sku.binarize_categorical_row(categories,
+            categories_to_val_map, list(row))
+        for row in dataset[categories].itertuples(index=False)])
+    matrix = sku.binarize_categorical_rows(categories,
+        categories_to_val_map, dataset)
+    assert matrix.dtype == np.uint8
+    assert np.array_equal(matrix, expected)
+    sparse = sku.extract_sklearn_features_categorical(categories,
+        categories_to_val_map, dataset, sparse=True)
+    assert sparse.format == 'csr'
+    assert np.array_equal(sparse.toarray(), expected)
+    # A batch of query rows, in any column order.
+    query = pd.DataFrame({'Gender':['T', None], 'Nationality':['USA', 'USA']})
+    matrix = sku.binarize_categorical_rows(categories, categories_to_val_map,
+        query)
+    assert np.array_equal(matrix, [sku.binarize_categorical_row(categories,
+            categories_to_val_map, ['USA', value]) for value in ['T', None]])
+    # Values without a code are rejected, as by binarize_categorical_row.
+    with pytest.raises(KeyError):
+        sku.binarize_categorical_rows(categories, categories_to_val_map,
+            pd.DataFrame({'Gender':['M'], 'Nationality':['Canada']}))
+    assert sku.binarize_categorical_rows([], {}, query).shape == (2, 0)
+
 def test_build_categorical_to_value_map():
     dataset = pd.DataFrame({
         'Nationality':['USA', 'USA', 'France', 'Germany', 'Bengal'],